@@ -11,8 +11,9 @@ import pty
 import signal
 import atexit
 
-import tornado.ioloop
+from tornado import gen
 from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
 import tornado.process
 
 from seesaw.event import Event
@@ -75,7 +76,7 @@ class AsyncPopen(object):
         os.setpgrp()
 
     def run(self):
-        self.ioloop = IOLoop.instance()
+        self.ioloop = IOLoop.current()
         (master_fd, slave_fd) = pty.openpty()
 
         # make stdout, stderr non-blocking
@@ -105,7 +106,7 @@ class AsyncPopen(object):
         _all_procs.add(self.pipe)
 
     def _handle_subprocess_stdout(self, fd, events):
-        if not self.master.closed and (events & IOLoop._EPOLLIN) != 0:
+        if not self.master.closed and (events & IOLoop.READ) != 0:
             data = self.master.read()
             self.on_output(data)
 
@@ -114,7 +115,7 @@ class AsyncPopen(object):
     def _wait_for_end(self, events=0):
         self.pipe.poll()
         if self.pipe.returncode is not None or \
-                (events & tornado.ioloop.IOLoop._EPOLLHUP) > 0:
+                (events & IOLoop.ERROR) > 0:
             self.wait_callback.stop()
             self.master.close()
             self.ioloop.remove_handler(self.master_fd)
@@ -124,6 +125,7 @@ class AsyncPopen(object):
 
 class AsyncPopen2(object):
     '''Adapter for the legacy AsyncPopen'''
+    READ_SIZE = 65536
 
     def __init__(self, *args, **kwargs):
         self.args = args
@@ -141,16 +143,24 @@ class AsyncPopen2(object):
 
         self.pipe = tornado.process.Subprocess(*self.args, **self.kwargs)
 
-        self.pipe.stdout.read_until_close(
-            callback=self._handle_subprocess_stdout,
-            streaming_callback=self._handle_subprocess_stdout)
-        self.pipe.stderr.read_until_close(
-            callback=self._handle_subprocess_stdout,
-            streaming_callback=self._handle_subprocess_stdout)
+        io_loop = IOLoop.current()
+        for stream in (self.pipe.stdout, self.pipe.stderr):
+            io_loop.add_future(self._read_stream(stream),
+                               lambda future: future.result())
 
         self.pipe.set_exit_callback(self._end_callback)
         _all_procs.add(self.pipe)
 
+    @gen.coroutine
+    def _read_stream(self, stream):
+        while True:
+            try:
+                data = yield stream.read_bytes(self.READ_SIZE, partial=True)
+            except StreamClosedError:
+                return
+
+            self._handle_subprocess_stdout(data)
+
     def _handle_subprocess_stdout(self, data):
         self.on_output(data)
 
@@ -201,9 +211,11 @@ class ExternalProcess(Task):
                 close_fds=True
             )
 
-            p.on_output += functools.partial(self.on_subprocess_stdout, p,
-                                             item)
-            p.on_end += functools.partial(self.on_subprocess_end, item)
+            p.on_output += self.wrap_item_callback(
+                item,
+                functools.partial(self.on_subprocess_stdout, p, item))
+            p.on_end += self.wrap_item_callback(
+                item, functools.partial(self.on_subprocess_end, item))
 
             p.run()
             item["ExternalProcess.running"] = True
@@ -258,9 +270,10 @@ class ExternalProcess(Task):
                 "Retrying %s for %s after %d seconds...\n" %
                 (self, item.description(), self.retry_delay)
             )
-            IOLoop.instance().add_timeout(
+            IOLoop.current().add_timeout(
                 datetime.timedelta(seconds=self.retry_delay),
-                functools.partial(self.process, item)
+                self.wrap_item_callback(
+                    item, functools.partial(self.process, item))
             )
 
         else:
@@ -2,15 +2,21 @@
 import os
 import os.path
 import shutil
+import threading
 import traceback
 import time
-import collections
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 
 from seesaw.event import Event
 import seesaw.six
+import seesaw.util
 
 
-class ItemData(collections.MutableMapping):
+class ItemData(MutableMapping):
     '''Base item data property container.
 
     Args:
@@ -58,6 +64,90 @@ class ItemData(collections.MutableMapping):
         return iter(self._properties)
 
 
+class DirectoryReaper(object):
+    '''Removes directories in a background thread.
+
+    A directory is first renamed into a ``.trash`` directory next to it,
+    which is quick and leaves its name free, and then deleted by a daemon
+    thread so that large directories do not block the IOLoop. Leftovers
+    from a previous run are deleted when a trash directory is first used.
+    '''
+    TRASH_DIR_NAME = ".trash"
+
+    def __init__(self):
+        self._queue = seesaw.six.moves.queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._thread_pid = None
+        self._scanned_trash_dirs = set()
+
+    def move_to_trash(self, dirname):
+        '''Renames `dirname` into the trash directory and deletes it later.
+
+        Returns False if it could not be renamed.
+        '''
+        parent_dir, basename = os.path.split(os.path.abspath(dirname))
+        trash_dir = os.path.join(parent_dir, self.TRASH_DIR_NAME)
+        self.reap(trash_dir)
+
+        trash_name = os.path.join(
+            trash_dir, "%s-%s" % (basename, seesaw.util.unique_id_str()))
+
+        try:
+            if not os.path.isdir(trash_dir):
+                os.makedirs(trash_dir)
+            os.rename(dirname, trash_name)
+        except OSError:
+            return False
+
+        self._put(trash_name)
+        return True
+
+    def remove(self, dirname):
+        '''Deletes `dirname` in the background.'''
+        if not self.move_to_trash(dirname):
+            self._put(dirname)
+
+    def reap(self, trash_dir):
+        '''Deletes everything left in `trash_dir`, once per directory.'''
+        with self._lock:
+            if trash_dir in self._scanned_trash_dirs:
+                return
+            self._scanned_trash_dirs.add(trash_dir)
+
+        if os.path.isdir(trash_dir):
+            for name in os.listdir(trash_dir):
+                self._put(os.path.join(trash_dir, name))
+
+    def join(self):
+        '''Waits until all scheduled directories are deleted.'''
+        self._queue.join()
+
+    def _put(self, dirname):
+        with self._lock:
+            # A forked worker process does not inherit the thread.
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._thread = threading.Thread(
+                    target=self._run, name="DirectoryReaper")
+                self._thread.daemon = True
+                self._thread.start()
+                self._thread_pid = os.getpid()
+
+        self._queue.put(dirname)
+
+    def _run(self):
+        while True:
+            dirname = self._queue.get()
+            try:
+                shutil.rmtree(dirname, ignore_errors=True)
+            finally:
+                self._queue.task_done()
+
+
+data_directory_reaper = DirectoryReaper()
+'''Removes the data directories of items.'''
+
+
 class Item(ItemData):
     '''A thing, or work unit, that needs to be downloaded.
 
@@ -167,7 +257,8 @@ class Item(ItemData):
     def prepare_data_directory(self):
         dirname = os.path.join(self._pipeline.data_dir, self._item_id)
         self["data_dir"] = dirname
-        if os.path.isdir(dirname):
+        if os.path.isdir(dirname) and \
+                not data_directory_reaper.move_to_trash(dirname):
             shutil.rmtree(dirname)
         os.makedirs(dirname)
 
@@ -175,7 +266,7 @@ class Item(ItemData):
         if not self._keep_data:
             dirname = self["data_dir"]
             if os.path.isdir(dirname):
-                shutil.rmtree(dirname)
+                data_directory_reaper.remove(dirname)
 
     def log_output(self, data, full_line=True):
         if isinstance(data, seesaw.six.binary_type):
@@ -1,6 +1,9 @@
+import os
+import shutil
+import tempfile
 import unittest
 
-from seesaw.item import Item
+from seesaw.item import Item, DirectoryReaper, data_directory_reaper
 
 
 class MockPipeline(object):
@@ -33,3 +36,25 @@ class ItemTest(unittest.TestCase):
         self.item['blah'] = 'blahblah'
 
         self.assertTrue(non_local_dict.get('callback_fired'))
+
+    def test_data_directory_is_reaped(self):
+        pipeline = MockPipeline()
+        pipeline.data_dir = tempfile.mkdtemp()
+
+        try:
+            trash_dir = os.path.join(pipeline.data_dir,
+                                     DirectoryReaper.TRASH_DIR_NAME)
+            os.makedirs(os.path.join(trash_dir, 'leftover', 'subdir'))
+
+            item = Item(pipeline, 'FakeID', 1)
+            dirname = item['data_dir']
+            with open(os.path.join(dirname, 'file'), 'w') as out_file:
+                out_file.write('data')
+
+            item.clear_data_directory()
+            self.assertFalse(os.path.exists(dirname))
+
+            data_directory_reaper.join()
+            self.assertEqual([], os.listdir(trash_dir))
+        finally:
+            shutil.rmtree(pipeline.data_dir)
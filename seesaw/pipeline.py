@@ -1,10 +1,11 @@
-import contextlib
+import functools
 import os
+import sys
 import traceback
 
-import tornado.stack_context
-
 from seesaw.event import Event
+from seesaw.item import Item
+import seesaw.util
 
 
 class Pipeline(object):
@@ -29,9 +30,15 @@ class Pipeline(object):
         self.on_stop_requested = Event()
         self.on_stop_canceled = Event()
         self.project = None
+        self.started = False
 
         self.items_in_pipeline = set()
+        # Index in self.tasks of the task each item is at, so a task
+        # may appear more than once in the pipeline.
+        self.item_positions = {}
         self.tasks = []
+        self._ui_task_list = None
+        self._ui_task_list_for_json = None
         for task in tasks:
             self.add_task(task)
 
@@ -39,33 +46,59 @@ class Pipeline(object):
         task.on_complete_item += self._task_complete_item
         task.on_fail_item += self._task_fail_item
         self.tasks.append(task)
+        self._ui_task_list = None
+        self._ui_task_list_for_json = None
 
     def enqueue(self, item):
+        if not self.started:
+            self.started = True
+            for task in self.tasks:
+                task.pipeline_started(self)
+
         self.items_in_pipeline.add(item)
         self.on_start_item(self, item)
-        self._enqueue_with_except(self.tasks[0], item)
+        self._enqueue_at(0, item)
 
-    def _enqueue_with_except(self, task, item):
-        @contextlib.contextmanager
-        def handle_item_exception(e_type, e_value, tb):
-            item.log_output("Failed %s for %s\n" % (task, item.description()))
-            item.log_output(
-                "".join(traceback.format_exception(e_type, e_value, tb))
-            )
-            item.log_error(self, e_value)
-            task.fail_item(item)
+    def _enqueue_at(self, position, item):
+        self.item_positions[item] = position
+        self._enqueue_with_except(self.tasks[position], item)
 
-        with tornado.stack_context.NullContext():
-            with tornado.stack_context.ExceptionStackContext(
-                    handle_item_exception):
-                task.enqueue(item)
+    def _enqueue_with_except(self, task, item):
+        try:
+            seesaw.util.call_with_exception_handler(
+                functools.partial(self._handle_callback_exception, task, item),
+                task.enqueue, item)
+        except Exception:
+            self._handle_item_exception(task, item, sys.exc_info())
+
+    def _handle_callback_exception(self, task, item, exc_info):
+        # The callback may run after the task is done with the item.
+        if not item.finished and item.task_status.get(task) not in \
+                (Item.TaskStatus.completed, Item.TaskStatus.failed):
+            self._handle_item_exception(task, item, exc_info)
+            return True
+
+    def _handle_item_exception(self, task, item, exc_info):
+        item.log_output("Failed %s for %s\n" % (task, item.description()))
+        item.log_output("".join(traceback.format_exception(*exc_info)))
+        item.log_error(self, exc_info[1])
+        task.fail_item(item)
 
     def _task_complete_item(self, task, item):
-        task_index = self.tasks.index(task)
-        if len(self.tasks) <= task_index + 1:
+        position = self.item_positions.get(item)
+        if position is None:
+            # The item has left the pipeline; this logs a warning.
+            self._complete_item(item)
+        elif self.tasks[position] is not task:
+            # See comment in _cancel_item.
+            item.log_output(
+                'Warning: Ignoring complete event from %s which is not the '
+                'current task.\n' % task +
+                ''.join(traceback.format_stack()))
+        elif len(self.tasks) <= position + 1:
             self._complete_item(item)
         else:
-            self._enqueue_with_except(self.tasks[task_index + 1], item)
+            self._enqueue_at(position + 1, item)
 
     def _task_fail_item(self, task, item):
         self._fail_item(item)
@@ -74,6 +107,7 @@ class Pipeline(object):
         if item in self.items_in_pipeline:
             item.cancel()
             self.items_in_pipeline.remove(item)
+            del self.item_positions[item]
             self.on_cancel_item(self, item)
             self.on_finish_item(self, item)
         else:
@@ -87,6 +121,7 @@ class Pipeline(object):
         if item in self.items_in_pipeline:
             item.complete()
             self.items_in_pipeline.remove(item)
+            del self.item_positions[item]
             self.on_complete_item(self, item)
             self.on_finish_item(self, item)
         else:
@@ -99,6 +134,7 @@ class Pipeline(object):
         if item in self.items_in_pipeline:
             item.fail()
             self.items_in_pipeline.remove(item)
+            del self.item_positions[item]
             self.on_fail_item(self, item)
             self.on_finish_item(self, item)
         else:
@@ -115,10 +151,27 @@ class Pipeline(object):
             self._cancel_item(item)
 
     def ui_task_list(self):
-        task_list = []
-        for task in self.tasks:
-            task.fill_ui_task_list(task_list)
-        return task_list
+        '''Returns the ``(task, name)`` pairs shown in the UI.
+
+        The list is built once and shared; do not modify it.
+        '''
+        if self._ui_task_list is None:
+            task_list = []
+            for task in self.tasks:
+                task.fill_ui_task_list(task_list)
+            self._ui_task_list = task_list
+
+        return self._ui_task_list
+
+    def ui_task_list_for_json(self):
+        '''Returns the UI task list as ``id`` and ``name`` dicts. It is
+        built once and shared.'''
+        if self._ui_task_list_for_json is None:
+            self._ui_task_list_for_json = [
+                {"id": id(task), "name": task_name}
+                for task, task_name in self.ui_task_list()]
+
+        return self._ui_task_list_for_json
 
     def __str__(self):
         return "Pipeline:\n -> " + ("\n -> ".join(map(str, self.tasks)))
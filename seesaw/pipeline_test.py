@@ -99,3 +99,45 @@ class ExternalProcessTest(BaseTestCase):
 
         self.assertEqual(1, pipeline.fail_count_test)
         self.assertIOLoopOK()
+
+    def test_repeated_task(self):
+        class CountingTask(SimpleTask):
+            def __init__(self):
+                SimpleTask.__init__(self, "CountingTask")
+
+            def process(self, item):
+                item['count'] = item.get('count', 0) + 1
+
+        counting_task = CountingTask()
+        pipeline = Pipeline(counting_task, PrintItem(), counting_task,
+                            counting_task)
+        pipeline.counts = []
+
+        def complete_callback(pipeline, item):
+            pipeline.counts.append(item['count'])
+
+        pipeline.on_complete_item += complete_callback
+
+        runner = SimpleRunner(pipeline, max_items=2)
+        runner.start()
+
+        self.assertEqual([3, 3], pipeline.counts)
+        self.assertEqual({}, pipeline.item_positions)
+        self.assertIOLoopOK()
+
+    def test_ui_task_list(self):
+        task1 = PrintItem()
+        task2 = SimpleTask('Task2')
+        pipeline = Pipeline(task1)
+
+        self.assertEqual([(task1, 'PrintItem')], pipeline.ui_task_list())
+        self.assertIs(pipeline.ui_task_list(), pipeline.ui_task_list())
+
+        pipeline.add_task(task2)
+
+        self.assertEqual([(task1, 'PrintItem'), (task2, 'Task2')],
+                         pipeline.ui_task_list())
+        self.assertEqual(
+            [{'id': id(task1), 'name': 'PrintItem'},
+             {'id': id(task2), 'name': 'Task2'}],
+            pipeline.ui_task_list_for_json())
@@ -1,30 +1,51 @@
 $(function() {
-  var conn = new SockJS(window.location.protocol + '//' + window.location.host);
+  var conn = null;
   var multiProject = false;
   var instanceID = null;
+  // The seq of the last numbered message, to skip those sent again.
+  var lastSeq = null;
   var eventCallbacks = {};
   var currentBroadcastMessageHash = null;
+  // The UI task lists of the pipelines, by pipeline ID.
+  var pipelineTasks = {};
 
   function processCarriageReturns(txt) {
     return txt.replace(/[^\n]*\r(?!\n|$)/g, "");
   }
 
-  conn.onopen = function() {
-    $('#connection-error').remove();
-  };
+  function connect() {
+    conn = new SockJS(window.location.protocol + '//' + window.location.host);
 
-  conn.onclose = function() {
-    var div = document.createElement('div');
-    div.id = 'connection-error';
-    div.innerHTML = 'There is no connection with the warrior.';
-    document.body.insertBefore(div, document.body.firstChild);
-  };
-  
-  conn.onmessage = function(event) {
-    var dataDoc = JSON.parse(event.data);
-    eventCallbacks[dataDoc.event_name](dataDoc.message);
+    conn.onopen = function() {
+      $('#connection-error').remove();
+    };
+
+    conn.onclose = function() {
+      if (!document.getElementById('connection-error')) {
+        var div = document.createElement('div');
+        div.id = 'connection-error';
+        div.innerHTML = 'There is no connection with the warrior.';
+        document.body.insertBefore(div, document.body.firstChild);
+      }
+      // Spread out the reconnects of many open pages.
+      window.setTimeout(connect, 2000 + Math.random() * 8000);
+    };
+
+    conn.onmessage = function(event) {
+      var dataDoc = JSON.parse(event.data);
+      if (dataDoc.seq != null) {
+        // A snapshot carries the seq of the last message it includes.
+        var isSnapshot = dataDoc.event_name == 'project.refresh' &&
+            dataDoc.message && dataDoc.message.resync;
+        if (!isSnapshot && lastSeq != null && dataDoc.seq <= lastSeq) {
+          return;
+        }
+        lastSeq = dataDoc.seq;
+      }
+      eventCallbacks[dataDoc.event_name](dataDoc.message);
+    };
   }
-  
+
   function registerEvent(event_name, func) {
     // socket.io to sockjs adapter
     eventCallbacks[event_name] = func;
@@ -36,16 +57,19 @@ $(function() {
       window.location.reload();
     } else {
       instanceID = msg;
+      // We skip the messages we already have.
+      conn.send(JSON.stringify({
+        'event_name': 'sync',
+        'message': { 'instance_id': instanceID }
+      }));
     }
   });
 
   registerEvent('warrior.settings_update', function(msg) {
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
     reloadSettingsTab();
   });
 
   registerEvent('warrior.projects_loaded', function(msg) {
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
 
     multiProject = true;
     $(document.body).removeClass('single-project');
@@ -53,7 +77,6 @@ $(function() {
   });
 
   registerEvent('warrior.project_installing', function(msg) {
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
 
     var projectLi = $('#project-' + msg.project.name);
     projectLi.addClass('installing');
@@ -62,7 +85,6 @@ $(function() {
   });
 
   registerEvent('warrior.project_installed', function(msg) {
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
 
     var projectLi = $('#project-' + msg.project.name);
     projectLi.removeClass('installing');
@@ -71,7 +93,6 @@ $(function() {
   });
 
   registerEvent('warrior.project_installation_failed', function(msg) {
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
 
     var projectLi = $('#project-' + msg.project.name);
     projectLi.removeClass('installing');
@@ -82,13 +103,20 @@ $(function() {
   });
 
   registerEvent('warrior.project_selected', function(msg) { // project
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
     reloadProjectsTab();
   });
 
   registerEvent('project.refresh', function(msg) { // project, pipeline, items
     if (msg) {
-//      if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
+
+      if (msg.resync) {
+        // A snapshot of the whole state.
+        clearItems();
+      }
+
+      if (msg.pipelines) {
+        $.extend(pipelineTasks, msg.pipelines);
+      }
 
       for (var i=0; i<msg.items.length; i++) {
         addItem(msg.items[i], true);
@@ -96,13 +124,13 @@ $(function() {
 
       showProject(msg.project);
       showRunnerStatus(msg.status);
+      showRunnerAdmission(msg.admission);
     }
   });
 
   var currentWarriorStatus = null;
 
   registerEvent('warrior.status', function(msg) {
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
 
     currentWarriorStatus = msg.status;
     showWarriorStatus(msg.status);
@@ -117,17 +145,22 @@ $(function() {
   });
 
   registerEvent('runner.status', function(msg) { // project_id
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
     showRunnerStatus(msg.status);
   });
 
+  registerEvent('runner.admission', function(msg) { // reason
+    showRunnerAdmission(msg.reason);
+  });
+
+  registerEvent('pipeline.tasks', function(msg) { // pipeline_id, tasks
+    pipelineTasks[msg.pipeline_id] = msg.tasks;
+  });
+
   registerEvent('pipeline.start_item', function(msg) { // pipeline_id, item
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
     addItem(msg.item);
   });
 
   registerEvent('item.output', function(msg) { // item_id, data
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
 
     var itemLog = $('#item-' + msg.item_id + ' pre.log')[0];
     if (itemLog) {
@@ -146,7 +179,6 @@ $(function() {
   });
 
   registerEvent('item.task_status', function(msg) { // item_id, task_id, new_status, old_status
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
 
     var itemTask = $('#item-' + msg.item_id + ' li.task-' + msg.task_id)[0];
     if (itemTask) {
@@ -175,13 +207,11 @@ $(function() {
   });
 
   registerEvent('item.update_name', function(msg) { // item_id, new_name
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
 
     $('#item-' + msg.item_id + ' h3 .name').text(msg.new_name);
   });
 
   registerEvent('item.complete', function(msg) { // pipeline_id, item_id
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
 
     $('#item-' + msg.item_id).addClass(itemStatusClassName['completed']);
     $('#item-' + msg.item_id + ' div.status').text(itemStatusTexts['completed']);
@@ -189,7 +219,6 @@ $(function() {
   });
 
   registerEvent('item.fail', function(msg) { // pipeline_id, item_id
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
 
     $('#item-' + msg.item_id).addClass(itemStatusClassName['failed']);
     $('#item-' + msg.item_id + ' div.status').text(itemStatusTexts['failed']);
@@ -197,7 +226,6 @@ $(function() {
   });
 
   registerEvent('item.cancel', function(msg) { // pipeline_id, item_id
-//    if (msg.session_id && msg.session_id != conn.socket.sessionid) return;
 
     $('#item-' + msg.item_id).addClass(itemStatusClassName['canceled']);
     $('#item-' + msg.item_id + ' div.status').text(itemStatusTexts['canceled']);
@@ -346,6 +374,15 @@ $(function() {
     }
   }
 
+  function showRunnerAdmission(reason) {
+    if (reason) {
+      $('#runner-admission').text('Paused new items: ' + reason + '.');
+      $('#runner-admission').css('display', 'table-cell');
+    } else {
+      $('#runner-admission').css('display', 'none');
+    }
+  }
+
   var projectCountdown = null;
 
   function showProject(project) {
@@ -420,9 +457,17 @@ $(function() {
     itemsDiv.innerHTML = '';
   }
 
+  function itemTasks(item) {
+    var tasks = pipelineTasks[item.pipeline_id] || [];
+    return $.map(tasks, function(task, i) {
+      return { 'id': task.id, 'name': task.name, 'status': item.task_status[i] };
+    });
+  }
+
   function addItem(item, skipAnimation) {
     var itemDiv, h3, div, ol, li, span, pre, name, briefTasks, briefLog,
         i, task;
+    var tasks = itemTasks(item);
 
     var openOrClosed = 'open';
     if (localStorage && localStorage.getItem("collapse-all") == "true") {
@@ -456,8 +501,8 @@ $(function() {
     ol = document.createElement('ol');
     ol.className = 'tasks';
     var currentTask = 0;
-    for (i=0; i<item.tasks.length; i++) {
-      task = item.tasks[i];
+    for (i=0; i<tasks.length; i++) {
+      task = tasks[i];
       li = document.createElement('li');
       li.className = 'task-' + task.id + ' ' + (task.status || '');
       li.appendChild(document.createTextNode(task.name + ' '));
@@ -505,7 +550,7 @@ $(function() {
     var itemsDiv = document.getElementById('items');
     itemsDiv.insertBefore(itemDiv, itemsDiv.firstChild);
 
-    updateBriefTasks(item.id, currentTask, item.tasks.length);
+    updateBriefTasks(item.id, currentTask, tasks.length);
     updateBriefLog(item.id, pre.data);
   }
 
@@ -668,6 +713,8 @@ $(function() {
                                                           .addClass('closed');
                                });
 
+  connect();
+
   /*
   addItem({
     'id': '1',
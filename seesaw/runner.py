@@ -1,14 +1,19 @@
 '''Pipeline execution.'''
+import collections
 import datetime
+import errno
 import functools
 import os
 import os.path
 import sys
+import time
 
+import seesaw.externalprocess
 import seesaw.util
 from seesaw.config import realize
 from seesaw.event import Event
 from seesaw.item import Item
+from seesaw.tracker import TrackerRequest
 
 from tornado import ioloop
 
@@ -16,27 +21,37 @@ from tornado import ioloop
 class Runner(object):
     '''Executes and manages the lifetime of :class:`Pipeline` instances.'''
     def __init__(self, stop_file=None, concurrent_items=1, max_items=None,
-                 keep_data=False):
+                 keep_data=False, admission_control=None):
         self.pipeline = None
         self.concurrent_items = concurrent_items
         self.max_items = max_items
         self.keep_data = keep_data
+        self.admission_control = admission_control
 
         self.item_count = 0
         self.active_items = set()
         self.stop_flag = False
+        self.finished = False
         self.stop_file = stop_file
         self.initial_stop_file_mtime = self.stop_file_mtime()
+        self.admission_refusal = None
+        self._admission_timeout = None
 
         self.on_status = Event()
         self.on_create_item = Event()
         self.on_pipeline_start_item = Event()
         self.on_pipeline_finish_item = Event()
         self.on_finish = Event()
+        self.on_admission = Event()
+
+        seesaw.util.handle_callback_exceptions(ioloop.IOLoop.current())
 
         if stop_file:
             ioloop.PeriodicCallback(self.check_stop_file, 5000).start()
 
+        if isinstance(concurrent_items, AdaptiveConcurrency):
+            concurrent_items.attach(self)
+
     def set_current_pipeline(self, pipeline):
         old_pipeline = self.pipeline
 
@@ -99,7 +114,11 @@ class Runner(object):
                 if self.max_items and self.max_items <= self.item_count:
                     return
 
+                if self.admission_control and not self._admit_item():
+                    return
+
                 self.item_count += 1
+                self.finished = False
                 item_id = "{0}-{1}".format(
                     seesaw.util.unique_id_str(), self.item_count)
                 item = Item(
@@ -112,13 +131,44 @@ class Runner(object):
                 self.active_items.add(item)
                 self.pipeline.enqueue(item)
 
+    def _admit_item(self):
+        reason = self.admission_control.refusal_reason(self)
+
+        if reason is None:
+            if self.admission_refusal is not None:
+                print("Resuming: there is enough headroom for new items.")
+                self.admission_refusal = None
+                self.on_admission(self, None)
+            return True
+
+        if reason != self.admission_refusal:
+            print("Not starting new items for now: %s. Running items "
+                  "continue; checking again every %d seconds."
+                  % (reason,
+                     realize(self.admission_control.recheck_interval)))
+            self.admission_refusal = reason
+            self.on_admission(self, reason)
+
+        if self._admission_timeout is None:
+            self._admission_timeout = ioloop.IOLoop.current().add_timeout(
+                datetime.timedelta(
+                    seconds=realize(self.admission_control.recheck_interval)),
+                self._recheck_admission
+            )
+
+        return False
+
+    def _recheck_admission(self):
+        self._admission_timeout = None
+        self._add_more_items()
+
     def _item_starting(self, pipeline, item):
         self.on_pipeline_start_item(self, pipeline, item)
 
     def _item_finished(self, pipeline, item):
         if item.failed:
             item.log_output("Waiting 10 seconds...")
-            ioloop.IOLoop.instance().add_timeout(
+            ioloop.IOLoop.current().add_timeout(
                 datetime.timedelta(seconds=10),
                 functools.partial(
                     self._item_finished_without_delay, pipeline, item)
@@ -130,27 +180,227 @@ class Runner(object):
         self.on_pipeline_finish_item(self, pipeline, item)
         self.active_items.remove(item)
 
-        def add_more_items():
-            if not self.should_stop():
-                self.add_items()
-
-            if len(self.active_items) == 0:
-                self.on_finish(self)
-
-        ioloop.IOLoop.instance().add_timeout(
+        ioloop.IOLoop.current().add_timeout(
             datetime.timedelta(),
-            add_more_items
+            self._add_more_items
         )
 
+    def _add_more_items(self):
+        if not self.should_stop():
+            self.add_items()
+
+        # Items that finish in the same IOLoop iteration each schedule
+        # this callback; only the first may report it. A runner waiting
+        # for admission has not finished.
+        if len(self.active_items) == 0 and not self.finished and \
+                self._admission_timeout is None:
+            self.finished = True
+            self.on_finish(self)
+
+
+class AdaptiveConcurrency(object):
+    '''Finds the number of concurrent items a host can handle.
+
+    Pass an instance as the `concurrent_items` of a :class:`Runner`. The
+    limit starts at `min_items` and grows additively, by one item for
+    every round of `limit` items that complete, up to `max_items`. It is
+    cut by `decrease_factor`, at most once every `cooldown` seconds, when
+
+    * the Tracker responds that it is rate limiting or overloaded (see
+      :meth:`seesaw.tracker.TrackerRequest.is_overload_status`),
+    * more than `max_failure_rate` of the last `failure_window` items
+      failed, or
+    * the upload rate reported by `bandwidth_monitor` (a
+      :class:`seesaw.warrior.BandwidthMonitor`) reaches `max_upload_rate`
+      bytes per second. A saturated uplink also stops any increase. The
+      monitor is sampled every `sample_interval` seconds while the
+      runner runs.
+
+    Lowering the limit does not stop running items; new items are started
+    once the number of active items falls below it.
+    '''
+    def __init__(self, max_items, min_items=1, decrease_factor=0.5,
+                 cooldown=60, failure_window=20, max_failure_rate=0.25,
+                 bandwidth_monitor=None, max_upload_rate=None,
+                 sample_interval=5):
+        self.max_items = max_items
+        self.min_items = min_items
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.max_failure_rate = max_failure_rate
+        self.bandwidth_monitor = bandwidth_monitor
+        self.max_upload_rate = max_upload_rate
+        self.sample_interval = sample_interval
+
+        self.limit = float(min_items)
+        self.outcomes = collections.deque((), failure_window)
+        self._last_decrease_time = None
+        self._sample_callback = None
+
+    def realize(self, dummy):
+        return int(self.limit)
+
+    def attach(self, runner):
+        runner.on_pipeline_finish_item += self._handle_finish_item
+        runner.on_finish += self.detach
+        TrackerRequest.on_tracker_response += self._handle_tracker_response
+
+        if self.bandwidth_monitor and self.max_upload_rate:
+            self._sample_callback = ioloop.PeriodicCallback(
+                self.bandwidth_monitor.update, self.sample_interval * 1000)
+            self._sample_callback.start()
+
+    def detach(self, runner):
+        # Called from runner.on_finish, which cannot be changed while it
+        # fires, so the handler stays and ignores later calls.
+        if self._handle_finish_item not in \
+                runner.on_pipeline_finish_item.handlers:
+            return
+
+        runner.on_pipeline_finish_item -= self._handle_finish_item
+        TrackerRequest.on_tracker_response -= self._handle_tracker_response
+
+        if self._sample_callback:
+            self._sample_callback.stop()
+            self._sample_callback = None
+
+    def increase(self):
+        if self.uplink_saturated():
+            self.decrease("the uplink is saturated")
+            return
+
+        old_limit = int(self.limit)
+        self.limit = min(realize(self.max_items),
+                         self.limit + 1.0 / max(1.0, self.limit))
+        if int(self.limit) != old_limit:
+            print("Raising concurrency to %d items." % int(self.limit))
+
+    def decrease(self, reason):
+        now = time.time()
+        if self._last_decrease_time is not None and \
+                now - self._last_decrease_time < self.cooldown:
+            return
+
+        self._last_decrease_time = now
+        self.outcomes.clear()
+        old_limit = int(self.limit)
+        self.limit = max(self.min_items, self.limit * self.decrease_factor)
+        if int(self.limit) != old_limit:
+            print("Lowering concurrency to %d items because %s."
+                  % (int(self.limit), reason))
+
+    def uplink_saturated(self):
+        if not self.bandwidth_monitor or not self.max_upload_rate:
+            return False
+
+        stats = self.bandwidth_monitor.current_stats()
+        return stats is not None and \
+            stats["sending"] >= realize(self.max_upload_rate)
+
+    def _handle_finish_item(self, runner, pipeline, item):
+        if item.canceled:
+            return
+
+        self.outcomes.append(item.failed)
+
+        if item.failed:
+            failure_rate = float(sum(self.outcomes)) / len(self.outcomes)
+            if len(self.outcomes) == self.outcomes.maxlen and \
+                    failure_rate > self.max_failure_rate:
+                self.decrease("%d%% of the recent items failed"
+                              % (failure_rate * 100))
+        else:
+            self.increase()
+
+    def _handle_tracker_response(self, task, status_code):
+        if task.is_overload_status(status_code):
+            self.decrease("the tracker returned status code %d"
+                          % status_code)
+
+
+class AdmissionControl(object):
+    '''Starts new items only while the host has headroom for them.
+
+    Pass an instance as the `admission_control` of a :class:`Runner`.
+    Before it starts an item, the runner checks that
+
+    * at least `min_free_disk` bytes are free for the pipeline's data
+      directory; once below, new items wait until `resume_free_disk`
+      bytes (default: twice `min_free_disk`) are free again,
+    * at least `min_free_memory` bytes of memory are available,
+    * the open file descriptors, plus as many again as an active item
+      holds on average, stay below `max_fd_usage` of the limit, and
+    * fewer than `max_processes` external processes are running.
+
+    Checks that cannot be measured on the platform are skipped. While
+    new items are refused, the runner checks again every
+    `recheck_interval` seconds; running items are not affected.
+    '''
+    def __init__(self, min_free_disk=1024 ** 3, resume_free_disk=None,
+                 min_free_memory=256 * 1024 ** 2, max_fd_usage=0.8,
+                 max_processes=None, recheck_interval=10):
+        self.min_free_disk = min_free_disk
+        self.resume_free_disk = resume_free_disk
+        self.min_free_memory = min_free_memory
+        self.max_fd_usage = max_fd_usage
+        self.max_processes = max_processes
+        self.recheck_interval = recheck_interval
+
+        self.disk_paused = False
+        self.free_disk = None
+
+    def refusal_reason(self, runner):
+        '''Returns why no new item should be started, or None.'''
+        min_free_disk = realize(self.min_free_disk)
+        if min_free_disk:
+            self.free_disk = seesaw.util.free_disk_space(
+                runner.pipeline.data_dir)
+
+            if self.free_disk is not None:
+                if self.disk_paused:
+                    threshold = realize(self.resume_free_disk) or \
+                        2 * min_free_disk
+                else:
+                    threshold = min_free_disk
+
+                self.disk_paused = self.free_disk < threshold
+
+                if self.disk_paused:
+                    return "waiting for %d MiB of free disk space" \
+                        % (threshold // 1024 ** 2)
+
+        min_free_memory = realize(self.min_free_memory)
+        if min_free_memory:
+            free_memory = seesaw.util.available_memory()
+            if free_memory is not None and free_memory < min_free_memory:
+                return "less than %d MiB of memory is available" \
+                    % (min_free_memory // 1024 ** 2)
+
+        max_fd_usage = realize(self.max_fd_usage)
+        open_fds = seesaw.util.open_fd_count()
+        fd_limit = seesaw.util.fd_limit()
+        if max_fd_usage and open_fds is not None and fd_limit is not None:
+            fds_per_item = open_fds // max(1, len(runner.active_items))
+            if open_fds + fds_per_item > fd_limit * max_fd_usage:
+                return "over %d%% of the file descriptors are in use" \
+                    % (max_fd_usage * 100)
+
+        max_processes = realize(self.max_processes)
+        num_processes = len(seesaw.externalprocess._all_procs)
+        if max_processes and num_processes >= max_processes:
+            return "%d external processes are running" % max_processes
+
+        return None
+
 
 class SimpleRunner(Runner):
     '''Executes a single class:`Pipeline` instance.'''
     def __init__(self, pipeline, stop_file=None, concurrent_items=1,
-                 max_items=None, keep_data=False):
+                 max_items=None, keep_data=False, admission_control=None):
         Runner.__init__(
             self, stop_file=stop_file,
             concurrent_items=concurrent_items, max_items=max_items,
-            keep_data=keep_data)
+            keep_data=keep_data, admission_control=admission_control)
 
         self.set_current_pipeline(pipeline)
         self.on_create_item += self._handle_create_item
@@ -158,16 +408,16 @@ class SimpleRunner(Runner):
 
     def start(self):
         Runner.start(self)
-        ioloop.IOLoop.instance().start()
+        ioloop.IOLoop.current().start()
         self.pipeline.on_cleanup()
 
     def _stop_ioloop(self, dummy):
-        ioloop.IOLoop.instance().stop()
+        ioloop.IOLoop.current().stop()
 
     def forced_stop(self):
         print("Stopping immediately...")
         # TODO perhaps the subprocesses should be killed
-        ioloop.IOLoop.instance().stop()
+        ioloop.IOLoop.current().stop()
 
     def _handle_create_item(self, dummy, item):
         item.on_output += self._handle_item_output
@@ -184,5 +434,5 @@ class SimpleRunner(Runner):
             except IOError as e:
                 # Ignore EINTR errors (which are spurious errors caused by signals) and retry the operation.
                 # Allow other errors to propagate up the call stack as normal.
-                if e.errno != os.errno.EINTR:
+                if e.errno != errno.EINTR:
                     raise
@@ -1,7 +1,11 @@
 from seesaw.pipeline import Pipeline
-from seesaw.runner import SimpleRunner
+from seesaw.runner import SimpleRunner, AdaptiveConcurrency, \
+    AdmissionControl
 from seesaw.task import PrintItem, SimpleTask
 from seesaw.test_base import BaseTestCase
+from seesaw.tracker import TrackerRequest
+import seesaw.externalprocess
+import seesaw.util
 
 class RunnerTest(BaseTestCase):
     def setUp(self):
@@ -50,3 +54,156 @@ class RunnerTest(BaseTestCase):
         runner.keep_running()
 
         self.assertEqual(1, self.stop_canceled_calls)
+
+    def test_adaptive_concurrency(self):
+        class MockItem(object):
+            canceled = False
+
+            def __init__(self, failed):
+                self.failed = failed
+
+        controller = AdaptiveConcurrency(4, cooldown=0, failure_window=4,
+                                         max_failure_rate=0.5)
+        self.assertEqual(1, controller.realize(None))
+
+        for dummy in range(20):
+            controller._handle_finish_item(None, None, MockItem(False))
+        self.assertEqual(4, controller.realize(None))
+
+        task = TrackerRequest('TrackerRequest', 'http://tracker.invalid/',
+                              'request')
+        controller._handle_tracker_response(task, 200)
+        controller._handle_tracker_response(task, 404)
+        self.assertEqual(4, controller.realize(None))
+        # An overloaded Tracker, like a rate limiting one.
+        controller._handle_tracker_response(task, 503)
+        self.assertEqual(2, controller.realize(None))
+
+        for dummy in range(4):
+            controller._handle_finish_item(None, None, MockItem(True))
+        self.assertEqual(1, controller.realize(None))
+
+    def test_adaptive_concurrency_runner(self):
+        class MockBandwidthMonitor(object):
+            updates = 0
+
+            def update(self):
+                self.updates += 1
+
+            def current_stats(self):
+                return {"sending": 0}
+
+        bandwidth_monitor = MockBandwidthMonitor()
+        handler_count = len(TrackerRequest.on_tracker_response)
+        controller = AdaptiveConcurrency(
+            3, bandwidth_monitor=bandwidth_monitor, max_upload_rate=1000,
+            sample_interval=60)
+        pipeline = Pipeline(PrintItem())
+        runner = SimpleRunner(
+            pipeline, concurrent_items=controller, max_items=10)
+        runner.start()
+
+        self.assertEqual(10, runner.item_count)
+        self.assertEqual(3, runner.concurrent_items.realize(None))
+        # The monitor is only sampled on the timer.
+        self.assertEqual(0, bandwidth_monitor.updates)
+        self.assertEqual(handler_count,
+                         len(TrackerRequest.on_tracker_response))
+        self.assertEqual(None, controller._sample_callback)
+
+    def stub_host(self, free_disk=None, free_memory=None, open_fds=None,
+                  fd_limit=None):
+        '''Makes seesaw.util report the given host resources.'''
+        values = {
+            'free_disk_space': lambda path: free_disk,
+            'available_memory': lambda: free_memory,
+            'open_fd_count': lambda: open_fds,
+            'fd_limit': lambda: fd_limit,
+        }
+
+        for name, function in values.items():
+            self.addCleanup(setattr, seesaw.util, name,
+                            getattr(seesaw.util, name))
+            setattr(seesaw.util, name, function)
+
+    def test_admission_control(self):
+        pipeline = Pipeline(PrintItem())
+        runner = SimpleRunner(pipeline, max_items=1)
+        controller = AdmissionControl(
+            min_free_disk=100 * 1024 ** 2, min_free_memory=50 * 1024 ** 2,
+            max_fd_usage=0.5, max_processes=2)
+
+        self.stub_host(free_disk=200 * 1024 ** 2, free_memory=60 * 1024 ** 2,
+                       open_fds=10, fd_limit=100)
+        self.assertEqual(None, controller.refusal_reason(runner))
+
+        self.stub_host(free_disk=99 * 1024 ** 2, free_memory=60 * 1024 ** 2,
+                       open_fds=10, fd_limit=100)
+        self.assertEqual('waiting for 100 MiB of free disk space',
+                         controller.refusal_reason(runner))
+        self.assertEqual(99 * 1024 ** 2, controller.free_disk)
+
+        self.stub_host(free_disk=200 * 1024 ** 2, free_memory=40 * 1024 ** 2,
+                       open_fds=10, fd_limit=100)
+        self.assertEqual('less than 50 MiB of memory is available',
+                         controller.refusal_reason(runner))
+
+        # Each of the two items holds 15 descriptors; one more would
+        # exceed half of the limit.
+        runner.active_items.update(['item-1', 'item-2'])
+        self.stub_host(free_disk=200 * 1024 ** 2, free_memory=60 * 1024 ** 2,
+                       open_fds=30, fd_limit=80)
+        self.assertEqual('over 50% of the file descriptors are in use',
+                         controller.refusal_reason(runner))
+        runner.active_items.clear()
+
+        # Checks that cannot be measured are skipped.
+        self.stub_host()
+        self.assertEqual(None, controller.refusal_reason(runner))
+
+        procs = seesaw.externalprocess._all_procs
+        self.addCleanup(procs.difference_update, ['proc-1', 'proc-2'])
+        procs.update(['proc-1', 'proc-2'])
+        self.assertEqual('2 external processes are running',
+                         controller.refusal_reason(runner))
+        procs.discard('proc-2')
+        self.assertEqual(None, controller.refusal_reason(runner))
+
+    def test_admission_control_runner(self):
+        class MockAdmissionControl(AdmissionControl):
+            def __init__(self):
+                AdmissionControl.__init__(self, recheck_interval=0.01)
+                self.refusals = 3
+
+            def refusal_reason(self, runner):
+                if self.refusals:
+                    self.refusals -= 1
+                    return 'testing'
+
+        pipeline = Pipeline(PrintItem())
+        runner = SimpleRunner(
+            pipeline, concurrent_items=2, max_items=4,
+            admission_control=MockAdmissionControl())
+        runner.start()
+
+        self.assertEqual(0, runner.admission_control.refusals)
+        self.assertEqual(4, runner.item_count)
+        self.assertFalse(runner.is_active())
+
+    def test_admission_control_disk_hysteresis(self):
+        pipeline = Pipeline(PrintItem())
+        runner = SimpleRunner(pipeline, max_items=1)
+        controller = AdmissionControl(
+            min_free_disk=100, resume_free_disk=200, min_free_memory=None,
+            max_fd_usage=None)
+        free_disk_space = seesaw.util.free_disk_space
+
+        try:
+            for free_disk, paused in [(150, False), (99, True), (150, True),
+                                      (200, False), (150, False)]:
+                seesaw.util.free_disk_space = lambda path: free_disk
+                reason = controller.refusal_reason(runner)
+                self.assertEqual(paused, reason is not None)
+                self.assertEqual(paused, controller.disk_paused)
+        finally:
+            seesaw.util.free_disk_space = free_disk_space
@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 from argparse import ArgumentParser
+import copy
 import itertools
 import os.path
 import re
@@ -8,9 +9,14 @@ import subprocess
 import sys
 import time
 
-from seesaw.runner import SimpleRunner
+from seesaw.runner import SimpleRunner, AdaptiveConcurrency, \
+    AdmissionControl
+from seesaw.supervisor import Supervisor, WorkerReporter, fork_workers, \
+    split_evenly
+from seesaw.warrior import BandwidthMonitor
 from seesaw.web import start_runner_server
 import seesaw
+import seesaw.util
 import tornado.ioloop
 import signal
 
@@ -54,12 +60,8 @@ def check_downloader_or_exit(value, regex="^[-_a-zA-Z0-9]{3,30}$"):
 
 
 def check_concurrency_or_exit(value):
-    if value > 20:
-        print()
-        print("I'm sorry, User. I'm afraid I can't do that.")
-        print('Please limit --concurrent to 20 or lower '
-              'to avoid exhausting resources or triggering bugs.'
-              )
+    if value < 1:
+        print('Please set --concurrent to 1 or higher.')
         sys.exit(1)
 
     if value > 6:
@@ -68,12 +70,23 @@ def check_concurrency_or_exit(value):
         print("!%-072s!" % ('    Whoa! Your concurrency level is at {0}.'
                             .format(value)))
         print("!%-072s!" % ('    Please check if this is what you wanted.'))
+        print("!%-072s!" % ('    Use --min-free-disk and --min-free-memory to '
+                            'only start'))
+        print("!%-072s!" % ('    new items while there is enough headroom.'))
         print("!%-072s!" % ('    Continuing anyway...'))
         print("!%-072s!" % " ")
         print("!" * 74)
         print()
 
 
+def use_uvloop_or_exit():
+    try:
+        seesaw.util.use_uvloop()
+    except RuntimeError as error:
+        print('Cannot use uvloop: {0}'.format(error))
+        sys.exit(1)
+
+
 def get_output(command):
     proc = subprocess.Popen(command, stdout=subprocess.PIPE)
     return proc.returncode, proc.communicate()[0]
@@ -172,6 +185,41 @@ def main():
     parser.add_argument("--concurrent", dest="concurrent_items",
                         help="work on N items at a time (default: 1)",
                         metavar="N", type=int, default=1)
+    parser.add_argument("--adaptive-concurrency",
+                        dest="adaptive_concurrency",
+                        help="adjust the number of items worked on between "
+                             "1 and --concurrent to what the tracker, the "
+                             "downloads and the uplink can take",
+                        action="store_true")
+    parser.add_argument("--max-upload-rate", dest="max_upload_rate",
+                        help="with --adaptive-concurrency, work on fewer "
+                             "items when uploads reach N kB/s",
+                        metavar="N", type=int, default=None)
+    parser.add_argument("--network-device", dest="network_device",
+                        help="the network device for --max-upload-rate "
+                             "(default: eth0)",
+                        metavar="DEVICE", type=str, default="eth0")
+    parser.add_argument("--min-free-disk", dest="min_free_disk",
+                        help="only start new items while N MB of disk space "
+                             "are free (default: no limit)",
+                        metavar="N", type=int, default=None)
+    parser.add_argument("--resume-free-disk", dest="resume_free_disk",
+                        help="after pausing for disk space, start new items "
+                             "again once N MB are free (default: twice "
+                             "--min-free-disk)",
+                        metavar="N", type=int, default=None)
+    parser.add_argument("--min-free-memory", dest="min_free_memory",
+                        help="only start new items while N MB of memory "
+                             "are available (default: no limit)",
+                        metavar="N", type=int, default=None)
+    parser.add_argument("--max-child-processes", dest="max_child_processes",
+                        help="only start new items while fewer than N "
+                             "external processes run (default: no limit)",
+                        metavar="N", type=int, default=None)
+    parser.add_argument("--processes", dest="processes",
+                        help="split --concurrent and --max-items across N "
+                             "worker processes (default: 1)",
+                        metavar="N", type=int, default=1)
     parser.add_argument("--max-items", dest="max_items",
                         help="stop after completing N items",
                         metavar="N", type=int, default=None)
@@ -204,6 +252,10 @@ def main():
                              "(name=text)",
                         metavar='VALUE_PAIR',
                         action='append', default=[], type=str)
+    parser.add_argument("--uvloop", dest="uvloop",
+                        help="run on the uvloop event loop (needs Tornado 5 "
+                             "or newer and the uvloop package)",
+                        action="store_true")
     parser.add_argument("--version", action="version",
                         version=seesaw.__version__)
     parser.add_argument("--auto-update", action="store_true",
@@ -213,6 +265,17 @@ def main():
     check_downloader_or_exit(args.downloader)
     check_concurrency_or_exit(args.concurrent_items)
 
+    if args.uvloop:
+        use_uvloop_or_exit()
+
+    if args.processes > 1:
+        if args.auto_update:
+            print('--auto-update cannot be used with --processes.')
+            sys.exit(1)
+
+        run_supervisor(args)
+        return
+
     if args.auto_update:
         check_git_repo_or_exit()
         trial_iterator = itertools.count(1)
@@ -229,8 +292,7 @@ def main():
         runner.start()
 
         if args.auto_update and runner.is_git_update_needed:
-            tornado.ioloop.IOLoop.instance().close(all_fds=True)
-            del tornado.ioloop.IOLoop._instance
+            seesaw.util.reset_ioloop()
             print("+++  End of trial {0}. Time to update.  +++"
                   .format(trial_num))
             update_repo()
@@ -239,7 +301,7 @@ def main():
             break
 
 
-def init_runner(args):
+def load_pipeline_from_args(args):
     context = {"downloader": args.downloader}
 
     for context_value in args.context_values:
@@ -249,8 +311,52 @@ def init_runner(args):
         else:
             raise Exception("Context value name %s already defined." % name)
 
-    (project, pipeline) = load_pipeline(args.pipeline, context)
+    return load_pipeline(args.pipeline, context)
+
+
+def run_supervisor(args):
+    num_workers = min(args.processes, args.concurrent_items,
+                      args.max_items or args.processes)
+    concurrent_shares = split_evenly(args.concurrent_items, num_workers)
+
+    if args.max_items:
+        max_items_shares = split_evenly(args.max_items, num_workers)
+    else:
+        max_items_shares = [None] * num_workers
+
+    def worker_main(index, event_fd, command_fd):
+        worker_args = copy.copy(args)
+        worker_args.concurrent_items = concurrent_shares[index]
+        worker_args.max_items = max_items_shares[index]
+        worker_args.enable_web_server = False
+
+        runner = init_runner(worker_args, print_banner=False)
+        reporter = WorkerReporter(runner, event_fd, command_fd)
+        runner.start()
+        reporter.close()
+
+    # Fork before anything in this process creates an IOLoop.
+    workers = fork_workers(num_workers, worker_main)
+
+    (project, pipeline) = load_pipeline_from_args(args)
+    print_pipeline_banner(project, pipeline)
+    print("Running %d worker processes." % num_workers)
+    print()
+
+    supervisor = Supervisor(pipeline, workers, stop_file=args.stop_file)
 
+    if args.enable_web_server:
+        start_web_server(args, project, supervisor)
+
+    print("Run 'touch %s' or interrupt (CTRL+C) to stop downloading."
+          % args.stop_file)
+    print()
+
+    attach_ctrl_c_handler(args.stop_file)
+    supervisor.start()
+
+
+def print_pipeline_banner(project, pipeline):
     print("*" * 74)
     print("*%-072s*" % " ")
     print("*%-072s*" % ("   ArchiveTeam Seesaw kit - %s" % seesaw.__version__))
@@ -264,28 +370,67 @@ def init_runner(args):
     print("-" * 74)
     print()
 
+
+def start_web_server(args, project, runner):
+    print("Starting the web interface on %s:%d..." %
+          (args.address, args.port_number))
+    print()
+    print("-" * 74)
+    print()
+    start_runner_server(project, runner,
+                        bind_address=args.address,
+                        port_number=args.port_number,
+                        http_username=args.http_username,
+                        http_password=args.http_password)
+
+
+def init_runner(args, print_banner=True):
+    (project, pipeline) = load_pipeline_from_args(args)
+
+    if print_banner:
+        print_pipeline_banner(project, pipeline)
+
+    if args.adaptive_concurrency:
+        if args.max_upload_rate:
+            bandwidth_monitor = BandwidthMonitor(args.network_device)
+            max_upload_rate = args.max_upload_rate * 1024
+        else:
+            bandwidth_monitor = None
+            max_upload_rate = None
+
+        concurrent_items = AdaptiveConcurrency(
+            args.concurrent_items,
+            bandwidth_monitor=bandwidth_monitor,
+            max_upload_rate=max_upload_rate)
+    else:
+        concurrent_items = args.concurrent_items
+
+    if args.min_free_disk or args.min_free_memory or \
+            args.max_child_processes:
+        # The file descriptor check comes with any of the limits.
+        admission_control = AdmissionControl(
+            min_free_disk=(args.min_free_disk or 0) * 1024 ** 2,
+            resume_free_disk=(args.resume_free_disk or 0) * 1024 ** 2,
+            min_free_memory=(args.min_free_memory or 0) * 1024 ** 2,
+            max_processes=args.max_child_processes)
+    else:
+        admission_control = None
+
     runner = SimpleRunner(
         pipeline,
         stop_file=args.stop_file,
-        concurrent_items=args.concurrent_items,
+        concurrent_items=concurrent_items,
         max_items=args.max_items,
-        keep_data=args.keep_data)
+        keep_data=args.keep_data,
+        admission_control=admission_control)
 
     if args.enable_web_server:
-        print("Starting the web interface on %s:%d..." %
-              (args.address, args.port_number))
-        print()
-        print("-" * 74)
-        print()
-        start_runner_server(project, runner,
-                            bind_address=args.address,
-                            port_number=args.port_number,
-                            http_username=args.http_username,
-                            http_password=args.http_password)
+        start_web_server(args, project, runner)
 
-    print("Run 'touch %s' or interrupt (CTRL+C) to stop downloading."
-          % args.stop_file)
-    print()
+    if print_banner:
+        print("Run 'touch %s' or interrupt (CTRL+C) to stop downloading."
+              % args.stop_file)
+        print()
 
     attach_ctrl_c_handler(args.stop_file)
 
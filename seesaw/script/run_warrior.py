@@ -5,11 +5,13 @@ from argparse import ArgumentParser
 import logging
 import logging.handlers
 import os
+import sys
 
 import seesaw
 seesaw.runner_type = "Warrior"
 
 from seesaw.log import LOG_FORMAT, LogFilter
+import seesaw.util
 from seesaw.warrior import Warrior
 from seesaw.web import start_warrior_server
 
@@ -66,6 +68,10 @@ def main():
                         help="the shutdown button in the web interface uses "
                              "sudo shutdown",
                         action="store_true")
+    parser.add_argument("--uvloop", dest="uvloop",
+                        help="run on the uvloop event loop (needs Tornado 5 "
+                             "or newer and the uvloop package)",
+                        action="store_true")
     # extra option to report the warrior VM version to the tracker
     # ask before using
     parser.add_argument("--warrior-build", dest="warrior_build",
@@ -74,6 +80,13 @@ def main():
 
     setup_logging(args.data_dir)
 
+    if args.uvloop:
+        try:
+            seesaw.util.use_uvloop()
+        except RuntimeError as error:
+            print('Cannot use uvloop: {0}'.format(error))
+            sys.exit(1)
+
     if args.warrior_build:
         seesaw.warrior_build = args.warrior_build
 
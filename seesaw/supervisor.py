@@ -0,0 +1,389 @@
+'''Running a pipeline in several worker processes.
+
+The supervisor forks worker processes that each run their own
+:class:`seesaw.runner.Runner` on their own IOLoop. Workers report their
+items over a pipe as JSON lines, with item output coalesced and
+throttled; the supervisor mirrors them in
+:class:`Item` instances so one web interface can show all of them.
+Commands such as a graceful stop are sent back over a second pipe.
+'''
+from __future__ import print_function
+
+import json
+import os
+import sys
+import traceback
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import PipeIOStream, StreamClosedError
+
+from seesaw.item import Item
+from seesaw.runner import Runner
+from seesaw.util import OutputCoalescer, OutputThrottle
+import seesaw.util
+
+
+def split_evenly(value, parts):
+    '''Splits the integer `value` into `parts` shares that differ by at
+    most one.'''
+    return [value // parts + (1 if index < value % parts else 0)
+            for index in range(parts)]
+
+
+class WorkerProcess(object):
+    '''The supervisor's handle of a forked worker.'''
+    def __init__(self, index, pid, event_fd, command_fd):
+        self.index = index
+        self.pid = pid
+        self.event_fd = event_fd
+        self.command_fd = command_fd
+        self.command_stream = None
+        self.exit_code = None
+
+    def close_fds(self):
+        for fd in (self.event_fd, self.command_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+def fork_workers(num_workers, worker_main):
+    '''Forks `num_workers` processes that each call
+    ``worker_main(index, event_fd, command_fd)`` and exit.
+
+    Each worker gets a fresh IOLoop. Returns a list of
+    :class:`WorkerProcess` in the supervisor.
+    '''
+    workers = []
+
+    for index in range(num_workers):
+        event_read_fd, event_write_fd = os.pipe()
+        command_read_fd, command_write_fd = os.pipe()
+
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(event_read_fd)
+            os.close(command_write_fd)
+
+            for worker in workers:
+                worker.close_fds()
+
+            exit_code = 1
+
+            try:
+                seesaw.util.reset_ioloop(close=False)
+                worker_main(index, event_write_fd, command_read_fd)
+                exit_code = 0
+            except SystemExit as error:
+                exit_code = error.code if isinstance(error.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+
+        os.close(event_write_fd)
+        os.close(command_read_fd)
+        workers.append(
+            WorkerProcess(index, pid, event_read_fd, command_write_fd))
+
+    return workers
+
+
+class WorkerReporter(object):
+    '''Reports the items of a worker's runner to the supervisor and
+    carries out the supervisor's commands.
+
+    Events are written without blocking the IOLoop. Call :meth:`close`
+    after the runner has stopped so the remaining events are sent before
+    the worker exits.
+
+    Item output is sent at most every `OUTPUT_FLUSH_INTERVAL` seconds and
+    limited to `OUTPUT_RATE` characters per second for all items of the
+    worker.
+    '''
+    OUTPUT_FLUSH_INTERVAL = 0.25
+    OUTPUT_FLUSH_SIZE = 16 * 1024
+    OUTPUT_RATE = 128 * 1024
+
+    def __init__(self, runner, event_fd, command_fd):
+        self.runner = runner
+        self.event_stream = PipeIOStream(event_fd)
+        self.command_stream = PipeIOStream(command_fd)
+        self.output_throttle = OutputThrottle(self.OUTPUT_RATE)
+        self._outputs = {}
+        self._task_indexes = None
+
+        runner.on_pipeline_start_item += self._handle_start_item
+        runner.on_pipeline_finish_item += self._handle_finish_item
+        runner.on_status += self._handle_status
+        runner.on_admission += self._handle_admission
+
+        IOLoop.current().add_future(self._read_commands(),
+                                    lambda future: future.result())
+
+    def send(self, event, **message):
+        message["event"] = event
+        data = json.dumps(message).encode("utf-8") + b"\n"
+
+        # The stream keeps the events in order. Once the supervisor is
+        # gone, the events are dropped.
+        if not self.event_stream.closed():
+            self.event_stream.write(data)
+
+    def close(self):
+        '''Sends the remaining events and closes the pipes.'''
+        for output in list(self._outputs.values()):
+            output.flush(force=True)
+
+        IOLoop.current().run_sync(self._drain)
+        self.event_stream.close()
+        self.command_stream.close()
+
+    @gen.coroutine
+    def _drain(self):
+        if not self.event_stream.closed():
+            try:
+                yield self.event_stream.write(b"")
+            except StreamClosedError:
+                pass
+
+    def flush_output(self, item):
+        output = self._outputs.get(item.item_id)
+
+        if output is not None:
+            output.flush(force=True)
+
+    def task_index(self, pipeline, task):
+        if self._task_indexes is None:
+            self._task_indexes = dict(
+                (ui_task, index) for index, (ui_task, dummy)
+                in enumerate(pipeline.ui_task_list()))
+
+        return self._task_indexes.get(task)
+
+    def _handle_start_item(self, runner, pipeline, item):
+        item_id = item.item_id
+
+        def send_output(data):
+            self.send("output", item_id=item_id, data=data)
+
+        self._outputs[item_id] = OutputCoalescer(
+            send_output, throttle=self.output_throttle,
+            flush_interval=self.OUTPUT_FLUSH_INTERVAL,
+            flush_size=self.OUTPUT_FLUSH_SIZE)
+
+        item.on_output += self._handle_item_output
+        item.on_task_status += self._handle_item_task_status
+        item.on_property += self._handle_item_property
+        item.on_item_state += self._handle_item_state
+        self.send("start_item", item_id=item_id)
+
+    def _handle_finish_item(self, runner, pipeline, item):
+        self.flush_output(item)
+        del self._outputs[item.item_id]
+        self.send("finish_item", item_id=item.item_id)
+
+    def _handle_status(self, runner, status):
+        self.send("status", status=status)
+
+    def _handle_admission(self, runner, reason):
+        self.send("admission", reason=reason)
+
+    def _handle_item_output(self, item, data):
+        output = self._outputs.get(item.item_id)
+
+        if output is not None:
+            output.add(data)
+
+    def _handle_item_task_status(self, item, task, new_status, old_status):
+        task_index = self.task_index(item.pipeline, task)
+        if task_index is not None:
+            self.flush_output(item)
+            self.send("task_status", item_id=item.item_id,
+                      task_index=task_index, status=new_status)
+
+    def _handle_item_property(self, item, key, new_value, old_value):
+        if key == "item_name":
+            self.send("item_name", item_id=item.item_id, name=new_value)
+
+    def _handle_item_state(self, item, state):
+        self.flush_output(item)
+        self.send("item_state", item_id=item.item_id, state=state)
+
+    @gen.coroutine
+    def _read_commands(self):
+        while True:
+            try:
+                line = yield self.command_stream.read_until(b"\n")
+            except StreamClosedError:
+                # The supervisor is gone; finish the current items.
+                if not self.runner.stop_flag:
+                    self.runner.stop_gracefully()
+                return
+
+            command = line.strip().decode("ascii")
+
+            if command == "stop":
+                self.runner.stop_gracefully()
+            elif command == "keep_running":
+                self.runner.keep_running()
+            elif command == "stop_now":
+                self.runner.forced_stop()
+
+
+class Supervisor(Runner):
+    '''Runs a pipeline in worker processes made by :func:`fork_workers`.
+
+    `pipeline` is the supervisor's own copy of the pipeline the workers
+    run. It is never run; its tasks are used to show the mirrored items.
+    '''
+    def __init__(self, pipeline, workers, stop_file=None):
+        Runner.__init__(self, stop_file=stop_file, concurrent_items=0)
+        self.pipeline = pipeline
+        self.workers = workers
+        self._items = {}
+        self._admission_refusals = {}
+        self._running_workers = 0
+
+    def start(self):
+        io_loop = IOLoop.current()
+
+        for worker in self.workers:
+            worker.command_stream = PipeIOStream(worker.command_fd)
+            self._running_workers += 1
+            io_loop.add_future(self._read_events(worker),
+                               lambda future: future.result())
+
+        io_loop.start()
+
+    def add_items(self):
+        pass
+
+    def stop_gracefully(self):
+        print("Stopping when current tasks are completed...")
+        self.stop_flag = True
+        self.initial_stop_file_mtime = self.stop_file_mtime()
+        self.send_command("stop")
+        self.on_status(self, "stopping")
+
+    def keep_running(self):
+        print("Keep running...")
+        self.stop_flag = False
+        self.initial_stop_file_mtime = self.stop_file_mtime()
+        self.send_command("keep_running")
+        self.on_status(self, "running")
+
+    def forced_stop(self):
+        print("Stopping immediately...")
+        self.send_command("stop_now")
+
+    def send_command(self, command):
+        for worker in self.workers:
+            if worker.exit_code is None and \
+                    not worker.command_stream.closed():
+                worker.command_stream.write(
+                    command.encode("ascii") + b"\n")
+
+    @gen.coroutine
+    def _read_events(self, worker):
+        event_stream = PipeIOStream(worker.event_fd)
+
+        while True:
+            try:
+                line = yield event_stream.read_until(b"\n")
+            except StreamClosedError:
+                break
+
+            self._handle_event(worker, json.loads(line.decode("utf-8")))
+
+        event_stream.close()
+        worker.command_stream.close()
+
+        dummy, status = os.waitpid(worker.pid, 0)
+        worker.exit_code = os.WEXITSTATUS(status) \
+            if os.WIFEXITED(status) else 1
+
+        if worker.exit_code != 0:
+            print("Worker %d exited with status %d."
+                  % (worker.index, worker.exit_code))
+
+        for (index, item_id), item in list(self._items.items()):
+            if index == worker.index:
+                if not item.finished:
+                    item.cancel()
+                self._finish_item(worker, item_id)
+
+        self._running_workers -= 1
+
+        if self._running_workers == 0:
+            self.on_finish(self)
+            IOLoop.current().stop()
+
+    def _handle_event(self, worker, message):
+        event = message["event"]
+
+        if event == "status":
+            stopping = message["status"] == "stopping"
+            if stopping != self.stop_flag:
+                self.stop_flag = stopping
+                self.on_status(self, message["status"])
+            return
+
+        if event == "admission":
+            self._admission_refusals[worker.index] = message["reason"]
+            reasons = ["worker %d: %s" % (index, reason) for index, reason
+                       in sorted(self._admission_refusals.items())
+                       if reason is not None]
+            reason = "; ".join(reasons) or None
+            if reason != self.admission_refusal:
+                self.admission_refusal = reason
+                self.on_admission(self, reason)
+            return
+
+        item_id = message["item_id"]
+
+        if event == "start_item":
+            self.item_count += 1
+            item = Item(
+                pipeline=self.pipeline,
+                item_id=item_id,
+                item_number=self.item_count,
+                keep_data=True,
+                prepare_data_directory=False
+            )
+            self._items[(worker.index, item_id)] = item
+            self.active_items.add(item)
+            self.on_pipeline_start_item(self, self.pipeline, item)
+            return
+
+        item = self._items.get((worker.index, item_id))
+
+        if item is None:
+            return
+
+        if event == "output":
+            item.log_output(message["data"], full_line=False)
+        elif event == "task_status":
+            task, dummy = self.pipeline.ui_task_list()[message["task_index"]]
+            item.set_task_status(task, message["status"])
+        elif event == "item_name":
+            item["item_name"] = message["name"]
+        elif event == "item_state":
+            if message["state"] == Item.ItemState.completed:
+                item.complete()
+            elif message["state"] == Item.ItemState.failed:
+                item.fail()
+            elif message["state"] == Item.ItemState.canceled:
+                item.cancel()
+        elif event == "finish_item":
+            self._finish_item(worker, item_id)
+
+    def _finish_item(self, worker, item_id):
+        item = self._items.pop((worker.index, item_id))
+        self.active_items.discard(item)
+        self.on_pipeline_finish_item(self, self.pipeline, item)
@@ -0,0 +1,84 @@
+from seesaw.pipeline import Pipeline
+from seesaw.runner import SimpleRunner
+from seesaw.supervisor import Supervisor, WorkerReporter, fork_workers, \
+    split_evenly
+from seesaw.task import PrintItem, SetItemKey, SimpleTask
+from seesaw.test_base import BaseTestCase
+
+
+def make_pipeline():
+    return Pipeline(SetItemKey('item_name', 'blah'), PrintItem())
+
+
+class ProgressTask(SimpleTask):
+    def __init__(self):
+        SimpleTask.__init__(self, 'ProgressTask')
+
+    def process(self, item):
+        for index in range(500):
+            item.log_output('progress %d\n' % index, full_line=False)
+
+
+class SupervisorTest(BaseTestCase):
+    def test_split_evenly(self):
+        self.assertEqual([3, 3, 2], split_evenly(8, 3))
+        self.assertEqual([1, 1, 0], split_evenly(2, 3))
+
+    def test_supervisor_mirrors_items(self):
+        def worker_main(index, event_fd, command_fd):
+            runner = SimpleRunner(make_pipeline(), max_items=index + 1)
+            reporter = WorkerReporter(runner, event_fd, command_fd)
+            runner.start()
+            reporter.close()
+
+        workers = fork_workers(2, worker_main)
+        pipeline = make_pipeline()
+        supervisor = Supervisor(pipeline, workers)
+        started = []
+        finished = []
+
+        def start_callback(runner, pipeline, item):
+            started.append(item)
+
+        def finish_callback(runner, pipeline, item):
+            finished.append((item['item_name'], item.completed,
+                             sorted(item.task_status.values())))
+
+        supervisor.on_pipeline_start_item += start_callback
+        supervisor.on_pipeline_finish_item += finish_callback
+        supervisor.start()
+
+        self.assertEqual(3, len(started))
+        self.assertEqual([('blah', True, ['completed', 'completed'])] * 3,
+                         finished)
+        self.assertEqual([0, 0], [worker.exit_code for worker in workers])
+        self.assertFalse(supervisor.is_active())
+        self.assertIOLoopOK()
+
+    def test_worker_output_is_coalesced(self):
+        def worker_main(index, event_fd, command_fd):
+            runner = SimpleRunner(Pipeline(ProgressTask()), max_items=1)
+            reporter = WorkerReporter(runner, event_fd, command_fd)
+            runner.start()
+            reporter.close()
+
+        workers = fork_workers(1, worker_main)
+        supervisor = Supervisor(Pipeline(ProgressTask()), workers)
+        output = []
+
+        def output_callback(item, data):
+            output.append(data)
+
+        def start_callback(runner, pipeline, item):
+            item.on_output += output_callback
+
+        supervisor.on_pipeline_start_item += start_callback
+        supervisor.start()
+
+        lines = ''.join(output).splitlines()
+        self.assertEqual(['progress %d' % index for index in range(500)],
+                         [line for line in lines
+                          if line.startswith('progress')])
+        self.assertTrue(len(output) < 10)
+        self.assertEqual([0], [worker.exit_code for worker in workers])
+        self.assertIOLoopOK()
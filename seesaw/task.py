@@ -1,13 +1,29 @@
 '''Managing steps in a work unit.'''
+import collections
+import concurrent.futures
 import contextlib
+import datetime
+import functools
+import heapq
+import itertools
 import os
+import sys
+import time
 import traceback
 
-import tornado.stack_context
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
 
 from seesaw.event import Event
 from seesaw.item import Item
 from seesaw.config import realize
+import seesaw.util
 
 
 class Task(object):
@@ -47,25 +63,54 @@ class Task(object):
     def fill_ui_task_list(self, task_list):
         task_list.append((self, self.name))
 
+    def pipeline_started(self, pipeline):
+        '''Called once before the pipeline receives its first item.'''
+        pass
+
     def __str__(self):
         return self.name
 
+    def wrap_item_callback(self, item, callback):
+        '''Returns a function that calls `callback` and fails `item` in this
+        task if it raises an exception.
+
+        Use it for callbacks that are scheduled on the IOLoop for an item,
+        such as timeouts and HTTP or subprocess callbacks. Unwrapped
+        callbacks that a task schedules on the runner's IOLoop while it
+        handles an item also fail the item.
+        '''
+        def wrapper(*args, **kwargs):
+            try:
+                return callback(*args, **kwargs)
+            except Exception as e:
+                self._handle_item_exception(self, item, e)
+
+        return wrapper
+
     # Helper to run "inner" tasks while still calling the correct tasks's item failure
     # handler on exceptions.
     def _enqueue_inner_task_with_except(self, inner_task, item):
-        @contextlib.contextmanager
-        def handle_item_exception(e_type, e_value, tb):
-            item.log_output("Failed %s for %s\n" % (inner_task, item.description()))
-            item.log_output(
-                "".join(traceback.format_exception(e_type, e_value, tb))
-            )
-            item.log_error(self, e_value)
-            inner_task.fail_item(item)
+        try:
+            seesaw.util.call_with_exception_handler(
+                functools.partial(
+                    self._handle_callback_exception, inner_task, item),
+                inner_task.enqueue, item)
+        except Exception as e:
+            self._handle_item_exception(inner_task, item, e)
+
+    def _handle_callback_exception(self, task, item, exc_info):
+        # The callback may run after the task is done with the item.
+        if not item.finished and item.task_status.get(task) not in \
+                (Item.TaskStatus.completed, Item.TaskStatus.failed):
+            self._handle_item_exception(task, item, exc_info[1], exc_info)
+            return True
 
-        with tornado.stack_context.NullContext():
-            with tornado.stack_context.ExceptionStackContext(
-                    handle_item_exception):
-                inner_task.enqueue(item)
+    def _handle_item_exception(self, task, item, error, exc_info=None):
+        item.log_output("Failed %s for %s\n" % (task, item.description()))
+        item.log_output("".join(
+            traceback.format_exception(*(exc_info or sys.exc_info()))))
+        item.log_error(self, error)
+        task.fail_item(item)
 
 
 class SimpleTask(Task):
@@ -105,47 +150,495 @@ class SimpleTask(Task):
         return self.name
 
 
+def _future_set_exc_info(future, exc_info):
+    if hasattr(tornado.concurrent, 'future_set_exc_info'):
+        tornado.concurrent.future_set_exc_info(future, exc_info)
+    else:
+        # Tornado 4
+        future.set_exc_info(exc_info)
+
+
+class CoroutineTask(Task):
+    '''Like :class:`SimpleTask`, but :meth:`process` is a coroutine.
+
+    :meth:`process` may be an ``async def`` method (Python 3.5+) or be
+    decorated with :func:`tornado.gen.coroutine`. The item completes when
+    the coroutine returns and fails if it raises. Only the code before the
+    first ``await`` runs in :attr:`cwd`.
+
+    Example::
+
+        class Wait(CoroutineTask):
+            async def process(self, item):
+                await tornado.gen.sleep(5)
+                item['waited'] = True
+    '''
+    def __init__(self, name):
+        Task.__init__(self, name)
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+        future = tornado.concurrent.Future()
+
+        try:
+            with self.task_cwd():
+                result = self.process(item)
+
+            if result is None:
+                future.set_result(None)
+            else:
+                future = tornado.gen.convert_yielded(result)
+        except Exception:
+            _future_set_exc_info(future, sys.exc_info())
+
+        tornado.ioloop.IOLoop.current().add_future(
+            future, self.wrap_item_callback(
+                item, functools.partial(self._handle_process_result, item)))
+
+    def _handle_process_result(self, item, future):
+        try:
+            future.result()
+        except Exception as e:
+            item.log_output("Failed %s for %s\n" % (self, item.description()))
+            item.log_output("%s\n" % traceback.format_exc())
+            item.log_error(self, e)
+            self.fail_item(item)
+        else:
+            item.log_output("Finished %s for %s\n" % (self,
+                                                      item.description()))
+            self.complete_item(item)
+
+    @tornado.gen.coroutine
+    def process(self, item):
+        pass
+
+
+class _ExecutorItem(MutableMapping):
+    '''Item wrapper given to :meth:`ExecutorTask.process`.
+
+    Mutations and log output are handed to the IOLoop thread, which owns
+    the item and its events. Reads, including iteration, see the writes
+    made through the wrapper. Only the read-only attributes of the item
+    are available.
+    '''
+    READ_ONLY_ATTRIBUTES = frozenset([
+        'item_id', 'item_number', 'item_state', 'pipeline', 'start_time',
+        'end_time', 'canceled', 'completed', 'failed', 'finished',
+    ])
+    _deleted = object()
+
+    def __init__(self, item, io_loop):
+        self._item = item
+        self._io_loop = io_loop
+        self._written = {}
+
+    def __getitem__(self, key):
+        value = self._written.get(key, self._item.get(key, self._deleted))
+        if value is self._deleted:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._written[key] = value
+        self._io_loop.add_callback(self._item.__setitem__, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._written[key] = self._deleted
+        self._io_loop.add_callback(self._item.pop, key, None)
+
+    def __iter__(self):
+        for key in list(self._item.properties):
+            if key not in self._written:
+                yield key
+
+        for key, value in list(self._written.items()):
+            if value is not self._deleted:
+                yield key
+
+    def __len__(self):
+        return sum(1 for dummy in self)
+
+    def description(self):
+        return "Item %s" % self.get("item_name", "")
+
+    def log_output(self, data, full_line=True):
+        self._io_loop.add_callback(self._item.log_output, data, full_line)
+
+    def __getattr__(self, name):
+        if name not in self.READ_ONLY_ATTRIBUTES:
+            raise AttributeError(
+                "%r is not available in ExecutorTask.process" % name)
+        return getattr(self._item, name)
+
+
+class ExecutorTask(Task):
+    '''Like :class:`SimpleTask`, but :meth:`process` runs on an executor
+    from :mod:`concurrent.futures` instead of the IOLoop.
+
+    Use it for blocking or CPU-heavy work, such as hashing or compressing
+    files, so other items and the web interface are not held up.
+    :meth:`process` receives a wrapper of the item that is safe to use
+    from the worker thread. It does not change into :attr:`cwd`, because
+    the working directory is shared by all threads; use absolute paths.
+
+    For CPU-heavy work, :meth:`process` can hand plain data to a
+    :class:`concurrent.futures.ProcessPoolExecutor` and wait for the
+    result.
+    '''
+    def __init__(self, name, executor):
+        Task.__init__(self, name)
+        self.executor = executor
+
+    def enqueue(self, item):
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+        io_loop = tornado.ioloop.IOLoop.current()
+        future = self.executor.submit(
+            self._run_process, _ExecutorItem(item, io_loop))
+        io_loop.add_future(
+            future, self.wrap_item_callback(
+                item, functools.partial(self._handle_process_result, item)))
+
+    def _run_process(self, item):
+        try:
+            self.process(item)
+        except Exception as e:
+            return e, traceback.format_exc()
+        else:
+            return None
+
+    def _handle_process_result(self, item, future):
+        error = future.result()
+
+        if error:
+            e, formatted_traceback = error
+            item.log_output("Failed %s for %s\n" % (self, item.description()))
+            item.log_output("%s\n" % formatted_traceback)
+            item.log_error(self, e)
+            self.fail_item(item)
+        else:
+            item.log_output("Finished %s for %s\n" % (self,
+                                                      item.description()))
+            self.complete_item(item)
+
+    def process(self, item):
+        pass
+
+
+class ThreadedTask(ExecutorTask):
+    '''An :class:`ExecutorTask` with its own pool of `max_workers`
+    threads.'''
+    def __init__(self, name, max_workers=2):
+        ExecutorTask.__init__(
+            self, name, concurrent.futures.ThreadPoolExecutor(max_workers))
+
+
 class LimitConcurrent(Task):
     '''Restricts the number of tasks of the same type that can be run at once.
+
+    Waiting items are started in arrival order unless `priority` is given.
+    `priority` is a function that returns a sort key for an item; items
+    with the lowest key are started first, for example
+    :func:`oldest_item_first`.
+
+    `concurrency` is realized again whenever an item finishes. While all
+    slots are taken, arriving items wait without realizing it.
     '''
-    def __init__(self, concurrency, inner_task):
+    def __init__(self, concurrency, inner_task, priority=None):
         Task.__init__(self, "LimitConcurrent")
         self.concurrency = concurrency
         self.inner_task = inner_task
+        self.priority = priority
         self.inner_task.on_complete_item += self._inner_task_complete_item
         self.inner_task.on_fail_item += self._inner_task_fail_item
-        self._queue = []
+        if priority:
+            self._queue = []
+        else:
+            self._queue = collections.deque()
+        self._counter = itertools.count()
         self._working = 0
+        self._concurrency = 0
+        self._max_queue_depth = 0
+        self._dequeued = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
 
     def enqueue(self, item):
-        if self._working < realize(self.concurrency, item):
-            self._working += 1
-            self._enqueue_inner_task_with_except(self.inner_task, item)
+        if self.priority:
+            heapq.heappush(self._queue, (self.priority(item),
+                                         next(self._counter),
+                                         time.time(), item))
         else:
-            self._queue.append(item)
+            self._queue.append((time.time(), item))
+
+        # A full task is filled again when one of its items finishes.
+        if not self._working or self._working < self._concurrency:
+            self._fill(item)
+
+        self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+
+    def _pop(self):
+        if self.priority:
+            dummy, dummy, enqueue_time, item = heapq.heappop(self._queue)
+        else:
+            enqueue_time, item = self._queue.popleft()
+
+        wait = time.time() - enqueue_time
+        self._dequeued += 1
+        self._total_wait += wait
+        self._max_wait = max(self._max_wait, wait)
+        return item
+
+    def _fill(self, item):
+        if not self._queue:
+            return
+
+        self._concurrency = realize(self.concurrency, item)
+        while self._queue and self._working < self._concurrency:
+            self._working += 1
+            self._enqueue_inner_task_with_except(self.inner_task, self._pop())
 
     def _inner_task_complete_item(self, task, item):
         self._working -= 1
-        if len(self._queue) > 0:
-            self._working += 1
-            self._enqueue_inner_task_with_except(self.inner_task, self._queue.pop(0))
+        self._fill(item)
         self.complete_item(item)
 
     def _inner_task_fail_item(self, task, item):
         self._working -= 1
-        if len(self._queue) > 0:
-            self._working += 1
-            self._enqueue_inner_task_with_except(self.inner_task, self._queue.pop(0))
+        self._fill(item)
         self.fail_item(item)
 
+    def stats(self):
+        '''Return a dict of queue depth and wait time statistics.'''
+        return {
+            "working": self._working,
+            "queue_depth": len(self._queue),
+            "max_queue_depth": self._max_queue_depth,
+            "dequeued": self._dequeued,
+            "mean_wait": self._total_wait / self._dequeued
+            if self._dequeued else 0.0,
+            "max_wait": self._max_wait,
+        }
+
     def fill_ui_task_list(self, task_list):
         self.inner_task.fill_ui_task_list(task_list)
 
+    def pipeline_started(self, pipeline):
+        self.inner_task.pipeline_started(pipeline)
+
     def __str__(self):
         return "LimitConcurrent({0} x {1} )".format(
             self.concurrency, self.inner_task)
 
 
+class RateLimit(Task):
+    '''Limits how many items per minute are passed to a task.
+
+    Uses a token bucket that holds up to `burst` items. `rate` and `burst`
+    may be :class:`seesaw.config.ConfigValue` instances.
+    '''
+    def __init__(self, rate, inner_task, burst=1):
+        Task.__init__(self, "RateLimit")
+        self.rate = rate
+        self.burst = burst
+        self.inner_task = inner_task
+        self.inner_task.on_complete_item += self._inner_task_complete_item
+        self.inner_task.on_fail_item += self._inner_task_fail_item
+        self._queue = collections.deque()
+        self._tokens = None
+        self._last_refill = None
+        self._timeout = None
+
+    def enqueue(self, item):
+        self._queue.append(item)
+        self._drain()
+
+    def _refill(self, item):
+        now = time.time()
+        burst = realize(self.burst, item)
+
+        if self._tokens is None:
+            self._tokens = burst
+        else:
+            elapsed = now - self._last_refill
+            self._tokens = min(
+                burst, self._tokens + elapsed * realize(self.rate, item) / 60.0)
+
+        self._last_refill = now
+
+    def _handle_timeout(self):
+        self._timeout = None
+        self._drain()
+
+    def _drain(self):
+        self._refill(self._queue[0] if self._queue else None)
+
+        while self._queue and self._tokens >= 1:
+            self._tokens -= 1
+            self._enqueue_inner_task_with_except(
+                self.inner_task, self._queue.popleft())
+
+        if self._queue and not self._timeout:
+            rate = realize(self.rate, self._queue[0])
+            delay = (1 - self._tokens) * 60.0 / rate if rate > 0 else 60
+            self._timeout = tornado.ioloop.IOLoop.current().add_timeout(
+                datetime.timedelta(seconds=delay), self._handle_timeout)
+
+    def _inner_task_complete_item(self, task, item):
+        self.complete_item(item)
+
+    def _inner_task_fail_item(self, task, item):
+        self.fail_item(item)
+
+    def fill_ui_task_list(self, task_list):
+        self.inner_task.fill_ui_task_list(task_list)
+
+    def pipeline_started(self, pipeline):
+        self.inner_task.pipeline_started(pipeline)
+
+    def __str__(self):
+        return "RateLimit({0}/min x {1})".format(self.rate, self.inner_task)
+
+
+class ResourcePool(object):
+    '''A named budget of units shared by :class:`LimitResources` tasks.
+
+    For example, a pool for disk I/O can be shared by a download and an
+    upload task so the two stages together do not oversubscribe the disk.
+    `capacity` may be a :class:`seesaw.config.ConfigValue`.
+    '''
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = capacity
+        self.in_use = 0
+        self._waiting = []
+
+    def available(self):
+        return realize(self.capacity, None) - self.in_use
+
+    def stats(self):
+        return {
+            "capacity": realize(self.capacity, None),
+            "in_use": self.in_use,
+            "waiting": len(self._waiting),
+        }
+
+    def __str__(self):
+        return "ResourcePool({0}: {1})".format(self.name, self.capacity)
+
+
+class _ResourceRequest(object):
+    '''Units wanted from one or more pools, acquired all at once.'''
+    def __init__(self, units, callback):
+        self.units = units
+        self.callback = callback
+
+    def try_acquire(self):
+        for pool, units in self.units.items():
+            if pool.available() < units:
+                return False
+
+        for pool, units in self.units.items():
+            pool.in_use += units
+
+        return True
+
+    def wait(self):
+        for pool in self.units:
+            pool._waiting.append(self)
+
+    def stop_waiting(self):
+        for pool in self.units:
+            pool._waiting.remove(self)
+
+
+def _release_resources(units):
+    for pool, amount in units.items():
+        pool.in_use -= amount
+
+    granted = []
+
+    # Waiters are served first-fit so a large request cannot block smaller
+    # ones that fit in the remaining capacity.
+    for pool in units:
+        for request in list(pool._waiting):
+            if request.try_acquire():
+                request.stop_waiting()
+                granted.append(request)
+
+    for request in granted:
+        request.callback()
+
+
+class LimitResources(Task):
+    '''Runs a task only when it can take units from one or more
+    :class:`ResourcePool`.
+
+    `requirements` is a dict that maps each pool to the number of units one
+    item needs. A weight larger than the capacity of the pool is reduced
+    to the capacity. Example::
+
+        disk_io = ResourcePool("disk-io", 4)
+
+        LimitResources({disk_io: 1}, WgetDownload(...))
+        LimitResources({disk_io: 2}, RsyncUpload(...))
+    '''
+    def __init__(self, requirements, inner_task):
+        Task.__init__(self, "LimitResources")
+        self.requirements = requirements
+        self.inner_task = inner_task
+        self.inner_task.on_complete_item += self._inner_task_complete_item
+        self.inner_task.on_fail_item += self._inner_task_fail_item
+        self._held = {}
+
+    def enqueue(self, item):
+        units = {}
+
+        for pool, weight in self.requirements.items():
+            units[pool] = max(0, min(realize(weight, item),
+                                     realize(pool.capacity, item)))
+
+        def start():
+            self._held[item] = units
+            self._enqueue_inner_task_with_except(self.inner_task, item)
+
+        request = _ResourceRequest(units, start)
+
+        if request.try_acquire():
+            start()
+        else:
+            request.wait()
+
+    def _inner_task_complete_item(self, task, item):
+        _release_resources(self._held.pop(item))
+        self.complete_item(item)
+
+    def _inner_task_fail_item(self, task, item):
+        _release_resources(self._held.pop(item))
+        self.fail_item(item)
+
+    def fill_ui_task_list(self, task_list):
+        self.inner_task.fill_ui_task_list(task_list)
+
+    def pipeline_started(self, pipeline):
+        self.inner_task.pipeline_started(pipeline)
+
+    def __str__(self):
+        return "LimitResources({0} x {1})".format(
+            ", ".join("{0}: {1}".format(pool.name, weight)
+                      for pool, weight in self.requirements.items()),
+            self.inner_task)
+
+
+def oldest_item_first(item):
+    ''':class:`LimitConcurrent` priority that favours the items that were
+    claimed from the tracker first, and so are closest to timing out.'''
+    return item.start_time
+
+
 class ConditionalTask(Task):
     '''Runs a task optionally.'''
     def __init__(self, condition_function, inner_task):
@@ -171,6 +664,9 @@ class ConditionalTask(Task):
     def fill_ui_task_list(self, task_list):
         self.inner_task.fill_ui_task_list(task_list)
 
+    def pipeline_started(self, pipeline):
+        self.inner_task.pipeline_started(pipeline)
+
     def __str__(self):
         return "Conditional(" + str(self.inner_task) + ")"
 
@@ -0,0 +1,421 @@
+import datetime
+import logging
+import sys
+import threading
+import time
+import unittest
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from seesaw.pipeline import Pipeline
+from seesaw.runner import SimpleRunner
+from seesaw.task import Task, LimitConcurrent, LimitResources, \
+    RateLimit, ResourcePool, ThreadedTask, SetItemKey, CoroutineTask, \
+    oldest_item_first
+from seesaw.config import NumberConfigValue
+from seesaw.test_base import BaseTestCase
+
+
+class MockItem(object):
+    def __init__(self, start_time):
+        self.start_time = start_time
+
+    def set_task_status(self, task, status):
+        pass
+
+    def log_output(self, data, full_line=True):
+        pass
+
+    def description(self):
+        return 'MockItem(%s)' % self.start_time
+
+
+class HoldingTask(Task):
+    '''Keeps items until they are released by the test.'''
+    def __init__(self):
+        Task.__init__(self, 'HoldingTask')
+        self.items = []
+
+    def enqueue(self, item):
+        self.start_item(item)
+        self.items.append(item)
+
+    def release(self, item):
+        self.complete_item(item)
+
+
+class TaskTest(BaseTestCase):
+    def test_limit_concurrent_fifo(self):
+        inner_task = HoldingTask()
+        task = LimitConcurrent(2, inner_task)
+        items = [MockItem(start_time) for start_time in range(5)]
+
+        for item in items:
+            task.enqueue(item)
+
+        self.assertEqual(items[:2], inner_task.items)
+        self.assertEqual(3, task.stats()['queue_depth'])
+        self.assertEqual(2, task.stats()['working'])
+
+        inner_task.release(items[0])
+        inner_task.release(items[1])
+        self.assertEqual(items[:4], inner_task.items)
+
+        stats = task.stats()
+        self.assertEqual(1, stats['queue_depth'])
+        self.assertEqual(3, stats['max_queue_depth'])
+        self.assertEqual(4, stats['dequeued'])
+        self.assertTrue(stats['max_wait'] >= stats['mean_wait'] >= 0)
+
+    def test_limit_concurrent_realizes_when_slot_free(self):
+        class CountingConcurrency(object):
+            realized = 0
+
+            def realize(self, item):
+                self.realized += 1
+                return 1
+
+        concurrency = CountingConcurrency()
+        inner_task = HoldingTask()
+        task = LimitConcurrent(concurrency, inner_task)
+        items = [MockItem(start_time) for start_time in range(10)]
+
+        for item in items:
+            task.enqueue(item)
+
+        self.assertEqual(items[:1], inner_task.items)
+        self.assertEqual(1, concurrency.realized)
+
+        inner_task.release(items[0])
+        self.assertEqual(items[:2], inner_task.items)
+        self.assertEqual(2, concurrency.realized)
+
+    def test_limit_concurrent_priority(self):
+        inner_task = HoldingTask()
+        task = LimitConcurrent(1, inner_task, priority=oldest_item_first)
+        items = [MockItem(start_time) for start_time in (5, 3, 4, 1)]
+        completed = []
+
+        def complete_callback(task, item):
+            completed.append(item)
+
+        task.on_complete_item += complete_callback
+
+        for item in items:
+            task.enqueue(item)
+
+        while len(inner_task.items) > len(completed):
+            inner_task.release(inner_task.items[len(completed)])
+
+        self.assertEqual([5, 1, 3, 4],
+                         [item.start_time for item in inner_task.items])
+        self.assertEqual(inner_task.items, completed)
+        self.assertEqual(0, task.stats()['queue_depth'])
+
+    def test_limit_resources(self):
+        disk_io = ResourcePool('disk-io', 3)
+        download_task = HoldingTask()
+        upload_task = HoldingTask()
+        download = LimitResources({disk_io: 1}, download_task)
+        upload = LimitResources({disk_io: 2}, upload_task)
+        oversized = LimitResources({disk_io: 10}, HoldingTask())
+
+        uploads = [MockItem(start_time) for start_time in range(2)]
+        downloads = [MockItem(start_time) for start_time in range(2, 4)]
+
+        upload.enqueue(uploads[0])
+        upload.enqueue(uploads[1])
+        download.enqueue(downloads[0])
+        download.enqueue(downloads[1])
+
+        self.assertEqual(uploads[:1], upload_task.items)
+        self.assertEqual(downloads[:1], download_task.items)
+        self.assertEqual(3, disk_io.stats()['in_use'])
+        self.assertEqual(2, disk_io.stats()['waiting'])
+
+        # The freed unit goes to the download that fits.
+        download_task.release(downloads[0])
+        self.assertEqual(downloads, download_task.items)
+        self.assertEqual(uploads[:1], upload_task.items)
+
+        upload_task.release(uploads[0])
+        self.assertEqual(uploads, upload_task.items)
+        self.assertEqual(0, disk_io.stats()['waiting'])
+
+        upload_task.release(uploads[1])
+        download_task.release(downloads[1])
+        self.assertEqual(0, disk_io.stats()['in_use'])
+
+        oversized.enqueue(MockItem(4))
+        self.assertEqual(3, disk_io.stats()['in_use'])
+
+    def test_rate_limit(self):
+        inner_task = HoldingTask()
+        rate = NumberConfigValue(name='rate', title='Rate', description='',
+                                 default=600)
+        task = RateLimit(rate, inner_task, burst=2)
+        start_times = []
+
+        def start_callback(task, item):
+            start_times.append(time.time())
+            if len(start_times) == 4:
+                IOLoop.current().stop()
+
+        inner_task.on_start_item += start_callback
+
+        for start_time in range(4):
+            task.enqueue(MockItem(start_time))
+
+        # The burst is passed on straight away.
+        self.assertEqual(2, len(inner_task.items))
+
+        timeout = IOLoop.current().add_timeout(
+            datetime.timedelta(seconds=5), IOLoop.current().stop)
+        IOLoop.current().start()
+        IOLoop.current().remove_timeout(timeout)
+
+        self.assertEqual(4, len(inner_task.items))
+        # 600 items per minute is one every 0.1 seconds.
+        self.assertTrue(start_times[3] - start_times[0] >= 0.15)
+
+    def test_threaded_task(self):
+        main_thread = threading.current_thread()
+
+        class HashTask(ThreadedTask):
+            def __init__(self):
+                ThreadedTask.__init__(self, 'HashTask', max_workers=2)
+
+            def process(self, item):
+                assert threading.current_thread() is not main_thread
+                item['hash'] = item['item_name'] * 2
+                item.log_output('hashed\n')
+                if item['item_name'] == 'bad':
+                    raise Exception('Bad item.')
+                item['hash_length'] = len(item['hash'])
+
+        pipeline = Pipeline(SetItemKey('item_name', 'good'), HashTask())
+        results = []
+
+        def complete_callback(pipeline, item):
+            assert threading.current_thread() is main_thread
+            results.append((item['hash'], item['hash_length']))
+
+        pipeline.on_complete_item += complete_callback
+
+        runner = SimpleRunner(pipeline, concurrent_items=2, max_items=3)
+        runner.start()
+
+        self.assertEqual([('goodgood', 8)] * 3, results)
+        self.assertIOLoopOK()
+
+        pipeline = Pipeline(SetItemKey('item_name', 'bad'), HashTask())
+        errors = []
+
+        def fail_callback(pipeline, item):
+            errors.append(item['hash'])
+
+        pipeline.on_fail_item += fail_callback
+
+        runner = SimpleRunner(pipeline, max_items=1)
+        runner.start()
+
+        self.assertEqual(['badbad'], errors)
+        self.assertIOLoopOK()
+
+    def test_threaded_task_item_wrapper(self):
+        seen = []
+
+        class WrapperTask(ThreadedTask):
+            def __init__(self):
+                ThreadedTask.__init__(self, 'WrapperTask', max_workers=1)
+
+            def process(self, item):
+                item.update(a=1, b=2)
+                del item['item_name']
+                item.setdefault('c', 3)
+                seen.append(item.pop('a'))
+                seen.append(sorted(item))
+                seen.append(len(item))
+                seen.append(item.item_number)
+
+                for name in ('fail', 'set_task_status', 'properties',
+                             'task_status'):
+                    try:
+                        getattr(item, name)
+                    except AttributeError:
+                        seen.append(name)
+
+        pipeline = Pipeline(SetItemKey('item_name', 'blah'), WrapperTask())
+        results = []
+
+        def complete_callback(pipeline, item):
+            results.append(dict(item.properties))
+
+        pipeline.on_complete_item += complete_callback
+
+        runner = SimpleRunner(pipeline, max_items=1)
+        runner.start()
+
+        self.assertEqual(
+            [1, ['b', 'c', 'data_dir'], 3, 1,
+             'fail', 'set_task_status', 'properties', 'task_status'],
+            seen)
+        self.assertEqual(1, len(results))
+        self.assertEqual(['b', 'c', 'data_dir'], sorted(results[0]))
+        self.assertEqual((2, 3), (results[0]['b'], results[0]['c']))
+        self.assertIOLoopOK()
+
+    def test_coroutine_task(self):
+        class SleepTask(CoroutineTask):
+            def __init__(self):
+                CoroutineTask.__init__(self, 'SleepTask')
+
+            @gen.coroutine
+            def process(self, item):
+                item['before'] = True
+                yield gen.sleep(0.01)
+                if item['item_name'] == 'bad':
+                    raise Exception('Bad item.')
+                item['after'] = True
+
+        for item_name, completed in (('good', True), ('bad', False)):
+            pipeline = Pipeline(SetItemKey('item_name', item_name),
+                                SleepTask())
+            results = []
+
+            def finish_callback(pipeline, item):
+                results.append((item.completed, 'after' in item))
+
+            pipeline.on_finish_item += finish_callback
+
+            runner = SimpleRunner(pipeline, concurrent_items=2, max_items=2)
+            runner.start()
+
+            self.assertEqual([(completed, completed)] * 2, results)
+            self.assertIOLoopOK()
+
+    def run_coroutine_task(self, task_class, item_name='good'):
+        pipeline = Pipeline(SetItemKey('item_name', item_name), task_class())
+        results = []
+
+        def finish_callback(pipeline, item):
+            results.append(item.completed)
+
+        pipeline.on_finish_item += finish_callback
+
+        runner = SimpleRunner(pipeline, max_items=1)
+        runner.start()
+        self.assertIOLoopOK()
+        return results
+
+    def test_coroutine_task_fails_synchronously(self):
+        class RaisingTask(CoroutineTask):
+            def __init__(self):
+                CoroutineTask.__init__(self, 'RaisingTask')
+
+            def process(self, item):
+                raise Exception('Bad item.')
+
+        class NotACoroutineTask(CoroutineTask):
+            def __init__(self):
+                CoroutineTask.__init__(self, 'NotACoroutineTask')
+
+            def process(self, item):
+                return 'not a coroutine'
+
+        self.assertEqual([False], self.run_coroutine_task(RaisingTask))
+        self.assertEqual([False], self.run_coroutine_task(NotACoroutineTask))
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'needs async def')
+    def test_native_coroutine_task(self):
+        namespace = {'CoroutineTask': CoroutineTask, 'gen': gen}
+        exec('''
+class NativeTask(CoroutineTask):
+    def __init__(self):
+        CoroutineTask.__init__(self, 'NativeTask')
+
+    async def process(self, item):
+        await gen.sleep(0.01)
+        if item['item_name'] == 'bad':
+            raise Exception('Bad item.')
+''', namespace)
+
+        self.assertEqual(
+            [True], self.run_coroutine_task(namespace['NativeTask']))
+        self.assertEqual(
+            [False], self.run_coroutine_task(namespace['NativeTask'], 'bad'))
+
+    def test_wrap_item_callback(self):
+        class BrokenCallbackTask(Task):
+            def __init__(self):
+                Task.__init__(self, 'BrokenCallbackTask')
+
+            def enqueue(self, item):
+                self.start_item(item)
+                IOLoop.current().add_callback(
+                    self.wrap_item_callback(item, self.callback), item)
+
+            def callback(self, item):
+                raise Exception('Broken callback.')
+
+        pipeline = Pipeline(LimitConcurrent(1, BrokenCallbackTask()))
+        failed = []
+
+        def fail_callback(pipeline, item):
+            failed.append(item)
+
+        pipeline.on_fail_item += fail_callback
+
+        runner = SimpleRunner(pipeline, max_items=2)
+        runner.start()
+
+        self.assertEqual(2, len(failed))
+        self.assertIOLoopOK()
+
+    def test_unwrapped_callback_fails_item(self):
+        def broken_callback():
+            raise Exception('Broken callback.')
+
+        class LateCallbackTask(Task):
+            def enqueue(self, item):
+                self.start_item(item)
+                self.complete_item(item)
+                # The item has moved on; it is not failed.
+                IOLoop.current().add_callback(broken_callback)
+
+        class BrokenCallbackTask(Task):
+            def __init__(self, name, item_number):
+                Task.__init__(self, name)
+                self.item_number = item_number
+
+            def enqueue(self, item):
+                self.start_item(item)
+
+                if item.item_number == self.item_number:
+                    IOLoop.current().add_callback(broken_callback)
+                else:
+                    self.complete_item(item)
+
+        tasks = [LateCallbackTask('LateCallbackTask'),
+                 BrokenCallbackTask('Direct', 1),
+                 BrokenCallbackTask('Limited', 2)]
+        pipeline = Pipeline(tasks[0], tasks[1], LimitConcurrent(1, tasks[2]))
+        failed = []
+
+        def fail_callback(pipeline, item):
+            failed.append([item.task_status.get(task) for task in tasks])
+
+        pipeline.on_fail_item += fail_callback
+
+        # Failing the items must not depend on the IOLoop's logging.
+        logger = logging.getLogger('tornado.application')
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.CRITICAL)
+
+        runner = SimpleRunner(pipeline, concurrent_items=2, max_items=2)
+        runner.start()
+
+        self.assertEqual([['completed', 'failed', None],
+                          ['completed', 'completed', 'failed']], failed)
+        self.assertIOLoopOK()
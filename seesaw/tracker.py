@@ -3,118 +3,370 @@
 A Tracker refers to the Universal Tracker
 (https://github.com/ArchiveTeam/universal-tracker).
 '''
+import collections
+import errno
 import json
 import functools
 import datetime
+import logging
+import os
 import os.path
+import random
 import re
+import tempfile
 
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPResponse
 from tornado.ioloop import IOLoop
 
 import seesaw
 from seesaw.config import realize
+from seesaw.event import Event
 from seesaw.task import Task, SimpleTask
 from seesaw.externalprocess import RsyncUpload, CurlUpload
+from seesaw.upload import HttpUpload
 import seesaw.six
+import seesaw.util
+
+
+logger = logging.getLogger(__name__)
+
+
+class BackoffPolicy(object):
+    '''Decides when requests to a Tracker are sent and retried.
+
+    :class:`TrackerRequest` tasks talking to the same Tracker share one
+    policy (see :func:`shared_backoff_policy`), so a failure seen by one
+    of them holds back the requests of all of them.
+    '''
+    def send_delay(self):
+        '''Returns the seconds a new request has to wait before sending.'''
+        return 0
+
+    def retry_delay(self, retries=1):
+        '''Returns the seconds to wait before retrying a request that was
+        retried `retries` times in a row, counting this retry.'''
+        raise NotImplementedError()
+
+    def request_started(self):
+        '''Called when a request is sent. The return value is passed
+        to :meth:`request_finished`.'''
+        return None
+
+    def request_finished(self, token, success):
+        '''Called with the outcome of a request.'''
+        raise NotImplementedError()
+
+
+class LinearBackoff(BackoffPolicy):
+    '''Adds `increment` seconds to the delay for each failure.
+
+    This was the behaviour of each :class:`TrackerRequest` before the
+    delay was shared.
+    '''
+    def __init__(self, initial_delay=60, increment=10, max_delay=300):
+        self.initial_delay = initial_delay
+        self.increment = increment
+        self.max_delay = max_delay
+        self.delay = initial_delay
+
+    def retry_delay(self, retries=1):
+        return min(self.max_delay,
+                   self.delay + self.increment * (retries - 1))
+
+    def request_finished(self, token, success):
+        if success:
+            self.delay = self.initial_delay
+        else:
+            self.delay = min(self.max_delay, self.delay + self.increment)
+
+
+class JitteredBackoff(BackoffPolicy):
+    '''Exponential backoff with full jitter.
+
+    Each failure doubles the range, starting at `base_delay` and capped at
+    `max_delay`, from which retry delays are drawn at random so that
+    items do not retry in lockstep. So does each retry of a request that
+    did not fail in this sense, such as one that got no item. Failures of requests that were sent
+    before the previous failure was counted do not escalate the delay
+    again; a wave of concurrent requests failing together counts once.
+
+    While the Tracker is failing, only one request is in flight at a
+    time. After the first success, this continues for `probe_count` more
+    successful requests before the full request rate is allowed again.
+    '''
+    def __init__(self, base_delay=60, max_delay=300, min_delay=1,
+                 probe_count=3):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_delay = min_delay
+        self.probe_count = probe_count
+        self.failures = 0
+        self.probes_left = 0
+        self.in_flight = 0
+        self._generation = 0
+
+    @property
+    def throttled(self):
+        return self.failures > 0 or self.probes_left > 0
+
+    def send_delay(self):
+        if self.throttled and self.in_flight > 0:
+            return self.retry_delay()
+        return 0
+
+    def retry_delay(self, retries=1):
+        doublings = max(self.failures, retries) - 1
+        ceiling = min(self.max_delay,
+                      self.base_delay * 2 ** max(0, doublings))
+        return random.uniform(self.min_delay, max(self.min_delay, ceiling))
+
+    def request_started(self):
+        self.in_flight += 1
+        return self._generation
+
+    def request_finished(self, token, success):
+        self.in_flight -= 1
+
+        if success:
+            if self.failures:
+                self.failures = 0
+                self.probes_left = self.probe_count
+                self._generation += 1
+            elif self.probes_left:
+                self.probes_left -= 1
+        elif token == self._generation:
+            self.failures += 1
+            self._generation += 1
+
+
+_shared_backoff_policies = {}
+
+
+def shared_backoff_policy(tracker_url):
+    '''Returns the :class:`BackoffPolicy` for requests to a Tracker.'''
+    if tracker_url not in _shared_backoff_policies:
+        _shared_backoff_policies[tracker_url] = JitteredBackoff()
+    return _shared_backoff_policies[tracker_url]
 
 
 class TrackerRequest(Task):
-    '''Represents a request to a Tracker.'''
+    '''Represents a request to a Tracker.
+
+    Unless a `backoff_policy` is given, sending and retrying requests
+    follows the policy shared by all requests to `tracker_url`.
+
+    Only responses that mean the Tracker is rate limiting or overloaded
+    (see :meth:`is_overload_status`) count as failures for the policy.
+    Others, such as 404 when no items are available, are retried without
+    holding back other requests, but the delay grows with each retry
+    until the task completes an item.
 
+    The class level :attr:`on_tracker_response` event is fired for the
+    response of every Tracker request with the task and the status code.
+    '''
     DEFAULT_RETRY_DELAY = 60
+    OVERLOAD_STATUS_CODES = (420, 429, 599)
+
+    on_tracker_response = Event()
 
     def __init__(self, name, tracker_url, tracker_command,
-                 may_be_canceled=False):
+                 may_be_canceled=False, backoff_policy=None):
         Task.__init__(self, name)
         self.http_client = AsyncHTTPClient()
         self.tracker_url = tracker_url
         self.tracker_command = tracker_command
-        self.retry_delay = self.DEFAULT_RETRY_DELAY
+        self.backoff_policy = (backoff_policy or
+                               shared_backoff_policy(tracker_url))
         self._set_may_be_canceled = may_be_canceled
+        self._retries = 0
 
     def enqueue(self, item):
         self.start_item(item)
         item.log_output("Starting %s for %s\n" % (self, item.description()))
         self.send_request(item)
 
+    def complete_item(self, item):
+        self._retries = 0
+        Task.complete_item(self, item)
+
     def send_request(self, item):
         if item.canceled:
             return
 
+        if self.defer_request(self.wrap_item_callback(
+                item, functools.partial(self.send_request, item))):
+            return
+
         if self._set_may_be_canceled:
             item.may_be_canceled = False
-        self.http_client.fetch(
-            HTTPRequest(
-                "%s/%s" % (self.tracker_url, self.tracker_command),
-                method="POST",
-                headers={"Content-Type": "application/json"},
-                user_agent=("ArchiveTeam Warrior/%s %s %s" % (
-                    seesaw.__version__, seesaw.runner_type,
-                    seesaw.warrior_build)).strip(),
-                body=json.dumps(self.data(item))
-                ),
-            functools.partial(self.handle_response, item))
+        self.fetch_tracker(
+            self.tracker_http_request(self.tracker_command, self.data(item)),
+            self.wrap_item_callback(
+                item, functools.partial(self.handle_response, item)))
+
+    def tracker_http_request(self, tracker_command, data, tracker_url=None):
+        return HTTPRequest(
+            "%s/%s" % (tracker_url or self.tracker_url, tracker_command),
+            method="POST",
+            headers={"Content-Type": "application/json"},
+            user_agent=("ArchiveTeam Warrior/%s %s %s" % (
+                seesaw.__version__, seesaw.runner_type,
+                seesaw.warrior_build)).strip(),
+            body=json.dumps(data)
+            )
+
+    def defer_request(self, callback):
+        '''Schedules `callback` for later if the backoff policy is holding
+        back requests. Returns whether it did.'''
+        delay = self.backoff_policy.send_delay()
+        if delay > 0:
+            IOLoop.current().add_timeout(
+                datetime.timedelta(seconds=delay), callback)
+            return True
+        return False
+
+    def fetch_tracker(self, request, callback):
+        '''Sends a request and reports its outcome to the backoff policy
+        before calling `callback` with the response.'''
+        token = self.backoff_policy.request_started()
+        future = self.http_client.fetch(request, raise_error=False)
+        IOLoop.current().add_future(
+            future,
+            functools.partial(self._handle_tracker_response, token, callback,
+                              request))
+
+    def _handle_tracker_response(self, token, callback, request, future):
+        try:
+            response = future.result()
+        except Exception as error:
+            # Connection errors are raised even with raise_error=False on
+            # newer versions of Tornado.
+            response = HTTPResponse(request, 599, error=error)
+
+        self.backoff_policy.request_finished(
+            token, not self.is_overload_status(response.code))
+        TrackerRequest.on_tracker_response(self, response.code)
+        callback(response)
+
+    @classmethod
+    def is_overload_status(cls, code):
+        '''Returns whether a response status code means the Tracker is
+        rate limiting or overloaded.'''
+        return code in cls.OVERLOAD_STATUS_CODES or 500 <= code < 600
+
+    @property
+    def retry_delay(self):
+        '''The seconds to wait before a retry, from the backoff policy.
+
+        Setting it gives the task its own :class:`LinearBackoff` starting
+        at that delay, like the delay of each task used to be.
+        '''
+        return self.backoff_policy.retry_delay()
+
+    @retry_delay.setter
+    def retry_delay(self, delay):
+        self.backoff_policy = LinearBackoff(initial_delay=delay)
+
+    def next_retry_delay(self):
+        '''Counts a retry and returns the seconds to wait before it.'''
+        self._retries += 1
+        return self.backoff_policy.retry_delay(self._retries)
+
+    def increment_retry_delay(self, max_delay=300):
+        '''Counts a failure in the backoff policy. `max_delay` is ignored;
+        the policy has its own.'''
+        self.backoff_policy.request_finished(
+            self.backoff_policy.request_started(), False)
+
+    def reset_retry_delay(self):
+        '''Counts a success in the backoff policy.'''
+        self._retries = 0
+        self.backoff_policy.request_finished(
+            self.backoff_policy.request_started(), True)
 
     def data(self, item):
         return {}
 
     def handle_response(self, item, response):
         if response.code == 200:
-            self.reset_retry_delay()
-            if isinstance(response.body, seesaw.six.binary_type):
-                self.process_body(response.body.decode('utf-8'), item)
-            else:
-                self.process_body(response.body, item)
+            self.process_body(response_text(response), item)
         else:
-            if response.code == 420 or response.code == 429:
-                r = ("Tracker rate limiting is active. "
-                     "We don't want to overload the site we're archiving, "
-                     "so we've limited the number of downloads per minute. ")
-            elif response.code == 404:
-                r = ("No item received. There aren't any items available "
-                     "for this project at the moment. Try again later. ")
-            elif response.code == 455:
-                r = ("Project code is out of date and needs to be upgraded. "
-                     "To remedy this problem immediately, you may reboot "
-                     "your warrior. ")
-            elif response.code == 599:
-                r = ("No HTTP response received from tracker. "
-                     "The tracker is probably overloaded. ")
-            else:
-                r = ("Tracker returned status code %d. "
-                     "The tracker has probably malfunctioned. "
-                     ) % (response.code)
-            self.schedule_retry(item, r)
-            self.increment_retry_delay()
+            self.schedule_retry(item, self.error_message(response))
+
+    def error_message(self, response):
+        if response.code == 420 or response.code == 429:
+            return ("Tracker rate limiting is active. "
+                    "We don't want to overload the site we're archiving, "
+                    "so we've limited the number of downloads per minute. ")
+        elif response.code == 404:
+            return ("No item received. There aren't any items available "
+                    "for this project at the moment. Try again later. ")
+        elif response.code == 455:
+            return ("Project code is out of date and needs to be upgraded. "
+                    "To remedy this problem immediately, you may reboot "
+                    "your warrior. ")
+        elif response.code == 599:
+            return ("No HTTP response received from tracker. "
+                    "The tracker is probably overloaded. ")
+        else:
+            return ("Tracker returned status code %d. "
+                    "The tracker has probably malfunctioned. "
+                    ) % (response.code)
 
     def schedule_retry(self, item, message=""):
         if self._set_may_be_canceled:
             item.may_be_canceled = True
+        retry_delay = self.next_retry_delay()
         item.log_output(
-            "%sRetrying after %d seconds...\n" % (message, self.retry_delay))
-        IOLoop.instance().add_timeout(
-            datetime.timedelta(seconds=self.retry_delay),
-            functools.partial(self.send_request, item))
+            "%sRetrying after %d seconds...\n" % (message, retry_delay))
+        IOLoop.current().add_timeout(
+            datetime.timedelta(seconds=retry_delay),
+            self.wrap_item_callback(
+                item, functools.partial(self.send_request, item)))
 
     def process_body(self, body, item):
         raise NotImplementedError()
 
-    def increment_retry_delay(self, max_delay=300):
-        self.retry_delay += 10
-        self.retry_delay = min(max_delay, self.retry_delay)
 
-    def reset_retry_delay(self):
-        self.retry_delay = self.DEFAULT_RETRY_DELAY
+class GetItemFromTracker(TrackerRequest):
+    '''Get a single work unit information from the Tracker.
 
+    If `batch_size` is greater than 1, items are checked out from the
+    Tracker `batch_size` at a time and kept in a local prefetch buffer.
+    New items are then served from the buffer, which is refilled in the
+    background once it holds `refill_threshold` or fewer items. The
+    batches are requested in the Tracker's multi-item mode; see
+    :func:`split_multi_item`.
 
-class GetItemFromTracker(TrackerRequest):
-    '''Get a single work unit information from the Tracker.'''
-    def __init__(self, tracker_url, downloader, version=None):
+    Prefetched items that are still in the buffer when the runner stops
+    are never worked on; the Tracker hands them out again once they
+    time out.
+    '''
+    BATCH_COMMAND = "multi={0}/request"
+
+    def __init__(self, tracker_url, downloader, version=None, batch_size=1,
+                 refill_threshold=None):
         TrackerRequest.__init__(self, "GetItemFromTracker", tracker_url,
                                 "request", may_be_canceled=True)
         self.downloader = downloader
         self.version = version
+        self.batch_size = batch_size
+        self.refill_threshold = refill_threshold
+        self._prefetched = collections.deque()
+        self._waiting = collections.deque()
+        self._refilling = False
+
+    def enqueue(self, item):
+        if realize(self.batch_size, item) <= 1 and not self._prefetched:
+            TrackerRequest.enqueue(self, item)
+            return
+
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+        item.may_be_canceled = True
+        self._waiting.append(item)
+        self._serve_waiting_items()
+        self._refill_if_needed(item)
 
     def data(self, item):
         data = {
@@ -128,21 +380,218 @@ class GetItemFromTracker(TrackerRequest):
     def process_body(self, body, item):
         data = json.loads(body)
         if "item_name" in data:
-            for (k, v) in data.items():
-                item[k] = v
-            item.log_output(
-                "Received item '%s' from tracker\n" % item["item_name"])
-            self.complete_item(item)
+            self._fill_item(item, data)
         else:
             item.log_output("Tracker responded with empty response.\n")
             self.schedule_retry(item)
 
+    def _fill_item(self, item, data):
+        if self._set_may_be_canceled:
+            item.may_be_canceled = False
+        for (k, v) in data.items():
+            item[k] = v
+        item.log_output(
+            "Received item '%s' from tracker\n" % item["item_name"])
+        self.complete_item(item)
+
+    def _serve_waiting_items(self):
+        while self._waiting and self._prefetched:
+            item = self._waiting.popleft()
+            if item.canceled:
+                continue
+            self._fill_item(item, self._prefetched.popleft())
+
+    def _refill_if_needed(self, item):
+        '''Requests a new batch if the buffer runs low. The settings and
+        the request data are realized against `item`, the item that is
+        waiting or was just served.'''
+        if self._refilling:
+            return
+
+        batch_size = realize(self.batch_size, item)
+        if self.refill_threshold is None:
+            refill_threshold = batch_size // 4
+        else:
+            refill_threshold = realize(self.refill_threshold, item)
+
+        if len(self._prefetched) - len(self._waiting) <= refill_threshold:
+            self._refilling = True
+            self._send_refill_request(item)
+
+    def _send_refill_request(self, item):
+        if self.defer_request(
+                functools.partial(self._send_refill_request, item)):
+            return
+
+        batch_size = max(1, realize(self.batch_size, item))
+        self.fetch_tracker(
+            self.tracker_http_request(
+                self.BATCH_COMMAND.format(batch_size), self.data(item)),
+            self._handle_refill_response)
+
+    def _handle_refill_response(self, response):
+        if response.code != 200:
+            message = self.error_message(response)
+        else:
+            try:
+                items = split_multi_item(json.loads(response_text(response)))
+            except ValueError as error:
+                message = "Tracker responded with invalid response: %s\n" % (
+                    error)
+            else:
+                if items:
+                    self._prefetched.extend(items)
+                    self._refilling = False
+                    self._serve_waiting_items()
+                    if self._waiting:
+                        self._refill_if_needed(self._waiting[0])
+                    return
+                message = "Tracker responded with empty response.\n"
+
+        self._schedule_refill_retry(message)
+
+    def _schedule_refill_retry(self, message):
+        self._waiting = collections.deque(
+            item for item in self._waiting if not item.canceled)
+
+        if not self._waiting:
+            self._refilling = False
+            return
+
+        retry_delay = self.next_retry_delay()
+        for item in self._waiting:
+            item.log_output(
+                "%sRetrying after %d seconds...\n" % (message, retry_delay))
+        IOLoop.current().add_timeout(
+            datetime.timedelta(seconds=retry_delay),
+            functools.partial(self._send_refill_request, self._waiting[0]))
+
+
+class _ItemBatcher(object):
+    '''Collects the items of a task into batches.
+
+    A batch is handed to `send` once `batch_size` items, or `batch_bytes`
+    bytes as counted by `item_bytes`, are waiting, or `batch_interval`
+    seconds after the first of them arrived. One batch is sent at a time;
+    :meth:`finished` is called when it is done.
+    '''
+    def __init__(self, send, batch_size, batch_interval, batch_bytes=None,
+                 item_bytes=None):
+        self.send = send
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.batch_bytes = batch_bytes
+        self.item_bytes = item_bytes
+        self.pending = []
+        self.sending = False
+        self._flush_timeout = None
+
+    def add(self, item):
+        self.pending.append(item)
+        self._schedule_flush()
+
+    def finished(self):
+        self.sending = False
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.sending or not self.pending:
+            return
+
+        batch_bytes = realize(self.batch_bytes)
+
+        if len(self.pending) >= realize(self.batch_size) or \
+                (batch_bytes and sum(self.item_bytes(item)
+                                     for item in self.pending) >= batch_bytes):
+            self._flush()
+        elif not self._flush_timeout:
+            self._flush_timeout = IOLoop.current().add_timeout(
+                datetime.timedelta(seconds=realize(self.batch_interval)),
+                self._flush)
+
+    def _flush(self):
+        if self._flush_timeout:
+            IOLoop.current().remove_timeout(self._flush_timeout)
+            self._flush_timeout = None
+
+        batch_size = max(1, realize(self.batch_size))
+        batch_bytes = realize(self.batch_bytes)
+        batch = []
+        total_bytes = 0
+
+        for item in self.pending[:batch_size]:
+            batch.append(item)
+            if batch_bytes:
+                total_bytes += self.item_bytes(item)
+                if total_bytes >= batch_bytes:
+                    break
+
+        del self.pending[:len(batch)]
+        self.sending = True
+        self.send(batch)
+
 
 class SendDoneToTracker(TrackerRequest):
-    '''Inform the Tracker the work unit has been completed.'''
-    def __init__(self, tracker_url, stats):
+    '''Inform the Tracker the work unit has been completed.
+
+    If `batch_size` is greater than 1, the stats of several items are
+    sent together to the Tracker once `batch_size` items are waiting or
+    `batch_interval` seconds after the first of them arrived, merged like
+    the stats of a multi-item (see :func:`merge_done_stats`). An item is
+    completed only when the Tracker confirms the batch it was sent in; a
+    failed batch is retried as a whole. Stats that cannot be merged are
+    sent one by one.
+
+    With `journal` enabled, every notification is written to a
+    :class:`TrackerJournal` in the pipeline data directory before it is
+    sent. Notifications left unconfirmed by a previous run are sent again
+    when the pipeline starts. The journal syncs each write to disk on the
+    IOLoop and needs ``fcntl``, so it is off by default.
+    '''
+    BATCH_COMMAND = "multi={0}/done"
+
+    def __init__(self, tracker_url, stats, batch_size=1, batch_interval=30,
+                 journal=False):
         TrackerRequest.__init__(self, "SendDoneToTracker", tracker_url, "done")
         self.stats = stats
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.journal = journal
+        self._journal = None
+        self._batcher = _ItemBatcher(self._send_batch, batch_size,
+                                     batch_interval)
+
+    def pipeline_started(self, pipeline):
+        if not self.journal:
+            return
+
+        journal = TrackerJournal(pipeline.data_dir, self.name)
+        try:
+            entries = journal.open()
+        except (IOError, OSError):
+            logger.exception('Could not open the tracker journal.')
+            return
+
+        self._journal = journal
+        pipeline.on_cleanup += self._close_journal
+
+        for entry in entries:
+            logger.info('Resending unconfirmed %s notification %s.',
+                        entry["command"], entry["id"])
+            self._send_journal_entry(entry)
+
+    def enqueue(self, item):
+        if self._journal:
+            item["SendDoneToTracker.journal_id"] = self._journal.record(
+                self.tracker_url, self.tracker_command, self.data(item))
+
+        if realize(self.batch_size, item) <= 1:
+            TrackerRequest.enqueue(self, item)
+            return
+
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+        self._batcher.add(item)
 
     def data(self, item):
         return realize(self.stats, item)
@@ -151,12 +600,85 @@ class SendDoneToTracker(TrackerRequest):
         if body.strip() == "OK":
             item.log_output(
                 "Tracker confirmed item '%s'.\n" % item["item_name"])
+            self._confirm_journal_entry(item)
             self.complete_item(item)
         else:
             item.log_output(
                 "Tracker responded with unexpected '%s'.\n" % body.strip())
             self.schedule_retry(item)
 
+    def _send_batch(self, batch):
+        stats = merge_done_stats([self.data(item) for item in batch])
+
+        if stats is None:
+            for item in batch:
+                TrackerRequest.send_request(self, item)
+            self._batcher.finished()
+            return
+
+        if self.defer_request(functools.partial(self._send_batch, batch)):
+            return
+
+        self.fetch_tracker(
+            self.tracker_http_request(
+                self.BATCH_COMMAND.format(len(batch)), stats),
+            functools.partial(self._handle_batch_response, batch))
+
+    def _handle_batch_response(self, batch, response):
+        if response.code == 200:
+            body = response_text(response).strip()
+            if body == "OK":
+                for item in batch:
+                    item.log_output(
+                        "Tracker confirmed item '%s'.\n" % item["item_name"])
+                    self._confirm_journal_entry(item)
+                    self.complete_item(item)
+                self._batcher.finished()
+                return
+            message = "Tracker responded with unexpected '%s'.\n" % body
+        else:
+            message = self.error_message(response)
+
+        retry_delay = self.next_retry_delay()
+        for item in batch:
+            item.log_output(
+                "%sRetrying after %d seconds...\n" % (message, retry_delay))
+        IOLoop.current().add_timeout(
+            datetime.timedelta(seconds=retry_delay),
+            functools.partial(self._send_batch, batch))
+
+    def _confirm_journal_entry(self, item):
+        if self._journal and "SendDoneToTracker.journal_id" in item:
+            self._journal.confirm(item["SendDoneToTracker.journal_id"])
+
+    def _close_journal(self):
+        self._journal.close()
+
+    def _send_journal_entry(self, entry):
+        if self.defer_request(
+                functools.partial(self._send_journal_entry, entry)):
+            return
+
+        self.fetch_tracker(
+            self.tracker_http_request(entry["command"], entry["data"],
+                                      tracker_url=entry["url"]),
+            functools.partial(self._handle_journal_response, entry))
+
+    def _handle_journal_response(self, entry, response):
+        if response.code == 200 and response_text(response).strip() == "OK":
+            logger.info('Tracker confirmed %s notification %s.',
+                        entry["command"], entry["id"])
+            self._journal.confirm(entry["id"])
+            return
+
+        retry_delay = self.next_retry_delay()
+        logger.warning('Tracker did not confirm %s notification %s (%s). '
+                       'Retrying after %d seconds.', entry["command"],
+                       entry["id"], response.code, retry_delay)
+        IOLoop.current().add_timeout(
+            datetime.timedelta(seconds=retry_delay),
+            functools.partial(self._send_journal_entry, entry))
+
 
 class PrepareStatsForTracker(SimpleTask):
     '''Apply statistical values on the item.'''
@@ -191,12 +713,29 @@ class UploadWithTracker(TrackerRequest):
     to where to upload:
 
     * :class:`RsyncUpload`
-    * :class:`CurlUpload`
+    * :class:`CurlUpload`, or :class:`seesaw.upload.HttpUpload` if
+      `native_http_upload` is set or `upload_parallelism` is above 1.
+      Unlike curl, it can upload several files, `upload_parallelism` at
+      a time, and tries each file up to `upload_max_tries` times before
+      the whole upload is retried.
+
+    If `batch_size` is greater than 1, the files of several items are
+    uploaded together in one session: a batch is sent once `batch_size`
+    items or, if given, `batch_bytes` bytes of files are waiting, or
+    `batch_interval` seconds after the first of them arrived. Rsync
+    uploads each file of a batch to the path relative to the
+    `rsync_target_source_path` of its item, like separate uploads would;
+    HTTP batches are uploaded with
+    :class:`seesaw.upload.HttpUpload`. An item is completed only when its
+    whole batch is uploaded; a failed batch is retried as a whole.
     '''
     def __init__(self, tracker_url, downloader, files, version=None,
                  rsync_target_source_path="./", rsync_bwlimit="0",
                  rsync_extra_args=[], curl_connect_timeout="60",
-                 curl_speed_limit="1", curl_speed_time="900"):
+                 curl_speed_limit="1", curl_speed_time="900",
+                 native_http_upload=False, upload_parallelism=1,
+                 upload_max_tries=1, batch_size=1, batch_interval=30,
+                 batch_bytes=None):
         TrackerRequest.__init__(self, "Upload", tracker_url, "upload")
 
         self.downloader = downloader
@@ -209,6 +748,49 @@ class UploadWithTracker(TrackerRequest):
         self.curl_connect_timeout = curl_connect_timeout
         self.curl_speed_limit = curl_speed_limit
         self.curl_speed_time = curl_speed_time
+        self.native_http_upload = native_http_upload
+        self.upload_parallelism = upload_parallelism
+        self.upload_max_tries = upload_max_tries
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.batch_bytes = batch_bytes
+        self._batcher = _ItemBatcher(
+            self._send_batch, batch_size, batch_interval, batch_bytes,
+            item_bytes=lambda item: item["UploadWithTracker.bytes"])
+        self._batches = {}
+
+    def enqueue(self, item):
+        if realize(self.batch_size, item) <= 1:
+            TrackerRequest.enqueue(self, item)
+            return
+
+        self.start_item(item)
+        item.log_output("Starting %s for %s\n" % (self, item.description()))
+        item["UploadWithTracker.bytes"] = sum(
+            os.path.getsize(filename) for filename in self._files(item))
+        self._batcher.add(item)
+
+    def _files(self, item):
+        return [os.path.abspath(realize(filename, item))
+                for filename in realize(self.files, item)]
+
+    def _send_batch(self, batch):
+        total_bytes = sum(item["UploadWithTracker.bytes"] for item in batch)
+
+        # The first item stands in for the batch in the Tracker request
+        # and the upload.
+        self._batches[batch[0]] = batch
+        for item in batch:
+            item.log_output(
+                "Uploading in a batch of %d items (%d bytes).\n"
+                % (len(batch), total_bytes))
+
+        self.send_request(batch[0])
+
+    def _finish_batch(self, item):
+        batch = self._batches.pop(item, None)
+        self._batcher.finished()
+        return batch
 
     def data(self, item):
         data = {"downloader": realize(self.downloader, item),
@@ -221,16 +803,47 @@ class UploadWithTracker(TrackerRequest):
         data = json.loads(body)
         if "upload_target" in data:
             inner_task = None
+            batch = self._batches.get(item)
+
+            if batch:
+                files = [filename for member in batch
+                         for filename in self._files(member)]
+            else:
+                files = self.files
 
             if re.match(r"^rsync://.+/$", data["upload_target"]):
                 item.log_output(
                     "Uploading with Rsync to %s" % data["upload_target"])
-                inner_task = RsyncUpload(
-                    data["upload_target"], self.files,
-                    target_source_path=self.rsync_target_source_path,
-                    bwlimit=self.rsync_bwlimit,
-                    extra_args=self.rsync_extra_args,
-                    max_tries=1)
+                if batch:
+                    inner_task = _BatchRsyncUpload(
+                        data["upload_target"],
+                        [(realize(self.rsync_target_source_path, member),
+                          filename)
+                         for member in batch
+                         for filename in self._files(member)],
+                        bwlimit=self.rsync_bwlimit,
+                        extra_args=self.rsync_extra_args,
+                        max_tries=1)
+                else:
+                    inner_task = RsyncUpload(
+                        data["upload_target"], files,
+                        target_source_path=self.rsync_target_source_path,
+                        bwlimit=self.rsync_bwlimit,
+                        extra_args=self.rsync_extra_args,
+                        max_tries=1)
+
+            elif re.match(r"^https?://.+/$", data["upload_target"]) and \
+                    (self.native_http_upload or batch or
+                     realize(self.upload_parallelism, item) > 1):
+                item.log_output(
+                    "Uploading over HTTP to %s" % data["upload_target"])
+                inner_task = HttpUpload(
+                    data["upload_target"], files,
+                    connect_timeout=self.curl_connect_timeout,
+                    speed_limit=self.curl_speed_limit,
+                    speed_time=self.curl_speed_time,
+                    max_tries=self.upload_max_tries,
+                    parallelism=self.upload_parallelism)
 
             elif re.match(r"^https?://.+/$", data["upload_target"]):
                 item.log_output(
@@ -263,7 +876,230 @@ class UploadWithTracker(TrackerRequest):
             self.schedule_retry(item)
 
     def _inner_task_complete_item(self, task, item):
-        self.complete_item(item)
+        if item in self._batches:
+            for member in self._finish_batch(item):
+                if member is not item:
+                    member.log_output("Batch upload finished.\n")
+                self.complete_item(member)
+        else:
+            self.complete_item(item)
 
     def _inner_task_fail_item(self, task, item):
         self.schedule_retry(item)
+
+    def fail_item(self, item):
+        if item in self._batches:
+            for member in self._finish_batch(item):
+                Task.fail_item(self, member)
+        else:
+            Task.fail_item(self, item)
+
+
+class _BatchRsyncUpload(RsyncUpload):
+    '''Uploads files that have different source paths in one session.
+
+    `files` is a list of ``(source_path, filename)`` pairs. Each file is
+    uploaded to its path relative to `source_path`, marked with ``/./``
+    for rsync's ``--relative``.
+    '''
+    def __init__(self, target, files, **kwargs):
+        RsyncUpload.__init__(self, target, [], target_source_path="/",
+                             **kwargs)
+        self.batch_files = files
+
+    def stdin_data(self, item):
+        return "".join(
+            "%s\n" % os.path.join(os.path.abspath(source_path), ".",
+                                  os.path.relpath(filename, source_path))
+            for source_path, filename in self.batch_files).encode('utf-8')
+
+
+class TrackerJournal(object):
+    '''Write-ahead log of Tracker notifications.
+
+    A notification is appended to the journal before it is sent and marked
+    as confirmed once the Tracker acknowledges it. Each process writes to
+    its own file named ``<name>.<unique id>.journal`` in `directory` and
+    holds a lock on it. When opened, the journal takes over the pending
+    notifications of files that are no longer locked, that is, files left
+    behind by a process that stopped before the Tracker confirmed them.
+    '''
+    COMPACT_THRESHOLD = 1000
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        self.path = None
+        self._file = None
+        self._pending = {}
+        self._line_count = 0
+
+    def open(self):
+        '''Opens the journal and returns the notifications to resend.'''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # The file is locked before it gets a name that other processes
+        # look at, so that they cannot take it over.
+        import fcntl
+
+        fd, temp_path = tempfile.mkstemp(
+            prefix=".%s." % self.name, suffix=".tmp", dir=self.directory)
+        self._file = os.fdopen(fd, "a")
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.path = os.path.join(
+            self.directory,
+            "%s.%s.journal" % (self.name, seesaw.util.unique_id_str()))
+        os.rename(temp_path, self.path)
+
+        recovered = []
+
+        for filename in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, filename)
+            if path == self.path or \
+                    not filename.startswith(self.name + ".") or \
+                    not filename.endswith(".journal"):
+                continue
+
+            recovered.extend(self._take_over(path))
+
+        return recovered
+
+    def record(self, url, command, data):
+        '''Appends a notification and returns its id.'''
+        entry = {
+            "id": seesaw.util.unique_id_str(),
+            "url": url,
+            "command": command,
+            "data": data
+        }
+        self._write(entry)
+        self._pending[entry["id"]] = entry
+        return entry["id"]
+
+    def confirm(self, entry_id):
+        '''Marks a notification as acknowledged by the Tracker.'''
+        if self._pending.pop(entry_id, None) is None:
+            return
+
+        if not self._pending and self._line_count >= self.COMPACT_THRESHOLD:
+            self._file.truncate(0)
+            self._line_count = 0
+        else:
+            self._write({"id": entry_id, "confirmed": True})
+
+    def close(self):
+        self._file.close()
+        if not self._pending:
+            os.remove(self.path)
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._line_count += 1
+
+    def _take_over(self, path):
+        '''Moves the pending notifications of an unlocked journal into
+        this one. The old journal is removed only after they are written.
+        '''
+        import fcntl
+
+        try:
+            journal_file = open(path, "r")
+        except IOError as error:
+            if error.errno == errno.ENOENT:
+                return []
+            raise
+
+        with journal_file:
+            try:
+                fcntl.flock(journal_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as error:
+                if error.errno in (errno.EAGAIN, errno.EACCES):
+                    # Still in use by a running process.
+                    return []
+                raise
+
+            pending = collections.OrderedDict()
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may have been cut short by a crash.
+                    continue
+                if record.get("confirmed"):
+                    pending.pop(record["id"], None)
+                else:
+                    pending[record["id"]] = record
+
+            for entry in pending.values():
+                self._write(entry)
+                self._pending[entry["id"]] = entry
+
+            os.remove(path)
+
+        return list(pending.values())
+
+
+def split_multi_item(data):
+    '''Splits the response to a ``multi={n}/request`` into one dict per
+    item.
+
+    The Tracker hands out the items as a single item whose ``item_name``
+    holds their names joined with NUL characters. The other fields are
+    copied to every item. Raises :class:`ValueError` if `data` is not a
+    Tracker response.
+    '''
+    if not isinstance(data, dict):
+        raise ValueError("Expected an object, got %r." % (data,))
+
+    if not data.get("item_name"):
+        return []
+
+    items = []
+    for item_name in data["item_name"].split("\0"):
+        if item_name:
+            item_data = dict(data)
+            item_data["item_name"] = item_name
+            items.append(item_data)
+
+    return items
+
+
+def merge_done_stats(stats_list):
+    '''Merges the stats of several items into the stats of one
+    ``multi={n}/done`` request, or returns None if they cannot be merged.
+
+    As for :func:`split_multi_item`, the ``item`` names are joined with
+    NUL characters. The ``bytes`` of each file group are added up. All
+    other fields must be the same for every item.
+    '''
+    first = stats_list[0]
+    merged = dict(first)
+    if "bytes" in first:
+        merged["bytes"] = {}
+
+    for stats in stats_list:
+        if set(stats) != set(first) or \
+                not isinstance(stats.get("item"), seesaw.six.string_types) or \
+                not isinstance(stats.get("bytes", {}), dict):
+            return None
+
+        for key, value in stats.items():
+            if key not in ("item", "bytes") and first[key] != value:
+                return None
+
+        for group, num_bytes in stats.get("bytes", {}).items():
+            merged["bytes"][group] = merged["bytes"].get(group, 0) + num_bytes
+
+    merged["item"] = "\0".join(stats["item"] for stats in stats_list)
+    return merged
+
+
+def response_text(response):
+    '''Returns the body of a Tracker response as text.'''
+    if isinstance(response.body, seesaw.six.binary_type):
+        return response.body.decode('utf-8')
+    else:
+        return response.body
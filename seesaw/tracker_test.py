@@ -0,0 +1,447 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from tornado.concurrent import Future
+from tornado.httpclient import HTTPResponse
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+import tornado.web
+
+from seesaw.item import ItemInterpolation, ItemValue
+from seesaw.pipeline import Pipeline
+from seesaw.runner import SimpleRunner
+from seesaw.task import SetItemKey, SimpleTask
+from seesaw.test_base import BaseTestCase
+from seesaw.tracker import GetItemFromTracker, SendDoneToTracker, \
+    TrackerJournal, JitteredBackoff, LinearBackoff, UploadWithTracker, \
+    merge_done_stats
+
+
+class MockHTTPClient(object):
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+
+    def fetch(self, request, raise_error=True):
+        self.requests.append(request)
+        code, body = self.handler(request)
+        response = HTTPResponse(
+            request, code, buffer=io.BytesIO(body.encode('utf-8')))
+        future = Future()
+        IOLoop.current().add_callback(future.set_result, response)
+        return future
+
+
+class TrackerTest(BaseTestCase):
+    def setUp(self):
+        super(TrackerTest, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TrackerTest, self).tearDown()
+        shutil.rmtree(self.temp_dir)
+
+    def test_batched_get_item(self):
+        names = iter(range(100))
+
+        def handler(request):
+            self.assertTrue(request.url.endswith('/multi=5/request'))
+            return 200, json.dumps({
+                'item_name': '\0'.join('item%d' % next(names)
+                                       for dummy in range(5))
+            })
+
+        task = GetItemFromTracker('http://tracker.invalid/test',
+                                  ItemValue('downloader'), batch_size=5)
+        task.http_client = MockHTTPClient(handler)
+        pipeline = Pipeline(SetItemKey('downloader', 'someone'), task)
+        received = []
+
+        def complete_callback(pipeline, item):
+            received.append(item['item_name'])
+
+        pipeline.on_complete_item += complete_callback
+
+        runner = SimpleRunner(pipeline, concurrent_items=2, max_items=5)
+        runner.start()
+
+        self.assertEqual(['item0', 'item1', 'item2', 'item3', 'item4'],
+                         sorted(received))
+        self.assertTrue(len(task.http_client.requests) <= 2)
+        self.assertEqual(
+            ['someone'] * len(task.http_client.requests),
+            [json.loads(request.body)['downloader']
+             for request in task.http_client.requests])
+        self.assertIOLoopOK()
+
+    def test_batched_get_item_retries_invalid_response(self):
+        responses = iter([
+            '<html>Bad Gateway</html>',
+            json.dumps({'item_name': 'item0\0item1', 'item_type': 'x'}),
+        ])
+
+        def handler(request):
+            return 200, next(responses)
+
+        task = GetItemFromTracker('http://tracker.invalid/test', 'someone',
+                                  batch_size=2)
+        task.backoff_policy = LinearBackoff(0, 0, 0)
+        task.http_client = MockHTTPClient(handler)
+        pipeline = Pipeline(task)
+        received = []
+
+        def complete_callback(pipeline, item):
+            received.append((item['item_name'], item['item_type']))
+
+        pipeline.on_complete_item += complete_callback
+
+        runner = SimpleRunner(pipeline, concurrent_items=2, max_items=2)
+        runner.start()
+
+        self.assertEqual([('item0', 'x'), ('item1', 'x')], sorted(received))
+        self.assertEqual(2, len(task.http_client.requests))
+        self.assertIOLoopOK()
+
+    def test_batched_send_done(self):
+        def handler(request):
+            self.assertTrue('/multi=' in request.url)
+            self.assertTrue(request.url.endswith('/done'))
+            return 200, 'OK'
+
+        task = SendDoneToTracker('http://tracker.invalid/test',
+                                 {'item': ItemValue('item_name'),
+                                  'bytes': {'data': 10}},
+                                 batch_size=3, batch_interval=0.1)
+        task.http_client = MockHTTPClient(handler)
+        pipeline = Pipeline(SetItemKey('item_name', 'blah'), task)
+        pipeline.data_dir = self.temp_dir
+        pipeline.has_failed = None
+
+        def fail_callback(task, item):
+            pipeline.has_failed = True
+
+        pipeline.on_fail_item += fail_callback
+
+        runner = SimpleRunner(pipeline, concurrent_items=3, max_items=4)
+        runner.start()
+
+        self.assertFalse(pipeline.has_failed)
+        self.assertEqual(4, runner.item_count)
+        self.assertEqual(2, len(task.http_client.requests))
+        self.assertEqual(
+            {'item': 'blah\0blah\0blah', 'bytes': {'data': 30}},
+            json.loads(task.http_client.requests[0].body))
+        self.assertIOLoopOK()
+
+    def test_batched_send_done_retries(self):
+        responses = iter([(500, ''), (200, 'Not OK'), (200, 'OK')])
+
+        def handler(request):
+            return next(responses)
+
+        task = SendDoneToTracker('http://tracker.invalid/test',
+                                 {'item': ItemValue('item_name')},
+                                 batch_size=2, batch_interval=0.1)
+        task.backoff_policy = LinearBackoff(0, 0, 0)
+        task.http_client = MockHTTPClient(handler)
+        pipeline = Pipeline(SetItemKey('item_name', 'blah'), task)
+        completed = []
+
+        def complete_callback(pipeline, item):
+            completed.append(item)
+
+        pipeline.on_complete_item += complete_callback
+
+        runner = SimpleRunner(pipeline, concurrent_items=2, max_items=2)
+        runner.start()
+
+        self.assertEqual(2, len(completed))
+        self.assertEqual(
+            [{'item': 'blah\0blah'}] * 3,
+            [json.loads(request.body)
+             for request in task.http_client.requests])
+        self.assertIOLoopOK()
+
+    def test_merge_done_stats(self):
+        self.assertEqual(
+            {'item': 'a\0b', 'bytes': {'x': 3, 'y': 4}, 'version': 1},
+            merge_done_stats([
+                {'item': 'a', 'bytes': {'x': 1, 'y': 4}, 'version': 1},
+                {'item': 'b', 'bytes': {'x': 2}, 'version': 1}]))
+        self.assertEqual(None, merge_done_stats([
+            {'item': 'a', 'id': 1}, {'item': 'b', 'id': 2}]))
+
+    def test_batched_upload(self):
+        uploads = []
+
+        class UploadHandler(tornado.web.RequestHandler):
+            def put(self, path):
+                uploads.append((path, self.request.body))
+
+        class WriteFile(SimpleTask):
+            def process(self, item):
+                item['item_name'] = item.item_id
+                with open(os.path.join(item['data_dir'], 'data.txt'),
+                          'w') as out_file:
+                    out_file.write(item.item_id)
+
+        sock, port = bind_unused_port()
+        server = HTTPServer(tornado.web.Application(
+            [(r'/(.*)', UploadHandler)]))
+        server.add_sockets([sock])
+
+        def handler(request):
+            self.assertTrue(request.url.endswith('/upload'))
+            return 200, json.dumps(
+                {'upload_target': 'http://127.0.0.1:%d/' % port})
+
+        task = UploadWithTracker(
+            'http://tracker.invalid/test', 'someone',
+            [ItemInterpolation('%(data_dir)s/data.txt')],
+            batch_size=3, batch_interval=0.1)
+        task.http_client = MockHTTPClient(handler)
+        pipeline = Pipeline(WriteFile('WriteFile'), task)
+        pipeline.data_dir = self.temp_dir
+        completed = []
+
+        def complete_callback(task, item):
+            completed.append(item.item_id)
+
+        task.on_complete_item += complete_callback
+
+        runner = SimpleRunner(pipeline, concurrent_items=3, max_items=4)
+        try:
+            runner.start()
+        finally:
+            server.stop()
+
+        self.assertEqual(4, len(completed))
+        self.assertEqual(2, len(task.http_client.requests))
+        self.assertEqual(
+            sorted(('data.txt', item_id.encode('ascii'))
+                   for item_id in completed),
+            sorted(uploads))
+        self.assertIOLoopOK()
+
+    def test_batched_rsync_upload_keeps_relative_paths(self):
+        uploads = []
+
+        class WriteFile(SimpleTask):
+            def process(self, item):
+                item['item_name'] = item.item_id
+                with open(os.path.join(item['data_dir'], 'data.txt'),
+                          'w') as out_file:
+                    out_file.write(item.item_id)
+
+        def handler(request):
+            return 200, json.dumps(
+                {'upload_target': 'rsync://127.0.0.1/test/'})
+
+        def enqueue_inner_task(inner_task, item):
+            uploads.append(inner_task.stdin_data(item).decode('utf-8'))
+            inner_task.start_item(item)
+            inner_task.complete_item(item)
+
+        # The files of both items are named data.txt.
+        task = UploadWithTracker(
+            'http://tracker.invalid/test', 'someone',
+            [ItemInterpolation('%(data_dir)s/data.txt')],
+            rsync_target_source_path=self.temp_dir,
+            batch_size=2, batch_interval=0.1)
+        task.http_client = MockHTTPClient(handler)
+        task._enqueue_inner_task_with_except = enqueue_inner_task
+        pipeline = Pipeline(WriteFile('WriteFile'), task)
+        pipeline.data_dir = self.temp_dir
+
+        runner = SimpleRunner(pipeline, concurrent_items=2, max_items=2)
+        runner.start()
+
+        self.assertEqual(1, len(uploads))
+        lines = uploads[0].splitlines()
+        self.assertEqual(2, len(set(lines)))
+        for line in lines:
+            source_path, path = line.split('/./')
+            self.assertEqual(os.path.abspath(self.temp_dir), source_path)
+            # The item's directory below the source path is kept.
+            self.assertEqual(2, len(path.split(os.sep)))
+            self.assertEqual('data.txt', os.path.basename(path))
+        self.assertIOLoopOK()
+
+    def test_journal_recovers_unconfirmed_entries(self):
+        journal = TrackerJournal(self.temp_dir, 'Test')
+        self.assertEqual([], journal.open())
+        first_id = journal.record('http://tracker.invalid', 'done', {'a': 1})
+        journal.record('http://tracker.invalid', 'done', {'b': 2})
+        journal.confirm(first_id)
+
+        other_journal = TrackerJournal(self.temp_dir, 'Test')
+        # A journal in use by a live process is left alone.
+        self.assertEqual([], other_journal.open())
+        other_journal.close()
+
+        # Simulate a crash.
+        journal._file.close()
+
+        new_journal = TrackerJournal(self.temp_dir, 'Test')
+        entries = new_journal.open()
+        self.assertEqual(1, len(entries))
+        self.assertEqual({'b': 2}, entries[0]['data'])
+        self.assertEqual([new_journal.path],
+                         [os.path.join(self.temp_dir, filename)
+                          for filename in os.listdir(self.temp_dir)])
+
+        new_journal.confirm(entries[0]['id'])
+        new_journal.close()
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+    def test_journal_takes_over_before_removing(self):
+        journal = TrackerJournal(self.temp_dir, 'Test')
+        journal.open()
+        journal.record('http://tracker.invalid', 'done', {'a': 1})
+        journal._file.close()
+
+        def crash(path):
+            raise OSError('Crash.')
+
+        new_journal = TrackerJournal(self.temp_dir, 'Test')
+        remove = os.remove
+        os.remove = crash
+        try:
+            self.assertRaises(OSError, new_journal.open)
+        finally:
+            os.remove = remove
+        new_journal._file.close()
+
+        with open(new_journal.path) as journal_file:
+            self.assertEqual(
+                [{'a': 1}],
+                [json.loads(line)['data'] for line in journal_file])
+
+    def test_send_done_replays_journal(self):
+        journal = TrackerJournal(self.temp_dir, 'SendDoneToTracker')
+        journal.open()
+        journal.record('http://tracker.invalid/test', 'done',
+                       {'item': 'from-last-run'})
+        journal._file.close()
+
+        def handler(request):
+            return 200, 'OK'
+
+        task = SendDoneToTracker('http://tracker.invalid/test',
+                                 {'item': ItemValue('item_name')},
+                                 journal=True)
+        task.http_client = MockHTTPClient(handler)
+        pipeline = Pipeline(SetItemKey('item_name', 'blah'), task)
+        pipeline.data_dir = self.temp_dir
+
+        runner = SimpleRunner(pipeline, max_items=1)
+        runner.start()
+
+        bodies = [json.loads(request.body)
+                  for request in task.http_client.requests]
+        self.assertEqual([{'item': 'from-last-run'}, {'item': 'blah'}],
+                         bodies)
+        self.assertEqual([], [filename
+                              for filename in os.listdir(self.temp_dir)
+                              if filename.endswith('.journal')])
+        self.assertIOLoopOK()
+
+    def test_backoff_policy_is_shared(self):
+        get_task = GetItemFromTracker('http://tracker.invalid/shared', 'x')
+        done_task = SendDoneToTracker('http://tracker.invalid/shared', {})
+        other_task = GetItemFromTracker('http://tracker.invalid/other', 'x')
+
+        self.assertIs(get_task.backoff_policy, done_task.backoff_policy)
+        self.assertIsNot(get_task.backoff_policy, other_task.backoff_policy)
+
+    def test_only_overload_responses_back_off(self):
+        task = GetItemFromTracker('http://tracker.invalid/codes', 'x')
+        task.backoff_policy = JitteredBackoff()
+
+        for code, failures in ((404, 0), (455, 0), (429, 1), (200, 0),
+                               (503, 1)):
+            task.http_client = MockHTTPClient(
+                lambda request, code=code: (code, ''))
+            future = Future()
+            task.fetch_tracker(task.tracker_http_request('request', {}),
+                               future.set_result)
+            IOLoop.current().run_sync(lambda: future)
+            self.assertEqual(failures, task.backoff_policy.failures)
+
+    def test_retry_delay_compatibility(self):
+        task = SendDoneToTracker('http://tracker.invalid/compat', {})
+        task.backoff_policy = LinearBackoff()
+        self.assertEqual(60, task.retry_delay)
+
+        task.increment_retry_delay()
+        self.assertEqual(70, task.retry_delay)
+        task.reset_retry_delay()
+        self.assertEqual(60, task.retry_delay)
+
+        task.retry_delay = 5
+        self.assertEqual(5, task.retry_delay)
+
+    def test_ordinary_retries_back_off(self):
+        responses = iter([(404, ''), (404, ''), (200, '{}'),
+                          (200, json.dumps({'item_name': 'item0'})),
+                          (404, '')])
+        task = GetItemFromTracker('http://tracker.invalid/retry', 'x')
+        task.backoff_policy = LinearBackoff(initial_delay=0, increment=0.1)
+        task.http_client = MockHTTPClient(lambda request: next(responses))
+        delays = []
+        next_retry_delay = task.next_retry_delay
+
+        def record_retry_delay():
+            delays.append(next_retry_delay())
+            return delays[-1]
+
+        task.next_retry_delay = record_retry_delay
+
+        runner = SimpleRunner(Pipeline(task), max_items=1)
+        runner.start()
+
+        self.assertEqual([0, 0.1, 0.2], delays)
+        self.assertEqual(0, task.next_retry_delay())
+        self.assertEqual(0, task.backoff_policy.delay)
+        self.assertIOLoopOK()
+
+    def test_jittered_backoff(self):
+        policy = JitteredBackoff(base_delay=10, max_delay=300, probe_count=2)
+        self.assertEqual(0, policy.send_delay())
+
+        # A wave of concurrent failures escalates once.
+        tokens = [policy.request_started() for dummy in range(3)]
+        for token in tokens:
+            policy.request_finished(token, False)
+        self.assertEqual(1, policy.failures)
+
+        token = policy.request_started()
+        policy.request_finished(token, False)
+        self.assertEqual(2, policy.failures)
+
+        for dummy in range(100):
+            self.assertTrue(1 <= policy.retry_delay() <= 20)
+            self.assertTrue(1 <= policy.retry_delay(4) <= 80)
+
+        # Only one request at a time while throttled.
+        self.assertEqual(0, policy.send_delay())
+        token = policy.request_started()
+        self.assertTrue(policy.send_delay() > 0)
+
+        policy.request_finished(token, True)
+        self.assertEqual(0, policy.failures)
+        self.assertTrue(policy.throttled)
+
+        for dummy in range(2):
+            self.assertEqual(0, policy.send_delay())
+            token = policy.request_started()
+            self.assertTrue(policy.send_delay() > 0)
+            policy.request_finished(token, True)
+
+        self.assertFalse(policy.throttled)
+        policy.request_started()
+        self.assertEqual(0, policy.send_delay())
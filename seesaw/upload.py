@@ -0,0 +1,329 @@
+'''Uploading files over HTTP without an external process.'''
+import datetime
+import functools
+import mmap
+import os
+import os.path
+import time
+
+import tornado
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from seesaw.config import realize
+from seesaw.task import CoroutineTask
+import seesaw.six
+
+
+class HttpUploadError(Exception):
+    '''An upload failed.'''
+
+
+class UploadProgress(object):
+    '''Counts the bytes sent for an item.
+
+    The counts are stored in the item's ``upload_bytes_sent``,
+    ``upload_bytes_total`` and ``upload_rate`` (bytes per second)
+    properties about once a second.
+    '''
+    REPORT_INTERVAL = 1
+
+    def __init__(self, item, total_bytes):
+        self.item = item
+        self.total_bytes = total_bytes
+        self.bytes_sent = 0
+        self.start_time = time.time()
+        self._last_report_time = None
+
+    def add(self, num_bytes):
+        self.bytes_sent += num_bytes
+
+        now = time.time()
+        if self._last_report_time is None or \
+                now - self._last_report_time >= self.REPORT_INTERVAL:
+            self.report(now)
+
+    def report(self, now=None):
+        now = now or time.time()
+        self._last_report_time = now
+        self.item["upload_bytes_sent"] = self.bytes_sent
+        self.item["upload_bytes_total"] = self.total_bytes
+        self.item["upload_rate"] = int(self.rate(now))
+
+    def rate(self, now=None):
+        elapsed = (now or time.time()) - self.start_time
+        return self.bytes_sent / elapsed if elapsed > 0 else 0.0
+
+
+class SpeedLimit(object):
+    '''Tracks the speed of one request.
+
+    Like curl's ``--speed-limit`` and ``--speed-time``, a request is too
+    slow once it sends fewer than `speed_limit` bytes per second over
+    `speed_time` seconds.
+    '''
+    def __init__(self, speed_limit, speed_time):
+        self.speed_limit = speed_limit
+        self.speed_time = speed_time
+        self.bytes_sent = 0
+        self.aborted = False
+        self.stream = None
+        self._window_start_time = time.time()
+        self._window_start_bytes = 0
+
+    def add(self, num_bytes):
+        self.bytes_sent += num_bytes
+
+    def exceeded(self):
+        if not self.speed_limit:
+            return False
+
+        now = time.time()
+        elapsed = now - self._window_start_time
+
+        if elapsed < self.speed_time:
+            return False
+
+        window_bytes = self.bytes_sent - self._window_start_bytes
+        self._window_start_time = now
+        self._window_start_bytes = self.bytes_sent
+        return window_bytes < self.speed_limit * elapsed
+
+    def abort(self):
+        '''Marks the request as aborted and closes its connection, if it
+        is known.'''
+        self.aborted = True
+        if self.stream is not None:
+            self.stream.close()
+
+
+class HttpUpload(CoroutineTask):
+    '''Uploads files with HTTP PUT requests, like :class:`CurlUpload`.
+
+    Each file is sent to `target` with its base name appended if `target`
+    ends in a slash. Files are streamed from memory maps instead of being
+    read into memory, and redirects are followed. A request fails when it
+    is slower than `speed_limit` bytes per second for `speed_time`
+    seconds; the limits are also sent to the server in the
+    ``X-Curl-Limits`` header.
+
+    Up to `parallelism` files of an item are uploaded at the same time.
+    Each file is tried up to `max_tries` times (default: forever). The
+    item completes when all files are uploaded. It fails once a file runs
+    out of tries; no further files are started then.
+
+    Progress is reported through :class:`UploadProgress`. Each call of
+    :meth:`process` uses its own HTTP client, which is closed when it
+    returns.
+    '''
+    CHUNK_SIZE = 1024 * 1024
+    MAX_REDIRECTS = 5
+    REDIRECT_STATUS_CODES = (301, 302, 303, 307, 308)
+
+    def __init__(self, target, files, connect_timeout=60, speed_limit=1,
+                 speed_time=900, max_tries=None, retry_delay=2,
+                 parallelism=1):
+        CoroutineTask.__init__(self, "HttpUpload")
+        self.target = target
+        self.files = files
+        self.connect_timeout = connect_timeout
+        self.speed_limit = speed_limit
+        self.speed_time = speed_time
+        self.max_tries = max_tries
+        self.retry_delay = retry_delay
+        self.parallelism = parallelism
+
+    @gen.coroutine
+    def process(self, item):
+        target = realize(self.target, item)
+        files = [realize(filename, item)
+                 for filename in realize(self.files, item)]
+
+        if not target.endswith("/") and len(files) != 1:
+            raise HttpUploadError(
+                "Cannot upload %d files to %s." % (len(files), target))
+
+        progress = UploadProgress(
+            item, sum(os.path.getsize(filename) for filename in files))
+        pending_files = list(files)
+        errors = []
+        parallelism = max(1, int(realize(self.parallelism, item)))
+        # Long uploads should not hold up the Tracker requests on the
+        # shared client.
+        http_client = AsyncHTTPClient(force_instance=True)
+
+        try:
+            yield [self._upload_files(http_client, item, target,
+                                      pending_files, progress, errors)
+                   for dummy in range(min(parallelism, len(files)))]
+        finally:
+            http_client.close()
+
+        progress.report()
+
+        if errors:
+            raise errors[0]
+
+        item.log_output(
+            "Uploaded %d bytes in %.1f seconds (%d kB/s).\n" %
+            (progress.bytes_sent, time.time() - progress.start_time,
+             progress.rate() / 1024))
+
+    @gen.coroutine
+    def _upload_files(self, http_client, item, target, pending_files,
+                      progress, errors):
+        while pending_files and not errors:
+            filename = pending_files.pop(0)
+
+            if target.endswith("/"):
+                url = target + os.path.basename(filename)
+            else:
+                url = target
+
+            try:
+                yield self.upload_file(http_client, item, url, filename,
+                                       progress)
+            except HttpUploadError as error:
+                errors.append(error)
+
+    @gen.coroutine
+    def upload_file(self, http_client, item, url, filename, progress):
+        '''Uploads a file, trying up to `max_tries` times.'''
+        tries = 0
+
+        while True:
+            tries += 1
+
+            try:
+                yield self._upload_file_once(http_client, item, url,
+                                             filename, progress)
+                return
+            except HttpUploadError as error:
+                item.log_output("%s\n" % error)
+                max_tries = realize(self.max_tries, item)
+
+                if max_tries is not None and tries >= max_tries:
+                    raise
+
+            item.log_output(
+                "Retrying upload of %s after %d seconds...\n" %
+                (os.path.basename(filename), self.retry_delay))
+            yield gen.sleep(self.retry_delay)
+
+    @gen.coroutine
+    def _upload_file_once(self, http_client, item, url, filename,
+                          progress):
+        with open(filename, "rb") as file_obj:
+            size = os.fstat(file_obj.fileno()).st_size
+
+            if size:
+                data = mmap.mmap(file_obj.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            else:
+                data = b""
+
+            try:
+                for dummy in range(self.MAX_REDIRECTS + 1):
+                    response = yield self._put(http_client, item, url, data,
+                                               size, progress)
+
+                    location = response.headers.get("Location")
+                    if response.code not in self.REDIRECT_STATUS_CODES or \
+                            not location:
+                        break
+
+                    url = seesaw.six.moves.urllib.parse.urljoin(
+                        url, location)
+                    item.log_output("Redirected to %s\n" % url)
+                else:
+                    raise HttpUploadError("Too many redirects.")
+            finally:
+                if size:
+                    try:
+                        data.close()
+                    except BufferError:
+                        # An abandoned request still holds a chunk; the
+                        # map is closed once it is collected.
+                        pass
+
+        if response.error:
+            raise HttpUploadError(
+                "Uploading %s to %s failed: %s" %
+                (filename, url, response.error))
+
+        item.log_output("Upload server: %s\n" % url)
+
+    @gen.coroutine
+    def _put(self, http_client, item, url, data, size, progress):
+        '''Sends one request. Its bytes stay counted in `progress` only if
+        it succeeds.'''
+        speed_limit = SpeedLimit(float(realize(self.speed_limit, item)),
+                                 float(realize(self.speed_time, item)))
+
+        request = HTTPRequest(
+            url,
+            method="PUT",
+            headers={
+                "Content-Length": str(size),
+                "X-Curl-Limits": "inf,%s,%s" % (
+                    realize(self.speed_limit, item),
+                    realize(self.speed_time, item)),
+            },
+            body_producer=functools.partial(
+                self._write_body, data, size, progress, speed_limit),
+            connect_timeout=float(realize(self.connect_timeout, item)),
+            # The speed limit bounds the request instead.
+            request_timeout=0,
+            follow_redirects=False,
+        )
+
+        response_future = http_client.fetch(request, raise_error=False)
+
+        while True:
+            try:
+                # The outcome of an aborted request is of no interest.
+                response = yield gen.with_timeout(
+                    datetime.timedelta(seconds=1), response_future,
+                    quiet_exceptions=(Exception,))
+            except gen.TimeoutError:
+                if speed_limit.exceeded():
+                    speed_limit.abort()
+                    progress.add(-speed_limit.bytes_sent)
+                    raise HttpUploadError(
+                        "Upload to %s is slower than %s bytes per second."
+                        % (url, realize(self.speed_limit, item)))
+            except Exception as error:
+                # Connection errors are raised even with raise_error=False
+                # on newer versions of Tornado.
+                progress.add(-speed_limit.bytes_sent)
+                raise HttpUploadError(
+                    "Uploading to %s failed: %s" % (url, error))
+            else:
+                if response.error:
+                    progress.add(-speed_limit.bytes_sent)
+                raise gen.Return(response)
+
+    @gen.coroutine
+    def _write_body(self, data, size, progress, speed_limit, write):
+        # The connection that `write` belongs to, to close it on abort.
+        speed_limit.stream = getattr(getattr(write, "__self__", None),
+                                     "stream", None)
+        view = memoryview(data) if size else None
+
+        for start in range(0, size, self.CHUNK_SIZE):
+            if speed_limit.aborted:
+                raise HttpUploadError("Upload aborted.")
+
+            chunk = view[start:start + self.CHUNK_SIZE]
+
+            if tornado.version_info < (4, 5):
+                chunk = chunk.tobytes()
+
+            yield write(chunk)
+
+            if speed_limit.aborted:
+                # Its bytes were already taken back from `progress`.
+                raise HttpUploadError("Upload aborted.")
+
+            speed_limit.add(len(chunk))
+            progress.add(len(chunk))
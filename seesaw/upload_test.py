@@ -0,0 +1,194 @@
+import os
+import shutil
+import tempfile
+import time
+
+import tornado.web
+from tornado.concurrent import Future
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+
+from seesaw.pipeline import Pipeline
+from seesaw.runner import SimpleRunner
+from seesaw.test_base import BaseTestCase
+from seesaw.upload import HttpUpload, SpeedLimit, UploadProgress
+
+
+class MockItem(dict):
+    pass
+
+
+@tornado.web.stream_request_body
+class UploadHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        self.chunks = []
+
+    def data_received(self, chunk):
+        self.chunks.append(chunk)
+
+        if self.request.path.startswith('/stall'):
+            # Stops reading the body.
+            return Future()
+
+    def put(self, path):
+        if path.startswith('moved/'):
+            self.redirect('/' + path[len('moved/'):], status=307)
+            return
+
+        attempts = self.application.settings['attempts']
+        attempts[path] = attempts.get(path, 0) + 1
+
+        if path.startswith('flaky') and attempts[path] == 1:
+            self.send_error(500)
+            return
+
+        self.application.settings['uploads'][path] = b''.join(self.chunks)
+        self.application.settings['limits'].append(
+            self.request.headers['X-Curl-Limits'])
+
+
+class UploadTest(BaseTestCase):
+    def setUp(self):
+        super(UploadTest, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.uploads = {}
+        self.limits = []
+        self.attempts = {}
+
+        sock, self.port = bind_unused_port()
+        application = tornado.web.Application(
+            [(r'/(.*)', UploadHandler)],
+            uploads=self.uploads, limits=self.limits,
+            attempts=self.attempts)
+        self.server = HTTPServer(application)
+        self.server.add_sockets([sock])
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.temp_dir)
+        super(UploadTest, self).tearDown()
+
+    def write_file(self, name, data):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'wb') as out_file:
+            out_file.write(data)
+        return path
+
+    def test_upload_progress(self):
+        item = MockItem()
+        progress = UploadProgress(item, 100)
+        progress.add(100)
+
+        self.assertEqual(100, item['upload_bytes_sent'])
+        self.assertEqual(100, item['upload_bytes_total'])
+
+    def test_speed_limit(self):
+        speed_limit = SpeedLimit(10, 0)
+        speed_limit.add(100)
+
+        self.assertFalse(speed_limit.exceeded())
+        self.assertTrue(speed_limit.exceeded())
+        self.assertFalse(SpeedLimit(0, 0).exceeded())
+
+    def test_http_upload(self):
+        files = [
+            self.write_file('a.warc.gz', os.urandom(3 * 1024 * 1024 + 5)),
+            self.write_file('b.warc.gz', b''),
+            self.write_file('c.warc.gz', b'data'),
+        ]
+        task = HttpUpload(
+            'http://127.0.0.1:%d/moved/' % self.port, files,
+            speed_limit=2, speed_time=300, max_tries=1, parallelism=2)
+        pipeline = Pipeline(task)
+        finished = []
+
+        def finish_callback(pipeline, item):
+            finished.append(item)
+
+        pipeline.on_finish_item += finish_callback
+        runner = SimpleRunner(pipeline, max_items=1)
+        runner.start()
+
+        self.assertEqual(1, len(finished))
+        item = finished[0]
+        self.assertTrue(item.completed)
+        self.assertEqual(3 * 1024 * 1024 + 9, item['upload_bytes_total'])
+        self.assertEqual(3 * 1024 * 1024 + 9, item['upload_bytes_sent'])
+
+        for path in files:
+            with open(path, 'rb') as in_file:
+                self.assertEqual(
+                    in_file.read(), self.uploads[os.path.basename(path)])
+
+        self.assertEqual(['inf,2,300'] * 3, self.limits)
+        self.assertIOLoopOK()
+
+    def test_http_upload_retries_each_file(self):
+        files = [self.write_file('flaky.warc.gz', b'a'),
+                 self.write_file('good.warc.gz', b'b')]
+        task = HttpUpload(
+            'http://127.0.0.1:%d/' % self.port, files, max_tries=2,
+            retry_delay=0, parallelism=2)
+        pipeline = Pipeline(task)
+        finished = []
+
+        def finish_callback(pipeline, item):
+            finished.append(item)
+
+        pipeline.on_finish_item += finish_callback
+        runner = SimpleRunner(pipeline, max_items=1)
+        runner.start()
+
+        self.assertTrue(finished[0].completed)
+        self.assertEqual({'flaky.warc.gz': 2, 'good.warc.gz': 1},
+                         self.attempts)
+        self.assertEqual(2, finished[0]['upload_bytes_sent'])
+
+    def test_http_upload_fails(self):
+        path = self.write_file('a.warc.gz', b'data')
+        task = HttpUpload(
+            'http://127.0.0.1:%d/one/two/' % self.port, [path, path],
+            max_tries=2, retry_delay=0)
+        self.server.stop()
+        pipeline = Pipeline(task)
+        finished = []
+
+        def finish_callback(pipeline, item):
+            finished.append(item)
+
+        pipeline.on_finish_item += finish_callback
+        runner = SimpleRunner(pipeline, max_items=1)
+        runner.start()
+
+        self.assertEqual(1, len(finished))
+        self.assertTrue(finished[0].failed)
+
+    def test_http_upload_aborts_stalled_request(self):
+        speed_limits = []
+
+        class RecordingHttpUpload(HttpUpload):
+            def _write_body(self, data, size, progress, speed_limit, write):
+                speed_limits.append(speed_limit)
+                return HttpUpload._write_body(
+                    self, data, size, progress, speed_limit, write)
+
+        path = self.write_file('a.warc.gz', os.urandom(64 * 1024 * 1024))
+        task = RecordingHttpUpload(
+            'http://127.0.0.1:%d/stall/' % self.port, [path],
+            speed_limit=1024 * 1024 * 1024, speed_time=1, max_tries=1)
+        pipeline = Pipeline(task)
+        finished = []
+
+        def finish_callback(pipeline, item):
+            finished.append((item, time.time()))
+
+        pipeline.on_finish_item += finish_callback
+        runner = SimpleRunner(pipeline, max_items=1)
+        start_time = time.time()
+        runner.start()
+
+        item, finish_time = finished[0]
+        self.assertTrue(item.failed)
+        self.assertTrue(finish_time - start_time < 5)
+        self.assertEqual(0, item['upload_bytes_sent'])
+        self.assertTrue(speed_limits[0].stream.closed())
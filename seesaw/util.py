@@ -1,8 +1,17 @@
 '''Miscellaneous functions.'''
 import os
 import subprocess
+import sys
 import time
 import base64
+import datetime
+import threading
+
+import tornado
+import tornado.ioloop
+
+# The exception handler of the item callbacks being scheduled or run.
+_callback_state = threading.local()
 
 
 def test_executable(name, version, path, version_arg="-V"):
@@ -59,3 +68,264 @@ def unique_id_str():
     '''Returns a unique string suitable for IDs.'''
     rand_str = base64.b16encode(os.urandom(8)).decode('ascii').lower()
     return "{0}{1}".format(int(time.time()), rand_str)
+
+
+def use_uvloop():
+    '''Makes the IOLoop run on uvloop.
+
+    Requires Tornado 5 or newer, which runs on asyncio, and the uvloop
+    package. It must be called before the IOLoop is created. Raises
+    :class:`RuntimeError` if uvloop cannot be used.
+    '''
+    if tornado.version_info < (5,):
+        raise RuntimeError('uvloop needs Tornado 5 or newer.')
+
+    try:
+        import asyncio
+        import uvloop
+    except ImportError as error:
+        raise RuntimeError('uvloop is not installed: {0}'.format(error))
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def reset_ioloop(close=True):
+    '''Replaces the current IOLoop with a new one.
+
+    Pass ``close=False`` in a forked child: it shares the epoll instance of
+    the parent's IOLoop, and closing the loop would unregister the parent's
+    file descriptors.
+    '''
+    if close:
+        tornado.ioloop.IOLoop.current().close(all_fds=True)
+
+    if tornado.version_info >= (5,) and sys.version_info[0] == 3:
+        import asyncio
+        asyncio.set_event_loop(asyncio.new_event_loop())
+    else:
+        tornado.ioloop.IOLoop.clear_current()
+        tornado.ioloop.IOLoop.clear_instance()
+
+
+def call_with_exception_handler(handler, function, *args):
+    '''Calls ``function(*args)`` and returns its result.
+
+    When a callback that `function` schedules on an IOLoop prepared with
+    :func:`handle_callback_exceptions` raises an exception,
+    ``handler(exc_info)`` is called. If the handler returns a false value,
+    the IOLoop logs the exception as usual. This also applies to the
+    callbacks that those callbacks schedule. Exceptions raised by
+    `function` itself propagate as usual.
+    '''
+    previous_handler = getattr(_callback_state, 'handler', None)
+    _callback_state.handler = handler
+    try:
+        return function(*args)
+    finally:
+        _callback_state.handler = previous_handler
+
+
+def _wrap_callback(callback):
+    handler = getattr(_callback_state, 'handler', None)
+
+    if handler is None:
+        return callback
+
+    def wrapper(*args, **kwargs):
+        previous_handler = getattr(_callback_state, 'handler', None)
+        _callback_state.handler = handler
+        try:
+            return callback(*args, **kwargs)
+        except Exception:
+            if not handler(sys.exc_info()):
+                raise
+        finally:
+            _callback_state.handler = previous_handler
+
+    return wrapper
+
+
+def handle_callback_exceptions(io_loop):
+    '''Makes the callbacks scheduled on `io_loop` within
+    :func:`call_with_exception_handler` pass their exceptions to its
+    handler.
+
+    The callbacks given to ``add_callback``, ``add_timeout``,
+    ``call_later``, ``call_at`` and ``add_future`` are wrapped when they
+    are scheduled; other callbacks run as before.
+    '''
+    if getattr(io_loop, '_seesaw_handles_callback_exceptions', False):
+        return
+
+    add_callback = io_loop.add_callback
+    call_at = io_loop.call_at
+    add_future = io_loop.add_future
+
+    # add_timeout and call_later go through call_at.
+    io_loop.add_callback = lambda callback, *args, **kwargs: \
+        add_callback(_wrap_callback(callback), *args, **kwargs)
+    io_loop.call_at = lambda when, callback, *args, **kwargs: \
+        call_at(when, _wrap_callback(callback), *args, **kwargs)
+    io_loop.add_future = lambda future, callback: \
+        add_future(future, _wrap_callback(callback))
+    io_loop._seesaw_handles_callback_exceptions = True
+
+
+def free_disk_space(path):
+    '''Returns the bytes available on the file system of `path`, or None
+    if they cannot be measured.
+
+    `path` need not exist yet; its nearest existing parent is used.
+    '''
+    if not hasattr(os, 'statvfs'):
+        return None
+
+    path = os.path.abspath(path)
+
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def available_memory():
+    '''Returns the bytes of memory available to new processes, or None if
+    they cannot be measured (only Linux is supported).'''
+    try:
+        with open('/proc/meminfo') as meminfo_file:
+            for line in meminfo_file:
+                name, value = line.split(':', 1)
+                if name == 'MemAvailable':
+                    return int(value.split()[0]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+
+    return None
+
+
+def open_fd_count():
+    '''Returns the number of file descriptors this process has open, or
+    None if it cannot be measured.'''
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(fd_dir))
+        except OSError:
+            pass
+
+    return None
+
+
+def fd_limit():
+    '''Returns the maximum number of file descriptors this process may
+    open, or None if there is no limit or it is unknown.'''
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    soft_limit, dummy = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if soft_limit == resource.RLIM_INFINITY:
+        return None
+
+    return soft_limit
+
+
+class OutputThrottle(object):
+    '''Limits item output to `rate` characters per second, with bursts of
+    up to `burst` characters.'''
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last_time = time.time()
+
+    def take(self, size):
+        '''Returns whether `size` characters may be sent now.
+
+        A message larger than the remaining budget is let through and
+        delays the ones after it.
+        '''
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+        if self.tokens < 0:
+            return False
+
+        self.tokens -= size
+        return True
+
+
+class OutputCoalescer(object):
+    '''Collects item output and passes it to `send` in larger pieces.
+
+    Output is sent at most every `flush_interval` seconds, or once
+    `flush_size` characters are waiting. Output that waits on `throttle`
+    is cut to its last `flush_size` characters; a marker line says how
+    much was skipped.
+    '''
+    def __init__(self, send, throttle=None, flush_interval=0.25,
+                 flush_size=16 * 1024):
+        self.send = send
+        self.throttle = throttle
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._output = []
+        self._output_size = 0
+        self._skipped_output_size = 0
+        self._flush_timeout = None
+        self._throttled = False
+
+    def add(self, data):
+        self._output.append(data)
+        self._output_size += len(data)
+
+        # While throttled, the output waits for the scheduled flush.
+        if self._output_size >= self.flush_size and not self._throttled:
+            self.flush()
+        elif self._flush_timeout is None:
+            self._schedule_flush()
+
+    def flush(self, force=False):
+        '''Sends the waiting output. With `force`, it is sent regardless
+        of the throttle.'''
+        if self._flush_timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(
+                self._flush_timeout)
+            self._flush_timeout = None
+
+        if not self._output:
+            return
+
+        data = "".join(self._output)
+
+        if not force and self.throttle and \
+                not self.throttle.take(len(data)):
+            if len(data) > self.flush_size:
+                self._skipped_output_size += len(data) - self.flush_size
+                data = data[-self.flush_size:]
+            self._output = [data]
+            self._output_size = len(data)
+            self._throttled = True
+            self._schedule_flush()
+            return
+
+        if self._skipped_output_size:
+            data = "\n[%d characters of output skipped]\n%s" % (
+                self._skipped_output_size, data)
+            self._skipped_output_size = 0
+
+        self._output = []
+        self._output_size = 0
+        self._throttled = False
+        self.send(data)
+
+    def _schedule_flush(self):
+        self._flush_timeout = tornado.ioloop.IOLoop.current().add_timeout(
+            datetime.timedelta(seconds=self.flush_interval), self.flush)
@@ -17,6 +17,7 @@ import logging
 
 from tornado import gen
 from tornado import ioloop
+from tornado.concurrent import Future
 from tornado.httpclient import AsyncHTTPClient
 
 import seesaw
@@ -25,7 +26,7 @@ from seesaw.config import realize
 from seesaw.event import Event
 from seesaw.externalprocess import AsyncPopen2
 from seesaw.log import InternalTempLogHandler
-from seesaw.runner import Runner
+from seesaw.runner import Runner, AdmissionControl
 import seesaw.six
 
 
@@ -239,8 +240,11 @@ class Warrior(object):
         self.bandwidth_monitor = BandwidthMonitor("eth0")
         self.bandwidth_monitor.update()
 
-        self.runner = Runner(concurrent_items=self.concurrent_items,
-                             keep_data=self.keep_data)
+        self.runner = Runner(
+            concurrent_items=self.concurrent_items,
+            keep_data=self.keep_data,
+            admission_control=AdmissionControl(
+                min_free_memory=None, max_fd_usage=None))
         self.runner.on_finish += self.handle_runner_finish
 
         self.current_project_name = None
@@ -267,7 +271,7 @@ class Warrior(object):
         self.shut_down_flag = False
         self.reboot_flag = False
 
-        io_loop = ioloop.IOLoop.instance()
+        io_loop = ioloop.IOLoop.current()
 
         def update_warror_callback():
             io_loop.add_future(
@@ -459,7 +463,8 @@ class Warrior(object):
                     env=self.gitenv
                 )
             p.on_output += self.collect_install_output
-            p.on_end += yield gen.Callback("gitend")
+            end_future = Future()
+            p.on_end += end_future.set_result
 
             try:
                 p.run()
@@ -468,7 +473,7 @@ class Warrior(object):
                 result = 9999
                 self.install_output.append(str(error))
             else:
-                result = yield gen.Wait("gitend")
+                result = yield end_future
 
             if result != 0:
                 self.install_output.append("\ngit returned %d\n" % result)
@@ -502,7 +507,8 @@ class Warrior(object):
                     cwd=project_path
                 )
                 p.on_output += self.collect_install_output
-                p.on_end += yield gen.Callback("installend")
+                end_future = Future()
+                p.on_end += end_future.set_result
                 try:
                     p.run()
                 except OSError as error:
@@ -510,7 +516,7 @@ class Warrior(object):
                     result = 9999
                     self.install_output.append(str(error))
                 else:
-                    result = yield gen.Wait("installend")
+                    result = yield end_future
 
                 if result != 0:
                     self.install_output.append(
@@ -591,9 +597,10 @@ class Warrior(object):
                 env=self.gitenv
             )
             p.on_output += self.collect_install_output
-            p.on_end += yield gen.Callback("gitend")
+            end_future = Future()
+            p.on_end += end_future.set_result
             p.run()
-            result = yield gen.Wait("gitend")
+            result = yield end_future
 
             if result != 0:
                 logger.debug('Got return code %s', result)
@@ -789,7 +796,7 @@ class Warrior(object):
         self.fire_status()
 
         if self.shut_down_flag or self.reboot_flag:
-            ioloop.IOLoop.instance().stop()
+            ioloop.IOLoop.current().stop()
 
             if self.real_shutdown:
                 if self.shut_down_flag:
@@ -798,7 +805,7 @@ class Warrior(object):
                     system_reboot()
 
     def start(self):
-        io_loop = ioloop.IOLoop.instance()
+        io_loop = ioloop.IOLoop.current()
 
         if self.real_shutdown:
             # schedule a reboot
@@ -826,13 +833,13 @@ class Warrior(object):
         if self.runner.is_active():
             self.runner.set_current_pipeline(None)
         else:
-            ioloop.IOLoop.instance().stop()
+            ioloop.IOLoop.current().stop()
             if self.real_shutdown:
                 system_reboot()
 
     def schedule_forced_reboot(self):
         if self.real_shutdown and not self.forced_reboot_timeout:
-            self.forced_reboot_timeout = ioloop.IOLoop.instance().add_timeout(
+            self.forced_reboot_timeout = ioloop.IOLoop.current().add_timeout(
                 datetime.timedelta(days=2), self.forced_reboot)
 
     def forced_reboot(self):
@@ -847,19 +854,19 @@ class Warrior(object):
         if self.runner.is_active():
             self.runner.set_current_pipeline(None)
         else:
-            ioloop.IOLoop.instance().stop()
+            ioloop.IOLoop.current().stop()
             if self.real_shutdown:
                 system_shutdown()
 
     def forced_stop(self):
-        ioloop.IOLoop.instance().stop()
+        ioloop.IOLoop.current().stop()
         if self.real_shutdown:
             system_shutdown()
 
     def keep_running(self):
         self.shut_down_flag = False
         self.reboot_flag = False
-        ioloop.IOLoop.instance().add_future(
+        ioloop.IOLoop.current().add_future(
             self.start_selected_project(), lambda fut: fut.result()
         )
         self.fire_status()
@@ -1,5 +1,6 @@
 '''The warrior web interface.'''
 import collections
+import datetime
 import hashlib
 import json
 import os
@@ -7,11 +8,13 @@ import os.path
 import random
 import re
 import time
+import weakref
 
 from sockjs.tornado import SockJSConnection, SockJSRouter
 from tornado import web, ioloop
 
 from seesaw.config import realize
+from seesaw.util import OutputCoalescer, OutputThrottle
 from seesaw.web_util import BaseWebAdminHandler
 
 PUBLIC_PATH = os.path.abspath(
@@ -28,10 +31,29 @@ class IndexHandler(BaseWebAdminHandler):
 
 
 class ItemMonitor(object):
-    '''Pushes item states and information to the client.'''
+    '''Pushes item states and information to the client.
+
+    Item output is collected and sent at most every
+    `OUTPUT_FLUSH_INTERVAL` seconds, or once `OUTPUT_FLUSH_SIZE`
+    characters are waiting. The output of all items is limited by
+    `output_throttle`; output that waits on it is cut to its last
+    `OUTPUT_FLUSH_SIZE` characters.
+
+    The last `OUTPUT_TAIL_SIZE` or so characters of sent output are kept
+    for the snapshots of new clients.
+    '''
+    OUTPUT_FLUSH_INTERVAL = 0.25
+    OUTPUT_FLUSH_SIZE = 16 * 1024
+    OUTPUT_TAIL_SIZE = 64 * 1024
+    output_throttle = OutputThrottle(128 * 1024)
+
     def __init__(self, item):
         self.pipeline = item.pipeline
         self.item = item
+        self.output = OutputCoalescer(
+            self.send_output, throttle=self.output_throttle,
+            flush_interval=self.OUTPUT_FLUSH_INTERVAL,
+            flush_size=self.OUTPUT_FLUSH_SIZE)
 
         item.on_output += self.handle_item_output
         item.on_task_status += self.handle_item_task_status
@@ -40,8 +62,10 @@ class ItemMonitor(object):
         item.on_fail += self.handle_item_fail
         item.on_cancel += self.handle_item_cancel
 
-        self.collected_data = collections.deque((), 500)
+        self.collected_data = collections.deque()
+        self.collected_size = 0
 
+        SeesawConnection.add_pipeline(self.pipeline)
         SeesawConnection.broadcast(
             "pipeline.start_item",
             {"pipeline_id": id(self.pipeline),
@@ -51,14 +75,9 @@ class ItemMonitor(object):
     def item_for_broadcast(self):
         item = self.item
 
-        tasks = []
-        for (task, task_name) in self.pipeline.ui_task_list():
-            tasks.append({
-                "id": id(task),
-                "name": task_name,
-                "status": (item.task_status[task]
-                           if task in item.task_status else None)
-            })
+        # Indexed like the UI task list of the pipeline.
+        task_status = [item.task_status.get(task)
+                       for task, dummy in self.pipeline.ui_task_list()]
 
         if self.pipeline.project:
             project_name = self.pipeline.project.title
@@ -70,8 +89,9 @@ class ItemMonitor(object):
                      if "item_name" in item else "New item"),
             "number": item.item_number,
             "status": self.item_status(),
-            "tasks": tasks,
-            "output": "".join(self.collected_data),
+            "pipeline_id": id(self.pipeline),
+            "task_status": task_status,
+            "output": "".join(self.collected_data)[-self.OUTPUT_TAIL_SIZE:],
             "project": project_name,
             "start_time": item.start_time
         }
@@ -89,11 +109,25 @@ class ItemMonitor(object):
             return "running"
 
     def handle_item_output(self, item, data):
-        self.collected_data.append(data)
+        self.output.add(data)
+
+    def send_output(self, data):
+        self.collect_output(data)
         SeesawConnection.broadcast(
-            "item.output", {"item_id": item.item_id, "data": data})
+            "item.output", {"item_id": self.item.item_id, "data": data})
+
+    def collect_output(self, data):
+        '''Keeps the tail of the output that is sent to the clients.'''
+        self.collected_data.append(data)
+        self.collected_size += len(data)
+
+        while self.collected_size - len(self.collected_data[0]) >= \
+                self.OUTPUT_TAIL_SIZE:
+            self.collected_size -= len(self.collected_data.popleft())
 
     def handle_item_task_status(self, item, task, new_status, old_status):
+        # The output of a task is shown before its new status.
+        self.output.flush(force=True)
         SeesawConnection.broadcast(
             "item.task_status",
             {
@@ -111,12 +145,15 @@ class ItemMonitor(object):
                 {"item_id": item.item_id, "new_name": "Item %s" % new_value})
 
     def handle_item_complete(self, item):
+        self.output.flush(force=True)
         SeesawConnection.broadcast("item.complete", {"item_id": item.item_id})
 
     def handle_item_fail(self, item):
+        self.output.flush(force=True)
         SeesawConnection.broadcast("item.fail", {"item_id": item.item_id})
 
     def handle_item_cancel(self, item):
+        self.output.flush(force=True)
         SeesawConnection.broadcast("item.cancel", {"item_id": item.item_id})
 
 
@@ -181,49 +218,264 @@ class ApiHandler(BaseWebAdminHandler):
 
 
 class SeesawConnection(SockJSConnection):
-    '''A WebSocket server that communicates the state of the warrior.'''
+    '''A WebSocket server that communicates the state of the warrior.
+
+    Messages go straight to SockJS while a client keeps up. Once more
+    than `MAX_TRANSPORT_BACKLOG` characters wait in its transport, they
+    are held in an outbox of at most `MAX_OUTBOX_SIZE` characters and
+    sent as the transport drains. In the outbox, a message of one of the
+    `COLLAPSED_EVENTS` replaces the previous one of its kind, and item
+    output is dropped, oldest first, when the outbox is full. A client
+    that is still too far behind is sent a fresh snapshot instead.
+
+    A client is sent a snapshot when it connects and then receives the
+    broadcasts. Broadcasts other than the `COLLAPSED_EVENTS` are numbered
+    with ``seq``, and the last `HISTORY_SIZE` of them, up to
+    `MAX_HISTORY_SIZE` characters, are recorded. A client that sends a
+    ``sync`` message skips the numbered messages it already has, so when
+    it falls too far behind, it is sent the recorded messages it may have
+    missed instead of a snapshot.
+    '''
     instance_id = ("%d-%f" % (os.getpid(), random.random()))
 
+    MAX_TRANSPORT_BACKLOG = 64 * 1024
+    MAX_OUTBOX_SIZE = 256 * 1024
+    COLLAPSED_EVENTS = ("bandwidth", "timestamp")
+    DRAIN_INTERVAL = 0.1
+    HISTORY_SIZE = 1000
+    MAX_HISTORY_SIZE = 1024 * 1024
+
     clients = set()
     item_monitors = dict()
+    # The pipelines whose UI task list was broadcast.
+    pipelines = weakref.WeakSet()
+
+    sequence = 0
+    # Entries are (seq, event_name, data, item_id) tuples.
+    history = collections.deque()
+    history_size = 0
+    _snapshot = None
 
     warrior = None
     project = None
     runner = None
+    # The SockJSRouter of the web server, which sends the broadcasts.
+    router = None
+
+    def __init__(self, session):
+        SockJSConnection.__init__(self, session)
+        # Entries are [event_name, data, item_id] lists.
+        self.outbox = collections.deque()
+        self.outbox_size = 0
+        self.skipped_output = {}
+        self.needs_resync = False
+        self.synced = False
+        # The seq of the last message that was sent before the client
+        # became backlogged.
+        self.resync_seq = None
+        self._drain_timeout = None
+
+    @staticmethod
+    def encode(event_name, message, seq=None):
+        doc = {'event_name': event_name, 'message': message}
+        if seq is not None:
+            doc['seq'] = seq
+        return json.dumps(doc)
 
     def emit(self, event_name, message):
         '''tornadoio to sockjs adapter.'''
-        self.send(json.dumps({'event_name': event_name, 'message': message}))
+        self.send_encoded(event_name, self.encode(event_name, message))
+
+    def transport_backlog(self):
+        '''Returns the characters written to the transport but not yet
+        sent to the client.'''
+        session = self.session
+        # Polling transports queue messages in the session.
+        backlog = len(getattr(session, "send_queue", None) or "")
+
+        stream = getattr(getattr(session.handler, "ws_connection", None),
+                         "stream", None)
+        if stream is not None:
+            # Tornado 4 counts the buffered bytes separately; later
+            # versions keep them in a single buffer.
+            write_buffer_size = getattr(stream, "_write_buffer_size", None)
+            if write_buffer_size is None:
+                write_buffer_size = len(
+                    getattr(stream, "_write_buffer", None) or ())
+            backlog += write_buffer_size
+
+        return backlog
+
+    def is_backlogged(self):
+        return bool(self.outbox or self.needs_resync or
+                    self.transport_backlog() >= self.MAX_TRANSPORT_BACKLOG)
+
+    def send_encoded(self, event_name, data, item_id=None):
+        '''Sends an encoded message, or queues it if the client is
+        backlogged.'''
+        if self.is_backlogged():
+            self.enqueue(event_name, data, item_id)
+        else:
+            self.send(data)
+
+    def enqueue(self, event_name, data, item_id=None):
+        if self.needs_resync:
+            # The snapshot or the replay will contain it.
+            return
+
+        if not self.outbox:
+            # The current broadcast has not been sent.
+            self.resync_seq = self.sequence - 1
+
+        if event_name in self.COLLAPSED_EVENTS:
+            for entry in self.outbox:
+                if entry[0] == event_name:
+                    self.outbox.remove(entry)
+                    self.outbox_size -= len(entry[1])
+                    break
+
+        self.outbox.append([event_name, data, item_id])
+        self.outbox_size += len(data)
+
+        if self.outbox_size > self.MAX_OUTBOX_SIZE:
+            self._drop_output()
+
+        if self.outbox_size > self.MAX_OUTBOX_SIZE:
+            self.outbox.clear()
+            self.outbox_size = 0
+            self.skipped_output = {}
+            self.needs_resync = True
+
+        self._schedule_drain()
+
+    def _drop_output(self):
+        kept = collections.deque()
+
+        while self.outbox:
+            entry = self.outbox.popleft()
+
+            if entry[0] == "item.output" and \
+                    self.outbox_size > self.MAX_OUTBOX_SIZE:
+                self.outbox_size -= len(entry[1])
+                # Roughly the characters of output, without the framing.
+                self.skipped_output[entry[2]] = \
+                    self.skipped_output.get(entry[2], 0) + len(entry[1])
+            else:
+                kept.append(entry)
+
+        self.outbox = kept
+
+    def _schedule_drain(self):
+        if self._drain_timeout is None:
+            self._drain_timeout = ioloop.IOLoop.current().add_timeout(
+                datetime.timedelta(seconds=self.DRAIN_INTERVAL), self.drain)
+
+    def drain(self):
+        '''Sends queued messages while the transport keeps up.'''
+        self._drain_timeout = None
+
+        if self.is_closed:
+            return
+
+        while self.transport_backlog() < self.MAX_TRANSPORT_BACKLOG:
+            if self.needs_resync:
+                self.needs_resync = False
+                if self.synced and self.can_replay(self.resync_seq):
+                    self.send_replay(self.resync_seq)
+                else:
+                    self.send_snapshot()
+            elif self.skipped_output:
+                item_id, size = self.skipped_output.popitem()
+                self.send(self.encode("item.output", {
+                    "item_id": item_id,
+                    "data": "\n[%d characters of output skipped]\n" % size
+                }))
+            elif self.outbox:
+                entry = self.outbox.popleft()
+                self.outbox_size -= len(entry[1])
+                self.send(entry[1])
+            else:
+                return
+
+        self._schedule_drain()
 
     def on_open(self, info):
-        self.clients.add(self)
         self.emit("instance_id", self.instance_id)
+        self.send_snapshot()
+        self.clients.add(self)
+
+    def sync(self, instance_id):
+        '''Switches a client that shows the state of this instance to
+        deltas when it falls too far behind.'''
+        self.synced = instance_id == self.instance_id
+
+    @classmethod
+    def can_replay(cls, seq):
+        if not isinstance(seq, int) or seq > cls.sequence:
+            return False
+
+        if seq == cls.sequence:
+            return True
+
+        return bool(cls.history) and cls.history[0][0] <= seq + 1
+
+    def send_replay(self, seq):
+        '''Sends the recorded messages after `seq`.'''
+        for entry_seq, event_name, data, item_id in self.history:
+            if entry_seq > seq:
+                self.send(data)
+
+    def send_snapshot(self):
+        '''Sends the state of the project and the warrior. The client
+        replaces what it shows with it.'''
+        for data in self.snapshot():
+            self.send(data)
+
+    @classmethod
+    def snapshot(cls):
+        '''Returns the encoded snapshot messages. They are built once
+        for each state.'''
+        if cls._snapshot is not None:
+            return cls._snapshot
 
-        items = []
-        for item_monitor in self.item_monitors.values():
-            items.append(item_monitor.item_for_broadcast())
+        snapshot = []
 
-        if self.project:
-            self.emit("project.refresh", {
-                "project": self.project.data_for_json(),
+        if cls.project:
+            items = []
+            for item_monitor in cls.item_monitors.values():
+                items.append(item_monitor.item_for_broadcast())
+
+            pipelines = dict(
+                (id(pipeline), pipeline.ui_task_list_for_json())
+                for pipeline in cls.pipelines)
+
+            snapshot.append(cls.encode("project.refresh", {
+                "project": cls.project.data_for_json(),
                 "status": ("stopping"
-                           if self.runner.should_stop() else "running"),
-                "items": items
-            })
+                           if cls.runner.should_stop() else "running"),
+                "admission": cls.runner.admission_refusal,
+                "pipelines": pipelines,
+                "items": items,
+                "resync": True
+            }, cls.sequence))
         else:
-            self.emit("project.refresh", None)
+            snapshot.append(cls.encode("project.refresh", None, cls.sequence))
 
-        if self.warrior:
-            self.emit("warrior.projects_loaded", {
-                "projects": self.warrior.projects
-            })
-            self.emit("warrior.status",
-                      {"status": self.warrior.warrior_status()})
-            self.emit("warrior.broadcast_message",
-                      {
-                          "message": self.warrior.broadcast_message,
-                          "hash": hash_string(self.warrior.broadcast_message)
-                      })
+        if cls.warrior:
+            snapshot.append(cls.encode("warrior.projects_loaded", {
+                "projects": cls.warrior.projects
+            }))
+            snapshot.append(cls.encode(
+                "warrior.status", {"status": cls.warrior.warrior_status()}))
+            snapshot.append(cls.encode(
+                "warrior.broadcast_message",
+                {
+                    "message": cls.warrior.broadcast_message,
+                    "hash": hash_string(cls.warrior.broadcast_message)
+                }))
+
+        cls._snapshot = snapshot
+        return snapshot
 
     @classmethod
     def broadcast_bandwidth(cls):
@@ -275,6 +527,7 @@ class SeesawConnection(SockJSConnection):
     def handle_project_refresh(cls, warrior, project, runner):
         cls.project = project
         cls.runner = runner
+        cls._snapshot = None
         cls.broadcast_project_refresh()
 
     @classmethod
@@ -292,6 +545,7 @@ class SeesawConnection(SockJSConnection):
                 "project": cls.project.data_for_json(),
                 "status": ("stopping"
                            if cls.runner.should_stop() else "running"),
+                "admission": cls.runner.admission_refusal,
                 "items": []
             })
         else:
@@ -303,26 +557,88 @@ class SeesawConnection(SockJSConnection):
             "status": ("stopping" if runner.should_stop() else "running")
         })
 
+    @classmethod
+    def handle_runner_admission(cls, runner, reason):
+        cls.broadcast("runner.admission", {"reason": reason})
+
     @classmethod
     def handle_start_item(cls, runner, pipeline, item):
         cls.item_monitors[item] = ItemMonitor(item)
 
+    @classmethod
+    def add_pipeline(cls, pipeline):
+        '''Broadcasts the UI task list of a pipeline once. Items refer to
+        it by the pipeline ID.'''
+        if pipeline not in cls.pipelines:
+            cls.pipelines.add(pipeline)
+            cls.broadcast("pipeline.tasks", {
+                "pipeline_id": id(pipeline),
+                "tasks": pipeline.ui_task_list_for_json()
+            })
+
     @classmethod
     def handle_finish_item(cls, runner, pipeline, item):
         del cls.item_monitors[item]
+        cls._snapshot = None
 
     @classmethod
     def broadcast(cls, event, message):
+        '''Sends a message to all clients. It is encoded once, and once
+        more for the SockJS frame of the WebSocket clients. Backlogged
+        clients queue it instead.'''
+        if event in cls.COLLAPSED_EVENTS:
+            if not cls.clients:
+                return
+            data = cls.encode(event, message)
+        else:
+            data = cls.record(event, message)
+
+        ready_clients = []
+        item_id = (message or {}).get("item_id")
+
         for client in cls.clients:
-            if message:
-                message["session_id"] = client.session.session_id
-            client.emit(event, message)
+            if client.is_backlogged():
+                client.enqueue(event, data, item_id)
+            else:
+                ready_clients.append(client)
+
+        if ready_clients:
+            cls.router.broadcast(ready_clients, data)
+
+    @classmethod
+    def record(cls, event, message):
+        '''Numbers a broadcast and records it in the history. Returns
+        it encoded.'''
+        cls.sequence += 1
+        cls._snapshot = None
+
+        data = cls.encode(event, message, cls.sequence)
+        cls.history.append(
+            (cls.sequence, event, data, (message or {}).get("item_id")))
+        cls.history_size += len(data)
+
+        while len(cls.history) > cls.HISTORY_SIZE or \
+                cls.history_size > cls.MAX_HISTORY_SIZE:
+            cls.history_size -= len(cls.history.popleft()[2])
+
+        return data
 
     def on_message(self, message):
-        pass
+        try:
+            doc = json.loads(message)
+        except ValueError:
+            return
+
+        if isinstance(doc, dict) and doc.get("event_name") == "sync":
+            state = doc.get("message") or {}
+            self.sync(state.get("instance_id"))
 
     def on_close(self):
-        self.clients.remove(self)
+        self.clients.discard(self)
+
+        if self._drain_timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(self._drain_timeout)
+            self._drain_timeout = None
 
 
 def hash_string(text):
@@ -346,10 +662,12 @@ def start_runner_server(project, runner, bind_address="localhost", port_number=8
     runner.on_pipeline_start_item += SeesawConnection.handle_start_item
     runner.on_pipeline_finish_item += SeesawConnection.handle_finish_item
     runner.on_status += SeesawConnection.handle_runner_status
+    runner.on_admission += SeesawConnection.handle_runner_admission
 
     ioloop.PeriodicCallback(SeesawConnection.broadcast_timestamp, 1000).start()
 
     router = SockJSRouter(SeesawConnection)
+    SeesawConnection.router = router
 
     application = web.Application(
         router.apply_routes([
@@ -394,6 +712,7 @@ def start_warrior_server(warrior, bind_address="localhost", port_number=8001,
     warrior.runner.on_pipeline_finish_item += \
         SeesawConnection.handle_finish_item
     warrior.runner.on_status += SeesawConnection.handle_runner_status
+    warrior.runner.on_admission += SeesawConnection.handle_runner_admission
 
     if not http_username:
         http_username = warrior.http_username
@@ -404,6 +723,7 @@ def start_warrior_server(warrior, bind_address="localhost", port_number=8001,
     ioloop.PeriodicCallback(SeesawConnection.broadcast_timestamp, 1000).start()
 
     router = SockJSRouter(SeesawConnection)
+    SeesawConnection.router = router
 
     application = web.Application(
         router.apply_routes([
@@ -0,0 +1,261 @@
+import collections
+import json
+
+from seesaw.item import Item
+from seesaw.pipeline import Pipeline
+from seesaw.task import PrintItem
+from seesaw.test_base import BaseTestCase
+from seesaw.util import OutputThrottle
+from seesaw.web import ItemMonitor, SeesawConnection
+
+
+class FakeSession(object):
+    '''Records the messages sent to a client. Set `send_queue` to make
+    the client look backlogged.'''
+    def __init__(self):
+        self.messages = []
+        self.send_queue = ''
+        self.handler = None
+        self.is_closed = False
+        self.session_id = 'session'
+
+    def send_message(self, message, binary=False):
+        self.messages.append(json.loads(message))
+
+
+class FakeRouter(object):
+    def __init__(self):
+        self.broadcasts = 0
+
+    def broadcast(self, clients, message):
+        self.broadcasts += 1
+
+        for client in clients:
+            client.session.send_message(message)
+
+
+class WebTest(BaseTestCase):
+    STATE = ('clients', 'item_monitors', 'sequence', 'history',
+             'history_size', '_snapshot', 'warrior', 'project', 'runner',
+             'router', 'HISTORY_SIZE', 'MAX_OUTBOX_SIZE')
+
+    def setUp(self):
+        super(WebTest, self).setUp()
+
+        self.saved_state = dict(
+            (name, getattr(SeesawConnection, name)) for name in self.STATE)
+        SeesawConnection.clients = set()
+        SeesawConnection.item_monitors = {}
+        SeesawConnection.sequence = 0
+        SeesawConnection.history = collections.deque()
+        SeesawConnection.history_size = 0
+        SeesawConnection._snapshot = None
+        SeesawConnection.warrior = None
+        SeesawConnection.project = None
+        SeesawConnection.runner = None
+        SeesawConnection.router = FakeRouter()
+        self.connections = []
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.on_close()
+
+        for name, value in self.saved_state.items():
+            setattr(SeesawConnection, name, value)
+
+        super(WebTest, self).tearDown()
+
+    def connect(self, instance_id=None, clear=True):
+        '''Opens a connection that syncs if `instance_id` is given. With
+        `clear`, the messages sent on opening are forgotten.'''
+        connection = SeesawConnection(FakeSession())
+        self.connections.append(connection)
+        connection.on_open(None)
+
+        if instance_id is not None:
+            connection.on_message(json.dumps({
+                'event_name': 'sync',
+                'message': {'instance_id': instance_id}
+            }))
+
+        if clear:
+            connection.session.messages = []
+
+        return connection
+
+    def backlog(self, *connections):
+        for connection in connections:
+            connection.session.send_queue = \
+                'x' * SeesawConnection.MAX_TRANSPORT_BACKLOG
+
+    def unblock(self, *connections):
+        for connection in connections:
+            connection.session.send_queue = ''
+            connection.drain()
+
+    def broadcast_events(self, count):
+        for index in range(count):
+            SeesawConnection.broadcast('warrior.status', {'status': index})
+
+    def events(self, connection):
+        return [(message['event_name'], message.get('seq'))
+                for message in connection.session.messages
+                if message['event_name'] != 'instance_id']
+
+    def test_new_client_gets_snapshot(self):
+        self.broadcast_events(3)
+        connection = self.connect(clear=False)
+        self.broadcast_events(1)
+
+        self.assertEqual(
+            [('project.refresh', 3), ('warrior.status', 4)],
+            self.events(connection))
+        self.assertEqual('instance_id',
+                         connection.session.messages[0]['event_name'])
+
+    def test_synced_client_catches_up_with_replay(self):
+        SeesawConnection.MAX_OUTBOX_SIZE = 1000
+        connection = self.connect(SeesawConnection.instance_id)
+        self.broadcast_events(2)
+        self.backlog(connection)
+        self.broadcast_events(50)
+
+        self.assertTrue(connection.needs_resync)
+
+        self.unblock(connection)
+        self.assertEqual(
+            [('warrior.status', seq) for seq in range(1, 53)],
+            self.events(connection))
+
+    def test_client_without_history_resyncs_with_snapshot(self):
+        SeesawConnection.MAX_OUTBOX_SIZE = 1000
+        SeesawConnection.HISTORY_SIZE = 10
+        # The client shows another instance.
+        other_connection = self.connect('other-instance')
+        connection = self.connect(SeesawConnection.instance_id)
+        self.backlog(other_connection, connection)
+        self.broadcast_events(50)
+
+        # Messages 1 to 40 are no longer recorded.
+        self.unblock(other_connection, connection)
+        self.assertEqual([('project.refresh', 50)],
+                         self.events(other_connection))
+        self.assertEqual([('project.refresh', 50)], self.events(connection))
+
+    def test_broadcast_is_sent_once_to_ready_clients(self):
+        connections = [self.connect()
+                       for dummy in range(3)]
+        connections[2].session.send_queue = \
+            'x' * SeesawConnection.MAX_TRANSPORT_BACKLOG
+        self.broadcast_events(1)
+
+        self.assertEqual(1, SeesawConnection.router.broadcasts)
+        self.assertEqual([[('warrior.status', 1)]] * 2 + [[]],
+                         [self.events(connection)
+                          for connection in connections])
+        self.assertEqual(1, len(connections[2].outbox))
+
+    def test_backlogged_client_collapses_messages(self):
+        connection = self.connect()
+        connection.session.send_queue = \
+            'x' * SeesawConnection.MAX_TRANSPORT_BACKLOG
+
+        for index in range(3):
+            SeesawConnection.broadcast('timestamp', {'timestamp': index})
+            SeesawConnection.broadcast('bandwidth', {'sending': index})
+        self.broadcast_events(1)
+
+        self.assertEqual([], self.events(connection))
+        self.assertEqual(3, len(connection.outbox))
+
+        connection.session.send_queue = ''
+        connection.drain()
+
+        self.assertEqual(
+            [('timestamp', None), ('bandwidth', None), ('warrior.status', 1)],
+            self.events(connection))
+        self.assertEqual(
+            [{'timestamp': 2}, {'sending': 2}, {'status': 0}],
+            [message['message'] for message in connection.session.messages])
+        self.assertFalse(connection.is_backlogged())
+
+    def test_backlogged_client_skips_output(self):
+        SeesawConnection.MAX_OUTBOX_SIZE = 1000
+        connection = self.connect()
+        connection.session.send_queue = \
+            'x' * SeesawConnection.MAX_TRANSPORT_BACKLOG
+
+        for index in range(5):
+            SeesawConnection.broadcast(
+                'item.output', {'item_id': 'a', 'data': 'x' * 300})
+        self.broadcast_events(1)
+
+        self.assertEqual(3, len(connection.outbox))
+        self.assertFalse(connection.needs_resync)
+
+        connection.session.send_queue = ''
+        connection.drain()
+        messages = connection.session.messages
+
+        self.assertEqual(
+            ['item.output', 'item.output', 'item.output', 'warrior.status'],
+            [message['event_name'] for message in messages])
+        # The three oldest messages were dropped.
+        skipped_size = sum(
+            len(SeesawConnection.encode(
+                'item.output', {'item_id': 'a', 'data': 'x' * 300}, seq))
+            for seq in range(1, 4))
+        self.assertEqual(
+            {'item_id': 'a',
+             'data': '\n[%d characters of output skipped]\n' % skipped_size},
+            messages[0]['message'])
+        self.assertEqual([4, 5], [message['seq'] for message in messages[1:3]])
+
+    def test_overflowing_client_resyncs(self):
+        SeesawConnection.MAX_OUTBOX_SIZE = 1000
+        connection = self.connect()
+        connection.session.send_queue = \
+            'x' * SeesawConnection.MAX_TRANSPORT_BACKLOG
+
+        self.broadcast_events(50)
+
+        self.assertTrue(connection.needs_resync)
+        self.assertEqual(0, len(connection.outbox))
+        self.assertEqual(0, connection.outbox_size)
+
+        self.broadcast_events(1)
+        self.assertEqual(0, len(connection.outbox))
+
+        connection.session.send_queue = ''
+        connection.drain()
+
+        self.assertEqual([('project.refresh', 51)], self.events(connection))
+        self.assertFalse(connection.is_backlogged())
+
+        self.broadcast_events(1)
+        self.assertEqual(('warrior.status', 52), self.events(connection)[-1])
+
+    def test_item_output_precedes_task_status(self):
+        connection = self.connect()
+        pipeline = Pipeline(PrintItem())
+        item = Item(pipeline, 'item-1', 1, keep_data=True,
+                    prepare_data_directory=False)
+        monitor = ItemMonitor(item)
+        # The output throttle is used up.
+        monitor.output.throttle = OutputThrottle(1)
+        monitor.output.throttle.tokens = -1
+
+        item.log_output('hello\n')
+        item.set_task_status(pipeline.tasks[0], Item.TaskStatus.running)
+        item.log_output('bye\n')
+        item.complete()
+
+        self.assertEqual(
+            ['pipeline.tasks', 'pipeline.start_item', 'item.output',
+             'item.task_status', 'item.output', 'item.complete'],
+            [event for event, dummy in self.events(connection)])
+        self.assertEqual(
+            ['hello\n', 'bye\n'],
+            [message['message']['data']
+             for message in connection.session.messages
+             if message['event_name'] == 'item.output'])
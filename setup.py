@@ -44,13 +44,21 @@ else:
     ]
 
 requires = [
-    'Tornado>=4,<4.99999.99999',
     'sockjs-tornado',
 ]
 
+if sys.version_info < (3, 7):
+    # Tornado 6 is only supported on Python 3.7 and newer.
+    requires.append('Tornado>=4.3,<6')
+else:
+    requires.append('Tornado>=4.3,<7')
+
 if sys.version_info < (2, 7):
     requires.append('ordereddict')
 
+if sys.version_info < (3, 2):
+    requires.append('futures')
+
 setup(
     name='seesaw',
     version=seesaw.__version__,
@@ -66,4 +74,7 @@ setup(
     include_package_data=True,
     scripts=scripts,
     install_requires=requires,
+    extras_require={
+        'uvloop': ['uvloop'],
+    },
 )
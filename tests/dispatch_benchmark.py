@@ -0,0 +1,72 @@
+'''Measures the per-task overhead of dispatching items through a pipeline.
+
+Run from the repository root::
+
+    python tests/dispatch_benchmark.py
+'''
+from __future__ import print_function
+
+import time
+
+from tornado.ioloop import IOLoop
+
+from seesaw.item import Item
+from seesaw.pipeline import Pipeline
+from seesaw.task import Task, LimitConcurrent
+
+
+class PassTask(Task):
+    '''Completes items immediately.'''
+    def __init__(self):
+        Task.__init__(self, 'PassTask')
+
+    def enqueue(self, item):
+        self.start_item(item)
+        self.complete_item(item)
+
+
+class CallbackTask(Task):
+    '''Completes items from an IOLoop callback.'''
+    def __init__(self):
+        Task.__init__(self, 'CallbackTask')
+
+    def enqueue(self, item):
+        self.start_item(item)
+        IOLoop.current().add_callback(self.complete_item, item)
+
+
+def run(name, task_factory, num_tasks=20, num_items=2000):
+    pipeline = Pipeline(*[task_factory() for dummy in range(num_tasks)])
+    finished = []
+
+    def finish_callback(pipeline, item):
+        finished.append(item)
+        if len(finished) == num_items:
+            IOLoop.current().stop()
+
+    pipeline.on_finish_item += finish_callback
+
+    items = [Item(pipeline, str(item_number), item_number,
+                  keep_data=True, prepare_data_directory=False)
+             for item_number in range(num_items)]
+
+    start_time = time.time()
+
+    for item in items:
+        IOLoop.current().add_callback(pipeline.enqueue, item)
+
+    IOLoop.current().start()
+
+    duration = time.time() - start_time
+    print('%-20s %8.2f us per task' % (
+        name, duration / (num_tasks * num_items) * 1e6))
+
+
+def main():
+    run('synchronous', PassTask)
+    run('LimitConcurrent', lambda: LimitConcurrent(100, PassTask()))
+    run('IOLoop callback', CallbackTask)
+
+
+if __name__ == '__main__':
+    main()
@@ -69,4 +69,4 @@ if __name__ == '__main__':
     app = tornado.web.Application(handlers=handlers)
 
     app.listen(8681, 'localhost')
-    tornado.ioloop.IOLoop.instance().start()
+    tornado.ioloop.IOLoop.current().start()
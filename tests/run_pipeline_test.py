@@ -21,3 +21,21 @@ class RunPipelineTest(unittest.TestCase):
             '--disable-web-server'
         ])
 
+    def test_example_pipeline_processes(self):
+        if sys.version_info[0] == 3:
+            python_exe = 'python3'
+            pipeline_exe = './run-pipeline3'
+        else:
+            python_exe = 'python'
+            pipeline_exe = './run-pipeline'
+
+        subprocess.check_call([
+            python_exe,
+            pipeline_exe,
+            './examples/example-pipeline.py',
+            'testuser',
+            '--max-items', '2',
+            '--concurrent', '2',
+            '--processes', '2',
+            '--disable-web-server'
+        ])